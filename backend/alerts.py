@@ -0,0 +1,180 @@
+"""
+Price alerts: "notify me when TSLA crosses X".
+
+AlertIndex keeps, per symbol and direction, a sorted array of thresholds
+with a parallel array of alert ids (16 bytes per alert). Thresholds are
+stored so that the alerts a price crosses always form a suffix: a tick
+bisects once and pops just that range. Deleted alerts are tombstoned (id 0)
+and squeezed out when they pile up.
+
+The index is per process and loaded once, so the app must run as a single
+worker process: alerts created in another worker would never fire here.
+Triggering only moves ACTIVE alerts, so an alert still fires at most once.
+"""
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timezone
+
+from sqlalchemy import select, update
+
+from model import SessionLocal, PriceAlert
+
+DIRECTIONS = ("ABOVE", "BELOW")
+COMPACT_MIN_DEAD = 4096
+TRIGGER_BATCH_SIZE = 500
+
+
+class _Thresholds:
+    """Sorted keys with parallel ids; keys are -threshold for ABOVE, threshold for BELOW."""
+
+    __slots__ = ("keys", "ids")
+
+    def __init__(self):
+        self.keys = array("d")
+        self.ids = array("q")
+
+    def insert(self, key, alert_id):
+        i = bisect_right(self.keys, key)
+        self.keys.insert(i, key)
+        self.ids.insert(i, alert_id)
+
+    def find(self, key, alert_id):
+        for i in range(bisect_left(self.keys, key), bisect_right(self.keys, key)):
+            if self.ids[i] == alert_id:
+                return i
+        return None
+
+    def pop_from(self, key):
+        """Remove and return the ids whose key is >= key."""
+        i = bisect_left(self.keys, key)
+        fired = [alert_id for alert_id in self.ids[i:] if alert_id]
+        dead = len(self.ids) - i - len(fired)
+        del self.keys[i:]
+        del self.ids[i:]
+        return fired, dead
+
+    def compact(self):
+        live = [(k, i) for k, i in zip(self.keys, self.ids) if i]
+        self.keys = array("d", (k for k, _ in live))
+        self.ids = array("q", (i for _, i in live))
+
+
+def _key(direction, threshold):
+    return -float(threshold) if direction == "ABOVE" else float(threshold)
+
+
+class AlertIndex:
+    """Active alerts indexed by symbol and threshold."""
+
+    def __init__(self):
+        self._books = {}  # (symbol, direction) -> _Thresholds
+        self._live = 0
+        self._dead = 0
+        self._lock = threading.Lock()
+        self.loaded = False
+
+    def __len__(self):
+        return self._live
+
+    def add(self, alert_id, symbol, direction, threshold):
+        with self._lock:
+            book = self._books.setdefault((symbol.upper(), direction), _Thresholds())
+            book.insert(_key(direction, threshold), alert_id)
+            self._live += 1
+
+    def remove(self, alert_id, symbol, direction, threshold):
+        """Tombstone an alert; returns False if it wasn't indexed."""
+        with self._lock:
+            book = self._books.get((symbol.upper(), direction))
+            i = book.find(_key(direction, threshold), alert_id) if book else None
+            if i is None:
+                return False
+            book.ids[i] = 0
+            self._live -= 1
+            self._dead += 1
+            if self._dead > max(COMPACT_MIN_DEAD, self._live):
+                for book in self._books.values():
+                    book.compact()
+                self._dead = 0
+            return True
+
+    def on_price(self, symbol, price):
+        """Pop and return the ids of alerts on symbol that price has reached."""
+        symbol = symbol.upper()
+        fired = []
+        with self._lock:
+            for direction in DIRECTIONS:
+                book = self._books.get((symbol, direction))
+                if book and book.keys:
+                    # ABOVE fires for threshold <= price, i.e. -threshold >= -price
+                    ids, dead = book.pop_from(_key(direction, price))
+                    fired.extend(ids)
+                    self._live -= len(ids)
+                    self._dead -= dead
+        return fired
+
+    def load(self, rows):
+        """Bulk-index (id, symbol, direction, threshold) rows of active alerts."""
+        grouped = {}
+        for alert_id, symbol, direction, threshold in rows:
+            grouped.setdefault((symbol.upper(), direction), []).append((_key(direction, threshold), alert_id))
+        with self._lock:
+            for book_key, entries in grouped.items():
+                book = self._books.setdefault(book_key, _Thresholds())
+                if book.keys:
+                    for key, alert_id in entries:
+                        book.insert(key, alert_id)
+                else:
+                    entries.sort()
+                    book.keys = array("d", (k for k, _ in entries))
+                    book.ids = array("q", (i for _, i in entries))
+                self._live += len(entries)
+            self.loaded = True
+
+    def load_active(self, conn):
+        self.load(conn.execute(select(PriceAlert.id, PriceAlert.symbol, PriceAlert.direction,
+                                      PriceAlert.threshold).where(PriceAlert.status == "ACTIVE")))
+
+    def symbols(self):
+        with self._lock:
+            return {symbol for (symbol, _), book in self._books.items() if book.keys}
+
+    def clear(self):
+        with self._lock:
+            self._books.clear()
+            self._live = self._dead = 0
+
+    def stats(self):
+        with self._lock:
+            nbytes = sum(b.keys.itemsize * len(b.keys) + b.ids.itemsize * len(b.ids)
+                         for b in self._books.values())
+            return {"alerts": self._live, "tombstones": self._dead, "books": len(self._books), "bytes": nbytes}
+
+
+def trigger_alerts(alert_ids, price, session_factory=SessionLocal):
+    """Mark fired alerts TRIGGERED so the notifications endpoint delivers them."""
+    triggered = 0
+    now = datetime.now(timezone.utc)
+    with session_factory() as session:
+        for start in range(0, len(alert_ids), TRIGGER_BATCH_SIZE):
+            batch = alert_ids[start:start + TRIGGER_BATCH_SIZE]
+            triggered += session.execute(
+                update(PriceAlert).where(PriceAlert.id.in_(batch), PriceAlert.status == "ACTIVE")
+                .values(status="TRIGGERED", triggered_price=price, triggered_at=now)
+                .execution_options(synchronize_session=False)).rowcount
+        session.commit()
+    return triggered
+
+
+def alert_to_dict(alert):
+    return {
+        "id": alert.id,
+        "symbol": alert.symbol,
+        "threshold": float(alert.threshold),
+        "direction": alert.direction,
+        "status": alert.status,
+        "triggered_price": float(alert.triggered_price) if alert.triggered_price is not None else None,
+        "triggered_at": alert.triggered_at.isoformat() if alert.triggered_at else None,
+        "created_at": alert.created_at.isoformat() if alert.created_at else None,
+    }
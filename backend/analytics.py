@@ -0,0 +1,205 @@
+"""
+Portfolio performance analytics from the transaction ledger and the local
+price history store.
+
+Trades are scattered onto a (days x symbols) grid and cumulated into daily
+position vectors; closes are forward-filled onto the same grid. Portfolio
+value, time-weighted return, volatility, drawdown, beta and the holding
+correlation matrix are then plain NumPy array operations with no per-row
+Python loops.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from sqlalchemy import select, func
+
+from model import Transaction
+from pricehistory import price_history, from_day, to_day, DAY, CLOSE
+
+ANALYTICS_BENCHMARK = os.getenv("ANALYTICS_BENCHMARK", "SPY")
+ANALYTICS_CACHE_TTL = float(os.getenv("ANALYTICS_CACHE_TTL", "3600"))
+ANALYTICS_CACHE_SIZE = 1024
+TRADING_DAYS = 252
+CORRELATION_WINDOW = TRADING_DAYS
+
+
+def load_trades(conn, user_id):
+    """The user's ledger as (symbols, day, symbol index, signed quantity, price) arrays."""
+    rows = conn.execute(
+        select(Transaction.timestamp, Transaction.symbol, Transaction.quantity,
+               Transaction.price, Transaction.transaction_type)
+        .where(Transaction.user_id == user_id)
+        .order_by(Transaction.timestamp, Transaction.id)).all()
+    symbols = sorted({row.symbol for row in rows})
+    position = {symbol: i for i, symbol in enumerate(symbols)}
+    days = np.array([to_day(row.timestamp.date()) for row in rows], dtype=np.int64)
+    columns = np.array([position[row.symbol] for row in rows], dtype=np.int64)
+    quantities = np.array([row.quantity if row.transaction_type == "BUY" else -row.quantity for row in rows],
+                          dtype=np.float64)
+    prices = np.array([float(row.price) for row in rows], dtype=np.float64)
+    return symbols, days, columns, quantities, prices
+
+
+def _align(grid, days, values):
+    """Forward-fill values observed on days onto grid (back-filling before the first one)."""
+    idx = np.searchsorted(days, grid, side="right") - 1
+    return values[np.clip(idx, 0, len(values) - 1)]
+
+
+def _rounded(value, places=6):
+    return None if value is None or not np.isfinite(value) else round(float(value), places)
+
+
+def compute_analytics(symbols, days, columns, quantities, prices, series, benchmark=None):
+    """
+    series maps symbol -> (days, closes) price history; symbols without any
+    are valued at their own trade prices. benchmark is (days, closes) or None.
+    """
+    if not len(days):
+        return None
+    missing = [s for s in symbols if s not in series or not len(series[s][0])]
+    history_days = [series[s][0] for s in symbols if s not in missing]
+    start = days.min()
+    grid = np.unique(np.concatenate(history_days + [days]))
+    grid = grid[grid >= start]
+    n_days, n_symbols = len(grid), len(symbols)
+
+    closes = np.empty((n_days, n_symbols))
+    for j, symbol in enumerate(symbols):
+        if symbol in missing:
+            mask = columns == j
+            closes[:, j] = _align(grid, days[mask], prices[mask])
+        else:
+            closes[:, j] = _align(grid, *series[symbol])
+
+    # Trades on non-trading days land on the next grid day
+    at = np.minimum(np.searchsorted(grid, days, side="left"), n_days - 1)
+    deltas = np.zeros((n_days, n_symbols))
+    np.add.at(deltas, (at, columns), quantities)
+    holdings = np.cumsum(deltas, axis=0)
+    flows = np.zeros(n_days)
+    np.add.at(flows, at, quantities * prices)
+
+    values = (holdings * closes).sum(axis=1)
+    previous = values[:-1]
+    invested = previous > 0
+    returns = np.zeros(n_days - 1)
+    np.divide(values[1:] - flows[1:], previous, out=returns, where=invested)
+    returns[invested] -= 1
+    active = returns[invested]
+
+    growth = np.cumprod(1 + returns)
+    drawdowns = growth / np.maximum.accumulate(growth) - 1 if len(growth) else np.zeros(1)
+    twr = growth[-1] - 1 if len(growth) else 0.0
+    annualized = (1 + twr) ** (TRADING_DAYS / len(active)) - 1 if len(active) else None
+    volatility = active.std(ddof=1) * np.sqrt(TRADING_DAYS) if len(active) > 1 else None
+
+    beta = None
+    if benchmark is not None and len(benchmark[0]) > 1 and len(active) > 1:
+        bench = _align(grid, *benchmark)
+        bench_returns = (bench[1:] / bench[:-1] - 1)[invested]
+        variance = bench_returns.var(ddof=1)
+        if variance > 0:
+            beta = np.cov(active, bench_returns, ddof=1)[0, 1] / variance
+
+    held = np.flatnonzero(holdings[-1] > 0)
+    window = closes[-(CORRELATION_WINDOW + 1):, held]
+    correlation = None
+    if len(held) > 1 and len(window) > 2:
+        symbol_returns = window[1:] / window[:-1] - 1
+        with np.errstate(invalid="ignore", divide="ignore"):
+            matrix = np.corrcoef(symbol_returns, rowvar=False)
+        correlation = {
+            "symbols": [symbols[j] for j in held],
+            "matrix": [[_rounded(v, 4) for v in row] for row in matrix],
+        }
+
+    return {
+        "start": from_day(grid[0]).isoformat(),
+        "end": from_day(grid[-1]).isoformat(),
+        "days": int(n_days),
+        "time_weighted_return": _rounded(twr),
+        "annualized_return": _rounded(annualized),
+        "volatility": _rounded(volatility),
+        "max_drawdown": _rounded(drawdowns.min()),
+        "beta": _rounded(beta),
+        "benchmark": ANALYTICS_BENCHMARK if beta is not None else None,
+        "correlation": correlation,
+        "equity_curve": [{"date": from_day(d).isoformat(), "value": round(v, 2)}
+                         for d, v in zip(grid.tolist(), values.tolist())],
+        "missing_price_history": missing,
+    }
+
+
+class AnalyticsCache:
+    """
+    Per-user results keyed by a fingerprint of the ledger (row count and
+    last id) and of the price history files involved, so new or imported
+    transactions and newly fetched bars invalidate the entry on the next
+    read. Entries also expire after ANALYTICS_CACHE_TTL as prices move.
+    """
+
+    def __init__(self, maxsize=ANALYTICS_CACHE_SIZE, ttl=ANALYTICS_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # user_id -> (fingerprint, computed_at, result)
+        self._lock = threading.Lock()
+
+    def get(self, user_id, fingerprint):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[0] != fingerprint or time.monotonic() - entry[1] > self.ttl:
+                return None
+            self._entries.move_to_end(user_id)
+            return entry[2]
+
+    def put(self, user_id, fingerprint, result):
+        with self._lock:
+            self._entries[user_id] = (fingerprint, time.monotonic(), result)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+analytics_cache = AnalyticsCache()
+
+
+def ledger_fingerprint(conn, user_id):
+    return tuple(conn.execute(
+        select(func.count(), func.max(Transaction.id)).where(Transaction.user_id == user_id)).one())
+
+
+def history_fingerprint(conn, user_id, store, benchmark=None):
+    """Stamps of the price history files for the user's symbols and the benchmark."""
+    symbols = sorted(conn.scalars(select(Transaction.symbol).where(Transaction.user_id == user_id).distinct()))
+    return tuple(store.stamp(symbol) for symbol in symbols + ([benchmark] if benchmark else []))
+
+
+def portfolio_analytics(conn, user_id, store=None, benchmark=ANALYTICS_BENCHMARK):
+    """Cached analytics for user_id, or None if the user has no transactions."""
+    store = store or price_history
+    fingerprint = ledger_fingerprint(conn, user_id) + history_fingerprint(conn, user_id, store, benchmark)
+    result = analytics_cache.get(user_id, fingerprint)
+    if result is not None:
+        return result
+    symbols, days, columns, quantities, prices = load_trades(conn, user_id)
+    series = {}
+    for symbol in symbols:
+        bars = store.bars(symbol)
+        series[symbol] = (bars[DAY], bars[CLOSE])
+    bench = store.bars(benchmark) if benchmark else None
+    result = compute_analytics(symbols, days, columns, quantities, prices, series,
+                               (bench[DAY], bench[CLOSE]) if bench is not None and bench.shape[1] else None)
+    analytics_cache.put(user_id, fingerprint, result)
+    return result
@@ -1,12 +1,31 @@
 from decimal import Decimal
 import os
-from flask import Flask, request, jsonify
+import time
+import zlib
+from flask import Flask, Response, request, jsonify, stream_with_context
 from helpers import *
 from create import *
-from model import dbconnect, User, Transaction, Portfolio
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import select, update
+from model import db_session, engine, init_app, User, Transaction, Portfolio, PendingOrder, PriceAlert
+from trading import (TradeRejected, ORDER_BATCH_MAX, trade_listeners, run_trade, execute_buy, execute_sell,
+                     parse_order, plan_orders, execute_orders)
+from pricefeed import PriceFeed, PRICE_FEED_INTERVAL, FeedFull, sse_stream
+from marketdata import MarketDataRefresher, held_symbols
+from orders import ORDER_TYPES, TriggerEngine, fill_orders, order_to_dict
+from alerts import DIRECTIONS, AlertIndex, trigger_alerts, alert_to_dict
+from pricehistory import price_history, bars_to_dicts
+from analytics import ANALYTICS_BENCHMARK, portfolio_analytics
+from leaderboard import LEADERBOARD_MAX_LIMIT, Leaderboard
+import identity
+from passwords import PASSWORD_BUSY, PasswordBusy, hasher
+from identity import current_user_id, current_profile, current_cash, load_profile
+from ledger import (LedgerQueryError, LedgerImportError, parse_history_args, history_query, history_page,
+                    export_query, export_row_to_dict, stream_json, stream_ndjson, stream_csv, import_transactions,
+                    import_listeners)
 from flask_cors import CORS
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
-from datetime import timedelta
+from flask_jwt_extended import JWTManager, create_access_token, jwt_required
+from datetime import datetime, timedelta, timezone
 
 
 # Configure application
@@ -14,9 +33,10 @@ from datetime import timedelta
 app = Flask(__name__, static_folder="static")
 
 # CORS configuration for React frontend
+CORS_ORIGINS = ["http://localhost:3000", "http://localhost:5173", "http://127.0.0.1:3000", "http://127.0.0.1:5173"]
 CORS(app, resources={
     r"/api/*": {
-        "origins": ["http://localhost:3000", "http://localhost:5173", "http://127.0.0.1:3000", "http://127.0.0.1:5173"],
+        "origins": CORS_ORIGINS,
         "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
         "allow_headers": ["Content-Type", "Authorization"],
         "supports_credentials": True
@@ -24,7 +44,10 @@ CORS(app, resources={
 })
 
 
-session_db = dbconnect()
+# Request-scoped session: each request thread gets its own, released on teardown
+session_db = db_session
+init_app(app)
+identity.init_app(app)
 
 
 # Configure session_db to use filesystem (instead of signed cookies)
@@ -46,12 +69,43 @@ load_dotenv() # This loads the variables from .env into your system
 
 api_key = os.getenv("API_KEY")
 
+# Per-user resources validated with ETags: clients may keep a copy but must revalidate it
+REVALIDATE = "private, no-cache"
+# Market-wide data that changes slowly may be reused without asking (seconds)
+TRENDING_MAX_AGE = 300
+PRICE_HISTORY_MAX_AGE = 900
+
 @app.after_request
 def after_request(response):
-    """Ensure responses aren't cached"""
-    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    response.headers["Expires"] = 0
-    response.headers["Pragma"] = "no-cache"
+    """Ensure responses aren't cached unless the endpoint chose its own policy"""
+    if "Cache-Control" not in response.headers:
+        response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+        response.headers["Expires"] = 0
+        response.headers["Pragma"] = "no-cache"
+    return response
+
+
+def _user_etag(user_id, resource, *variant):
+    """
+    Strong ETag for one of the user's resources, derived from the user's
+    version counter; None if the user doesn't exist.
+    """
+    version = session_db.scalar(select(User.version).where(User.id == user_id))
+    if version is None:
+        return None
+    return "-".join(str(part) for part in (resource, user_id, version) + variant)
+
+
+def _not_modified(etag):
+    """The 304 answer when the client's If-None-Match already has etag, else None."""
+    if not request.if_none_match.contains(etag):
+        return None
+    return _validated(Response(status=304), etag)
+
+
+def _validated(response, etag):
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = REVALIDATE
     return response
 
 
@@ -81,9 +135,13 @@ def api_register():
     if existing_username:
         return jsonify({"error": "Username already exists"}), 400
     
+    try:
+        hashed_password = hasher.hash(data['password'])
+    except PasswordBusy:
+        return jsonify({"error": PASSWORD_BUSY}), 503
+
     try:
         # Create new user
-        hashed_password = generate_password_hash(data['password'])
         user = User(
             full_names=data['full_names'],
             email=data['email'],
@@ -92,6 +150,8 @@ def api_register():
         )
         session_db.add(user)
         session_db.commit()
+        if leaderboard.loaded:
+            leaderboard.set_user(user.id, user.username, user.cash)
         
         return jsonify({
             "message": "User registered successfully",
@@ -122,8 +182,18 @@ def api_login():
         (User.email == username_or_email) | (User.username == username_or_email)
     ).first()
     
-    if not user or not user.verify_password(password):
+    if not user:
+        return jsonify({"error": "Invalid credentials"}), 401
+    try:
+        valid, upgraded_hash = hasher.verify(user.password_hash, password)
+    except PasswordBusy:
+        return jsonify({"error": PASSWORD_BUSY}), 503
+    if not valid:
         return jsonify({"error": "Invalid credentials"}), 401
+    if upgraded_hash:
+        # Hash parameters changed since this password was stored
+        user.password_hash = upgraded_hash
+        session_db.commit()
     
     # Create JWT token
     access_token = create_access_token(identity = str(user.id))
@@ -156,40 +226,112 @@ def portfolio_to_dict(holding):
         "total_value": float(holding.shares * holding.current_price)
     }
 
+def market_holdings(user_stocks):
+    """
+    Value holdings at market prices fetched in one batched quote call.
+    Holdings without a usable quote fall back to their book price and are
+    flagged stale.
+    """
+    quotes = lookup_many([s.symbol for s in user_stocks], priority=PRIORITY_QUOTE) if user_stocks else {}
+    now = time.time()
+    holdings = []
+    for s in user_stocks:
+        avg_price = float(s.avg_cost or s.price)
+        quote = quotes.get(s.symbol.upper())
+        if quote:
+            current_price = float(quote["price"])
+            as_of = quote.get("as_of", now)
+            source = "market"
+        else:
+            current_price, as_of, source = avg_price, None, "book"
+        age = round(now - as_of, 3) if as_of else None
+
+        market_value = s.quantity * current_price
+        cost_basis = float(s.total_cost) if s.total_cost else s.quantity * avg_price
+        holdings.append({
+            "symbol": s.symbol,
+            "quantity": s.quantity,
+            "shares": s.quantity,
+            "price": current_price,
+            "current_price": current_price,
+            "avg_price": avg_price,
+            "market_value": round(market_value, 2),
+            "cost_basis": round(cost_basis, 2),
+            "unrealized_pnl": round(market_value - cost_basis, 2),
+            "realized_pnl": float(s.realized_pnl or 0),
+            "price_source": source,
+            "price_as_of": datetime.fromtimestamp(as_of, timezone.utc).isoformat() if as_of else None,
+            "price_age": age,
+            "stale": source != "market" or age > QUOTE_CACHE_TTL,
+        })
+    return holdings
+
 @app.route('/api/portfolio', methods=['GET'])
 @jwt_required()
 def get_portfolio():
-    raw_identity = get_jwt_identity()
-    try:
-        user_id = int(raw_identity)
-    except (TypeError, ValueError):
+    """
+    API endpoint for the user's holdings. valuation=market prices them at
+    current quotes with cost basis and unrealized P&L; the default (book)
+    values them at their recorded price.
+    """
+    user_id = current_user_id()
+    if user_id is None:
         return jsonify({"error": "Invalid user identity"}), 401
+
+    market = request.args.get("valuation") == "market"
+    # Market valuation moves with prices, so only book valuation is validated
+    etag = None if market else _user_etag(user_id, "portfolio")
+    if etag:
+        not_modified = _not_modified(etag)
+        if not_modified:
+            return not_modified
     
-    user = session_db.get(User, user_id)
+    cash = current_cash(session_db, user_id)
     
-    if not user:
+    if cash is None:
         return jsonify({"error": "User not found"}), 404
     
     try:
         # Check your database query for the user's stocks
         # Ensure it returns a list of objects with "symbol", "quantity", and "price"
-        user_stocks = session_db.query(Portfolio).filter_by(user_id=user_id).all()
+        positions = session_db.query(Portfolio).filter_by(user_id=user_id).all()
+        user_stocks = [p for p in positions if p.quantity > 0]
+        realized_pnl = float(sum(Decimal(p.realized_pnl or 0) for p in positions))
+
+        if market:
+            holdings = market_holdings(user_stocks)
+            market_value = sum(h["market_value"] for h in holdings)
+            cost_basis = sum(h["cost_basis"] for h in holdings)
+            return jsonify({
+                "valuation": "market",
+                "holdings": holdings,
+                "market_value": round(market_value, 2),
+                "cost_basis": round(cost_basis, 2),
+                "unrealized_pnl": round(market_value - cost_basis, 2),
+                "realized_pnl": realized_pnl,
+                "total_value": float(cash) + market_value,
+                "cash": float(cash)
+            })
         
         holdings = []
         for s in user_stocks:
             holdings.append({
                 "symbol": s.symbol,
                 "quantity": s.quantity,     # <--- Must match React!
-                "price": float(s.price)     # <--- Must match React!
+                "price": float(s.price),    # <--- Must match React!
+                "avg_price": float(s.avg_cost or s.price),
+                "cost_basis": float(s.total_cost or 0),
+                "realized_pnl": float(s.realized_pnl or 0)
             })
         
         total_stock_value = sum(h['quantity'] * h['price'] for h in holdings)
 
-        return jsonify({
+        return _validated(jsonify({
             "holdings": holdings,
-            "total_value": float(user.cash) + total_stock_value,
-            "cash": float(user.cash)
-        })
+            "realized_pnl": realized_pnl,
+            "total_value": float(cash) + total_stock_value,
+            "cash": float(cash)
+        }), etag)
     except Exception as e:
         app.logger.error(f"Error fetching portfolio for user {user_id}: {str(e)}")
         return jsonify({"error": "Failed to fetch portfolio"}), 500
@@ -198,12 +340,10 @@ def get_portfolio():
 @app.route("/api/quote", methods=["POST"])
 @jwt_required()
 def api_quote():
-    raw_identity = get_jwt_identity()
-    try:
-        user_id = int(raw_identity)
-    except (TypeError, ValueError):
-        return jsonify({"error": "Invalid user identity"}), 401
-    
+    unknown = _unknown_caller()
+    if unknown:
+        return unknown
+
     data = request.get_json()
 
     if not data or 'symbol' not in data:
@@ -212,21 +352,38 @@ def api_quote():
 
     symbol = data['symbol'].upper()
     
-    stock_info = lookup(symbol)
+    try:
+        stock_info = lookup(symbol, priority=PRIORITY_QUOTE)
+    except UpstreamThrottled:
+        return jsonify({"error": THROTTLED}), 503
     if not stock_info:
         # Changed message to match exactly what your test expects
         return jsonify({"error": "Invalid symbol"}), 400 
 
-    return jsonify({
+    return jsonify(quote_to_dict(symbol, stock_info)), 200
+
+
+def quote_to_dict(symbol, stock_info):
+    return {
         "name": stock_info.get("name", symbol), 
         "symbol": stock_info["symbol"],
         "price": float(stock_info["price"])
-    }), 200
+    }
+
+
+@app.route("/api/quote-cache/stats", methods=["GET"])
+def api_quote_cache_stats():
+    """API endpoint exposing quote cache, price store and upstream budget counters"""
+    return jsonify(dict(quote_cache.stats(), upstream=scheduler.stats(), store=price_store.stats(),
+                        refresher=refresher.stats())), 200
     
     
 # HELPER FUNCTIONS FOR API ENDPOINTS
 def buy_for_user(user_id, symbol, quantity):
-    stock_info = lookup(symbol)
+    try:
+        stock_info = lookup(symbol, max_age=ORDER_QUOTE_MAX_AGE, priority=PRIORITY_ORDER)
+    except UpstreamThrottled:
+        return THROTTLED
     if stock_info is None:
         return "Invalid symbol"
 
@@ -237,56 +394,13 @@ def buy_for_user(user_id, symbol, quantity):
     except (ValueError, TypeError):
         return "Invalid quantity"
 
-    # Correct user lookup
-    user = session_db.get(User, user_id)
-    if not user:
-        return "User not found"
-
-    # Convert everything to Decimal
-    current_cash = Decimal(user.cash)
-    unit_price = Decimal(str(stock_info["price"]))
-    total_cost = unit_price * quantity
-
-    if total_cost > current_cash:
-        return "Insufficient funds"
-
-    # Deduct cash
-    user.cash = current_cash - Decimal(str(total_cost))
-    # Portfolio logic
-    existing_portfolio = session_db.query(Portfolio).filter_by(
-        user_id=user.id, symbol=symbol
-    ).first()
-
-    if existing_portfolio:
-        existing_portfolio.quantity += quantity
-        existing_portfolio.price = unit_price
-    else:
-        portfolio = Portfolio(
-            user_id=user.id,
-            symbol=symbol,
-            quantity=quantity,
-            price=unit_price
-        )
-        session_db.add(portfolio)
-
-    # Record transaction
-    transaction = Transaction(
-        user_id=user.id,
-        symbol=symbol,
-        quantity=quantity,
-        price=unit_price,
-        transaction_type="BUY"
-    )
-    session_db.add(transaction)
-
-    session_db.commit()
-
-    return "success"
+    # Cash check, position update and ledger row commit atomically
+    return run_trade(session_db, execute_buy, user_id, symbol, quantity, stock_info["price"])
 
 @app.route("/api/buy", methods=["POST"])
 @jwt_required()
 def api_buy():
-    user_id = int(get_jwt_identity())  # IMPORTANT
+    user_id = current_user_id()  # IMPORTANT
     data = request.get_json()
 
     if not data or "symbol" not in data or "quantity" not in data:
@@ -295,13 +409,15 @@ def api_buy():
     result = buy_for_user(user_id, data["symbol"], data["quantity"])
 
     if result == "success":
-        # Fetch the updated user to get the new cash balance
-        user = session_db.get(User, user_id)
-        new_balance = float(user.cash) if user and user.cash is not None else None
+        # Read the new balance straight from the database
+        cash = current_cash(session_db, user_id)
+        new_balance = float(cash) if cash is not None else None
         return jsonify({
             "message": "Purchase successful",
             "new_balance": new_balance
         }), 200
+    elif result == THROTTLED:
+        return jsonify({"error": result}), 503
     else:
         return jsonify({"error": result}), 400
 
@@ -311,7 +427,7 @@ def api_buy():
 @jwt_required()
 def api_sell():
     """API endpoint to sell stocks"""
-    user_id = get_jwt_identity()
+    user_id = current_user_id()
     data = request.get_json()
     
     if not data or 'symbol' not in data or 'quantity' not in data:
@@ -325,64 +441,501 @@ def api_sell():
     
     if result == "success":
         return jsonify({"message": "Stock sold successfully"}), 200
+    elif result == THROTTLED:
+        return jsonify({"error": result}), 503
     else:
         return jsonify({"error": result}), 400
 
+@app.route("/api/history/prices", methods=["GET"])
+@jwt_required()
+def api_price_history():
+    """
+    API endpoint serving daily OHLCV bars from the local price history store.
+    symbol is required; start and end (ISO dates) bound the range. Missing
+    recent days are fetched from upstream at most every few hours per symbol.
+    """
+    symbol = request.args.get("symbol", "").strip().upper()
+    if not symbol:
+        return jsonify({"error": "Missing symbol"}), 400
+    start, end = request.args.get("start"), request.args.get("end")
+    try:
+        for value in (start, end):
+            if value:
+                datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        return jsonify({"error": "start and end must be YYYY-MM-DD dates"}), 400
+
+    price_history.update(symbol)
+    bars = price_history.range(symbol, start, end)
+    if not price_history.bars(symbol).shape[1]:
+        return jsonify({"error": "No price history for symbol"}), 404
+    response = jsonify({"symbol": symbol, "bars": bars_to_dicts(bars)})
+    response.headers["Cache-Control"] = f"private, max-age={PRICE_HISTORY_MAX_AGE}"
+    return response, 200
+
+# Price history for analytics is topped up in the background, never inline
+history_updates = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-updates")
+
+@app.route("/api/analytics", methods=["GET"])
+@jwt_required()
+def api_analytics():
+    """
+    API endpoint for portfolio performance: time-weighted return, volatility,
+    max drawdown, beta against the benchmark, holding correlations and the
+    daily equity curve. Uses locally stored price history; symbols without
+    any are valued at their trade prices until their history is fetched.
+    """
+    user_id = current_user_id()
+    unknown = _unknown_caller()
+    if unknown:
+        return unknown
+    with engine.connect() as conn:
+        result = portfolio_analytics(conn, user_id)
+    if result is None:
+        return jsonify({"error": "No transactions to analyze"}), 404
+    symbols = set(result["missing_price_history"])
+    symbols.update((result["correlation"] or {}).get("symbols", []))
+    for symbol in sorted(symbols | {ANALYTICS_BENCHMARK}):
+        history_updates.submit(price_history.update, symbol)
+    return jsonify(result), 200
+
+def _unknown_caller():
+    """Error response when the JWT doesn't name an existing user, else None."""
+    if current_user_id() is None:
+        return jsonify({"error": "Invalid user identity"}), 401
+    if current_profile(session_db) is None:
+        return jsonify({"error": "User not found"}), 404
+    return None
+
+def _ensure_leaderboard():
+    if not leaderboard.loaded:
+        with engine.connect() as conn:
+            leaderboard.rebuild(conn, _current_price)
+
+def _current_price(symbol):
+    stored = price_store.get(symbol, float("inf"), record=False)
+    return stored["price"] if stored else None
+
+@app.route("/api/leaderboard", methods=["GET"])
+def api_leaderboard():
+    """Public net-worth leaderboard: the top `limit` users (default 10)."""
+    try:
+        limit = min(max(int(request.args.get("limit", 10)), 1), LEADERBOARD_MAX_LIMIT)
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    _ensure_leaderboard()
+    return jsonify({"leaders": leaderboard.top(limit), "total": len(leaderboard)}), 200
+
+@app.route("/api/leaderboard/me", methods=["GET"])
+@jwt_required()
+def api_leaderboard_me():
+    """The caller's leaderboard rank with k neighbours on each side (default 5)."""
+    user_id = current_user_id()
+    unknown = _unknown_caller()
+    if unknown:
+        return unknown
+    try:
+        k = min(max(int(request.args.get("k", 5)), 0), LEADERBOARD_MAX_LIMIT)
+    except ValueError:
+        return jsonify({"error": "k must be an integer"}), 400
+    _ensure_leaderboard()
+    standing = leaderboard.around(user_id, k)
+    if standing is None:
+        return jsonify({"error": "User not ranked"}), 404
+    return jsonify(standing), 200
+
+@app.route("/api/leaderboard/rebuild", methods=["POST"])
+@jwt_required()
+def api_leaderboard_rebuild():
+    """Admin endpoint recomputing the leaderboard from the database"""
+    if not _is_admin(current_user_id()):
+        return jsonify({"error": "Admin access required"}), 403
+    with engine.connect() as conn:
+        ranked = leaderboard.rebuild(conn, _current_price)
+    return jsonify({"ranked": ranked}), 200
+
+@app.route("/api/orders/batch", methods=["POST"])
+@jwt_required()
+def api_orders_batch():
+    """
+    API endpoint executing a list of orders all-or-nothing.
+    Body: {"orders": [{"symbol", "side": "BUY"|"SELL", "quantity"}, ...]}.
+    Prices come from one batched quote lookup and everything commits in one
+    transaction; orders apply in the given order, so sells can fund buys.
+    """
+    user_id = current_user_id()
+    unknown = _unknown_caller()
+    if unknown:
+        return unknown
+    data = request.get_json(silent=True) or {}
+    raw_orders = data.get("orders")
+    if not isinstance(raw_orders, list) or not raw_orders:
+        return jsonify({"error": "orders must be a non-empty list"}), 400
+    if len(raw_orders) > ORDER_BATCH_MAX:
+        return jsonify({"error": f"At most {ORDER_BATCH_MAX} orders per batch"}), 400
+
+    orders = []
+    for raw in raw_orders:
+        try:
+            orders.append(parse_order(raw))
+        except TradeRejected as e:
+            orders.append(e)
+    symbols = sorted({o["symbol"] for o in orders if isinstance(o, dict)})
+
+    cash = session_db.scalar(select(User.cash).where(User.id == user_id))
+    if cash is None:
+        return jsonify({"error": "User not found"}), 404
+    holdings = dict(session_db.execute(
+        select(Portfolio.symbol, Portfolio.quantity)
+        .where(Portfolio.user_id == user_id, Portfolio.symbol.in_(symbols))).all())
+    # Orders may wait as long for budget as a single order would
+    quotes = lookup_many(symbols, max_age=ORDER_QUOTE_MAX_AGE, priority=PRIORITY_ORDER,
+                         deadline=max(QUOTE_BATCH_DEADLINE, PRIORITY_MAX_WAIT[PRIORITY_ORDER]),
+                         mark_unavailable=True) if symbols else {}
+
+    results = plan_orders(orders, quotes, cash, holdings)
+    errors = [r["error"] for r in results if "error" in r]
+    if errors:
+        for r in results:
+            r["status"] = "rejected" if "error" in r else "not_executed"
+        # Only missing prices stood in the way: the client should retry, not fix the batch
+        status = 503 if all(e == THROTTLED for e in errors) else 400
+        return jsonify({"error": "Batch rejected, no orders were executed", "results": results}), status
+
+    outcome = run_trade(session_db, execute_orders, user_id, results)
+    if outcome != "success":
+        return jsonify({"error": outcome, "results": [dict(r, status="not_executed") for r in results]}), 409
+    new_cash = session_db.scalar(select(User.cash).where(User.id == user_id))
+    return jsonify({
+        "results": [dict(r, status="filled") for r in results],
+        "new_balance": float(new_cash),
+    }), 200
+
+@app.route("/api/orders", methods=["POST"])
+@jwt_required()
+def api_place_order():
+    """
+    API endpoint placing a resting order.
+    Body: {"symbol", "side": "BUY"|"SELL", "type": "LIMIT"|"STOP", "quantity", "trigger_price"}.
+    Buy limits and sell stops fire when the price falls to trigger_price,
+    sell limits and buy stops when it rises to it.
+    """
+    user_id = current_user_id()
+    unknown = _unknown_caller()
+    if unknown:
+        return unknown
+    data = request.get_json(silent=True) or {}
+    try:
+        order = parse_order({"symbol": data.get("symbol"), "side": data.get("side"),
+                             "quantity": data.get("quantity")})
+    except TradeRejected as e:
+        return jsonify({"error": str(e)}), 400
+    order_type = str(data.get("type") or "").upper()
+    if order_type not in ORDER_TYPES:
+        return jsonify({"error": "type must be LIMIT or STOP"}), 400
+    try:
+        trigger_price = Decimal(str(data.get("trigger_price")))
+    except (ArithmeticError, ValueError):
+        return jsonify({"error": "Invalid trigger_price"}), 400
+    if not trigger_price.is_finite() or trigger_price <= 0:
+        return jsonify({"error": "Invalid trigger_price"}), 400
+
+    try:
+        stock_info = lookup(order["symbol"])
+    except UpstreamThrottled:
+        return jsonify({"error": THROTTLED}), 503
+    if stock_info is None:
+        return jsonify({"error": "Invalid symbol"}), 400
+
+    pending = PendingOrder(user_id=user_id, symbol=order["symbol"], side=order["side"],
+                           order_type=order_type, quantity=order["quantity"],
+                           trigger_price=trigger_price, status="OPEN")
+    session_db.add(pending)
+    session_db.commit()
+    order_engine.add(pending.id, pending.symbol, pending.side, pending.order_type, trigger_price)
+    # An order that is already marketable fills on the current price
+    on_price_update(pending.symbol, float(stock_info["price"]))
+    return jsonify(order_to_dict(pending)), 201
+
+@app.route("/api/orders", methods=["GET"])
+@jwt_required()
+def api_list_orders():
+    """API endpoint listing the user's resting orders, newest first; status=OPEN filters."""
+    user_id = current_user_id()
+    unknown = _unknown_caller()
+    if unknown:
+        return unknown
+    stmt = select(PendingOrder).where(PendingOrder.user_id == user_id)
+    status = request.args.get("status")
+    if status:
+        stmt = stmt.where(PendingOrder.status == status.upper())
+    orders = session_db.scalars(stmt.order_by(PendingOrder.id.desc()))
+    return jsonify({"orders": [order_to_dict(o) for o in orders]}), 200
+
+@app.route("/api/orders/<int:order_id>", methods=["DELETE"])
+@jwt_required()
+def api_cancel_order(order_id):
+    """API endpoint cancelling one of the user's open orders"""
+    user_id = current_user_id()
+    unknown = _unknown_caller()
+    if unknown:
+        return unknown
+    result = session_db.execute(
+        update(PendingOrder)
+        .where(PendingOrder.id == order_id, PendingOrder.user_id == user_id, PendingOrder.status == "OPEN")
+        .values(status="CANCELLED", closed_at=datetime.now(timezone.utc))
+        .execution_options(synchronize_session=False))
+    session_db.commit()
+    if result.rowcount == 0:
+        return jsonify({"error": "No open order with that id"}), 404
+    order_engine.remove(order_id)
+    return jsonify({"message": "Order cancelled"}), 200
+
+@app.route("/api/alerts", methods=["POST"])
+@jwt_required()
+def api_create_alert():
+    """
+    API endpoint registering a price alert.
+    Body: {"symbol", "threshold", "direction": "ABOVE"|"BELOW"}; without a
+    direction the alert fires when the price crosses threshold from where it is now.
+    """
+    user_id = current_user_id()
+    unknown = _unknown_caller()
+    if unknown:
+        return unknown
+    data = request.get_json(silent=True) or {}
+    symbol = str(data.get("symbol") or "").strip().upper()
+    if not symbol:
+        return jsonify({"error": "Missing symbol"}), 400
+    try:
+        threshold = Decimal(str(data.get("threshold")))
+    except (ArithmeticError, ValueError):
+        return jsonify({"error": "Invalid threshold"}), 400
+    if not threshold.is_finite() or threshold <= 0:
+        return jsonify({"error": "Invalid threshold"}), 400
+    direction = data.get("direction")
+    if direction is not None and str(direction).upper() not in DIRECTIONS:
+        return jsonify({"error": "direction must be ABOVE or BELOW"}), 400
+
+    try:
+        stock_info = lookup(symbol)
+    except UpstreamThrottled:
+        return jsonify({"error": THROTTLED}), 503
+    if stock_info is None:
+        return jsonify({"error": "Invalid symbol"}), 400
+    if direction is None:
+        direction = "ABOVE" if threshold > Decimal(str(stock_info["price"])) else "BELOW"
+
+    alert = PriceAlert(user_id=user_id, symbol=symbol, threshold=threshold,
+                       direction=str(direction).upper(), status="ACTIVE")
+    session_db.add(alert)
+    session_db.commit()
+    alert_index.add(alert.id, alert.symbol, alert.direction, threshold)
+    return jsonify(alert_to_dict(alert)), 201
+
+@app.route("/api/alerts", methods=["GET"])
+@jwt_required()
+def api_list_alerts():
+    """API endpoint listing the user's alerts, newest first; status=ACTIVE filters."""
+    user_id = current_user_id()
+    unknown = _unknown_caller()
+    if unknown:
+        return unknown
+    stmt = select(PriceAlert).where(PriceAlert.user_id == user_id, PriceAlert.status != "DELETED")
+    status = request.args.get("status")
+    if status:
+        stmt = stmt.where(PriceAlert.status == status.upper())
+    alerts = session_db.scalars(stmt.order_by(PriceAlert.id.desc()))
+    return jsonify({"alerts": [alert_to_dict(a) for a in alerts]}), 200
+
+@app.route("/api/alerts/<int:alert_id>", methods=["DELETE"])
+@jwt_required()
+def api_delete_alert(alert_id):
+    """API endpoint deleting one of the user's alerts"""
+    user_id = current_user_id()
+    unknown = _unknown_caller()
+    if unknown:
+        return unknown
+    alert = session_db.scalar(select(PriceAlert).where(
+        PriceAlert.id == alert_id, PriceAlert.user_id == user_id, PriceAlert.status != "DELETED"))
+    if alert is None:
+        return jsonify({"error": "No alert with that id"}), 404
+    if alert.status == "ACTIVE":
+        alert_index.remove(alert.id, alert.symbol, alert.direction, alert.threshold)
+    alert.status = "DELETED"
+    session_db.commit()
+    return jsonify({"message": "Alert deleted"}), 200
+
+@app.route("/api/alerts/notifications", methods=["GET"])
+@jwt_required()
+def api_alert_notifications():
+    """API endpoint for polling: returns alerts fired since the last poll, oldest first."""
+    user_id = current_user_id()
+    unknown = _unknown_caller()
+    if unknown:
+        return unknown
+    fired = session_db.scalars(
+        select(PriceAlert)
+        .where(PriceAlert.user_id == user_id, PriceAlert.status == "TRIGGERED",
+               PriceAlert.delivered_at.is_(None))
+        .order_by(PriceAlert.triggered_at, PriceAlert.id)).all()
+    notifications = [alert_to_dict(a) for a in fired]
+    if fired:
+        session_db.execute(
+            update(PriceAlert).where(PriceAlert.id.in_([a.id for a in fired]))
+            .values(delivered_at=datetime.now(timezone.utc))
+            .execution_options(synchronize_session=False))
+        session_db.commit()
+    return jsonify({"notifications": notifications}), 200
+
 @app.route("/api/history", methods=["GET"])
 @jwt_required()
 def api_history():
-    """API endpoint to get transaction history"""
-    raw_identity = get_jwt_identity()
-    try:
-        user_id = int(raw_identity)
-    except (TypeError, ValueError):
+    """
+    API endpoint to get transaction history, newest first.
+    Optional filters: symbol, type (BUY/SELL), start, end (ISO dates).
+    With limit and/or cursor, returns one page plus next_cursor; with
+    format=ndjson, streams one row per line; otherwise streams the whole
+    history as {"transactions": [...]}.
+    """
+    user_id = current_user_id()
+    if user_id is None:
         return jsonify({"error": "Invalid user identity"}), 401
     
-    # Get all transactions for the user
-    transactions = session_db.query(Transaction).filter_by(user_id=user_id).order_by(Transaction.timestamp.desc()).all()
-    
-    # Convert to JSON-serializable format
-    transaction_list = []
-    for t in transactions:
-        transaction_list.append({
-            "id": t.id,
-            "symbol": t.symbol,
-            "quantity": t.quantity,
-            "price": float(t.price),
-            "transaction_type": t.transaction_type,
-            "timestamp": t.timestamp.isoformat() if t.timestamp else None
-        })
-    
-    return jsonify({"transactions": transaction_list}), 200
+    try:
+        filters = parse_history_args(request.args)
+    except LedgerQueryError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # Each filter/page combination is its own representation
+    etag = _user_etag(user_id, "history", zlib.crc32(request.query_string))
+    if etag is None:
+        return jsonify({"error": "User not found"}), 404
+    not_modified = _not_modified(etag)
+    if not_modified:
+        return not_modified
+
+    if request.args.get("format") == "ndjson":
+        rows = stream_ndjson(history_query(user_id, **filters))
+        return _validated(Response(stream_with_context(rows), mimetype="application/x-ndjson"), etag)
+
+    if "limit" in filters or "after" in filters:
+        transactions, next_cursor = history_page(session_db, user_id, **filters)
+        return _validated(jsonify({"transactions": transactions, "next_cursor": next_cursor}), etag)
+
+    rows = stream_json(history_query(user_id, **filters))
+    return _validated(Response(stream_with_context(rows), mimetype="application/json"), etag)
+
+EXPORT_FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+def _is_admin(user_id):
+    profile = load_profile(session_db, user_id)
+    return bool(profile and profile.is_admin)
+
+@app.route("/api/export/transactions", methods=["GET"])
+@jwt_required()
+def api_export_transactions():
+    """
+    API endpoint streaming the transaction ledger as CSV (default) or NDJSON.
+    Accepts the same symbol/type/start/end filters as /api/history;
+    admins may pass scope=all to export every user's ledger.
+    """
+    user_id = current_user_id()
+    if user_id is None:
+        return jsonify({"error": "Invalid user identity"}), 401
+
+    fmt = request.args.get("format", "csv")
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error": "format must be csv or ndjson"}), 400
+    try:
+        filters = parse_history_args(request.args)
+    except LedgerQueryError as e:
+        return jsonify({"error": str(e)}), 400
+    filters = {k: v for k, v in filters.items() if k in ("symbol", "transaction_type", "start", "end")}
+
+    export_user = user_id
+    if request.args.get("scope") == "all":
+        if not _is_admin(user_id):
+            return jsonify({"error": "Admin access required"}), 403
+        export_user = None
+
+    stmt = export_query(export_user, **filters)
+    rows = stream_csv(stmt) if fmt == "csv" else stream_ndjson(stmt, export_row_to_dict)
+    response = Response(stream_with_context(rows), mimetype=EXPORT_FORMATS[fmt])
+    response.headers["Content-Disposition"] = f"attachment; filename=transactions.{fmt}"
+    return response
+
+@app.route("/api/import/transactions", methods=["POST"])
+@jwt_required()
+def api_import_transactions():
+    """
+    API endpoint bulk-importing historical trades from CSV or NDJSON, sent
+    as a multipart "file" upload or as the raw request body.
+    Columns: symbol, quantity, price, transaction_type, timestamp; admin
+    uploads may add user_id to import on behalf of other users.
+    """
+    user_id = current_user_id()
+    if user_id is None:
+        return jsonify({"error": "Invalid user identity"}), 401
+
+    if request.mimetype.startswith("multipart/"):
+        upload = request.files.get("file")
+        if not upload:
+            return jsonify({"error": "No file provided"}), 400
+        stream, name, mimetype = upload.stream, upload.filename or "", upload.mimetype
+    else:
+        stream, name, mimetype = request.stream, "", request.mimetype
+
+    fmt = request.args.get("format")
+    if not fmt:
+        is_ndjson = mimetype in ("application/x-ndjson", "application/jsonl") or name.endswith((".ndjson", ".jsonl"))
+        fmt = "ndjson" if is_ndjson else "csv"
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error": "format must be csv or ndjson"}), 400
+
+    try:
+        imported, rebuilt = import_transactions(stream, user_id, fmt, allow_user_id=_is_admin(user_id))
+    except LedgerImportError as e:
+        return jsonify({"error": str(e), "details": e.errors}), 400
+
+    return jsonify({"imported": imported, "positions_rebuilt": rebuilt}), 200
 
 @app.route("/api/trending", methods=["GET"])
 def api_trending():
     """API endpoint to get trending stocks (public endpoint)"""
     market_data = get_trending_stocks()
-    return jsonify({"stocks": market_data}), 200
+    response = jsonify({"stocks": market_data})
+    response.headers["Cache-Control"] = f"public, max-age={TRENDING_MAX_AGE}"
+    return response, 200
 
 @app.route("/api/user", methods=["GET"])
 @jwt_required()
 def api_get_user():
     """API endpoint to get current user info"""
-    raw_identity = get_jwt_identity()
-    try:
-        user_id = int(raw_identity)
-    except (TypeError, ValueError):
+    user_id = current_user_id()
+    if user_id is None:
         return jsonify({"error": "Invalid user identity"}), 401
     
-    user = session_db.query(User).get(user_id)
+    etag = _user_etag(user_id, "user")
+    if etag is None:
+        return jsonify({"error": "User not found"}), 404
+    not_modified = _not_modified(etag)
+    if not_modified:
+        return not_modified
+
+    profile = current_profile(session_db)
+    cash = current_cash(session_db, user_id) if profile else None
     
-    if not user:
+    if cash is None:
         return jsonify({"error": "User not found"}), 404
     
-    return jsonify({
-        "id": user.id,
-        "username": user.username,
-        "email": user.email,
-        "full_names": user.full_names,
-        "cash": float(user.cash)
-    }), 200
+    return _validated(jsonify({
+        "id": profile.id,
+        "username": profile.username,
+        "email": profile.email,
+        "full_names": profile.full_names,
+        "cash": float(cash)
+    }), etag)
 
 
 def sell_for_user(user_id, symbol, quantity):
@@ -394,60 +947,123 @@ def sell_for_user(user_id, symbol, quantity):
     except ValueError:
         return "Invalid quantity"
     
-    user = session_db.query(User).get(user_id)
-    if not user:
-        return "User not found"
-    
-    # Check if user owns this stock
-    portfolio_entry = session_db.query(Portfolio).filter_by(user_id=user.id, symbol=symbol).first()
-    
-    if not portfolio_entry:
+    # Skip the quote for users who can't sell; the UPDATE below re-checks atomically
+    held = session_db.scalar(select(Portfolio.quantity).where(
+        Portfolio.user_id == user_id, Portfolio.symbol == symbol))
+    if not held or held <= 0:
         return "You don't own this stock"
-    
-    if portfolio_entry.quantity < quantity:
+    if held < quantity:
         return "Not enough shares"
     
     # Get current stock price
-    stock_info = lookup(symbol)
+    try:
+        stock_info = lookup(symbol, max_age=ORDER_QUOTE_MAX_AGE, priority=PRIORITY_ORDER)
+    except UpstreamThrottled:
+        return THROTTLED
     if stock_info is None:
         return "Invalid symbol"
     
-    # Sell stock
-    total_revenue = Decimal(stock_info["price"]) * Decimal(quantity)
-    user.cash += total_revenue
-    
-    # Update portfolio
-    portfolio_entry.quantity -= quantity
-    if portfolio_entry.quantity == 0:
-        session_db.delete(portfolio_entry)
-    
-    # Record transaction
-    transaction = Transaction(
-        user_id=user.id,
-        symbol=symbol,
-        quantity=quantity,
-        price=stock_info["price"],
-        transaction_type='SELL'
-    )
-    session_db.add(transaction)
-    session_db.commit()
-    
-    return "success"
+    # A closed position keeps its row for realized P&L
+    return run_trade(session_db, execute_sell, user_id, symbol, quantity, stock_info["price"])
+
+MARKET_SNAPSHOT_SYMBOLS = ["AAPL", "TSLA", "MSFT", "IBM", "GOOGL"]
+# 🟢 High-end fallback data to use when API is blocked
+MOCK_PRICES = {
+    "AAPL": 185.92, 
+    "TSLA": 171.05, 
+    "MSFT": 415.50, 
+    "IBM": 190.20, 
+    "GOOGL": 154.30
+}
+MAX_STREAM_SYMBOLS = 50
+
+# Shared in-process price feed behind the SSE stream, fed by the background
+# refresher that keeps the hot set of symbols warm in the price store
+price_feed = PriceFeed()
+refresher = MarketDataRefresher(price_feed)
+refresher.add_source(held_symbols, 30)
+refresher.add_source(lambda: MARKET_SNAPSHOT_SYMBOLS, 60)
+refresher.add_source(price_feed.watched_symbols, PRICE_FEED_INTERVAL)
+refresher.add_source(price_store.recent_symbols, 120)
+
+# Resting orders: every published price is checked against the trigger heaps,
+# and fired orders fill one at a time off the publishing thread
+order_engine = TriggerEngine()
+order_fills = ThreadPoolExecutor(max_workers=1, thread_name_prefix="order-fills")
+refresher.add_source(order_engine.symbols, 30)
+
+def on_price_update(symbol, price):
+    fired = order_engine.on_price(symbol, price)
+    if fired:
+        order_fills.submit(fill_orders, fired, price, engine=order_engine)
+
+price_feed.add_listener(on_price_update)
+
+# Price alerts: fired alerts are marked for delivery off the publishing thread
+alert_index = AlertIndex()
+alert_delivery = ThreadPoolExecutor(max_workers=1, thread_name_prefix="alert-delivery")
+refresher.add_source(alert_index.symbols, 60)
+
+def on_alert_price(symbol, price):
+    fired = alert_index.on_price(symbol, price)
+    if fired:
+        alert_delivery.submit(trigger_alerts, fired, price)
+
+price_feed.add_listener(on_alert_price)
+
+# Leaderboard standings follow committed trades and published prices
+leaderboard = Leaderboard()
+
+def on_trade_committed(user_id, symbol, quantity_delta, cash_delta, price):
+    if leaderboard.loaded and not leaderboard.on_trade(user_id, symbol, quantity_delta, cash_delta, price):
+        with engine.connect() as conn:
+            leaderboard.load_user(conn, user_id)
+
+def on_ledger_imported(user_ids):
+    # Imports rebuild positions without trade events; reload the users they touched
+    if leaderboard.loaded:
+        with engine.connect() as conn:
+            for user_id in user_ids:
+                leaderboard.load_user(conn, user_id)
+
+import_listeners.append(on_ledger_imported)
+
+leaderboard_updates = ThreadPoolExecutor(max_workers=1, thread_name_prefix="leaderboard")
+
+def on_leaderboard_price(symbol, price):
+    if leaderboard.on_price(symbol, price):
+        leaderboard_updates.submit(leaderboard.reprice)
+
+trade_listeners.append(on_trade_committed)
+price_feed.add_listener(on_leaderboard_price)
+
+@app.before_request
+def start_background_tasks():
+    """Load open orders and alerts and start the market data refresher with the first request (not under tests)."""
+    if app.config.get("TESTING"):
+        return
+    if not order_engine.loaded:
+        with engine.connect() as conn:
+            order_engine.load(conn)
+    if not alert_index.loaded:
+        with engine.connect() as conn:
+            alert_index.load_active(conn)
+    if os.getenv("MARKET_REFRESHER", "1") == "1":
+        refresher.start()
+
 @app.route("/api/market-snapshot")
 def get_market_snapshot():
-    symbols = ["AAPL", "TSLA", "MSFT", "IBM", "GOOGL"]
-    # 🟢 High-end fallback data to use when API is blocked
-    mock_data = {
-        "AAPL": 185.92, 
-        "TSLA": 171.05, 
-        "MSFT": 415.50, 
-        "IBM": 190.20, 
-        "GOOGL": 154.30
-    }
+    return jsonify(market_snapshot(lookup_many(MARKET_SNAPSHOT_SYMBOLS)))
+
+
+def market_snapshot(quotes):
+    """Snapshot rows for MARKET_SNAPSHOT_SYMBOLS from quotes, mock prices filling the gaps."""
+    symbols = MARKET_SNAPSHOT_SYMBOLS
+    mock_data = MOCK_PRICES
     market_data = []
 
     for symbol in symbols:
-        stock_info = lookup(symbol)
+        stock_info = quotes.get(symbol)
         
         # Extract numeric price from lookup result (dict or direct value)
         if isinstance(stock_info, dict):
@@ -465,7 +1081,34 @@ def get_market_snapshot():
             "price": price
         })
     
-    return jsonify(market_data)
+    return market_data
+
+@app.route("/api/stream/prices")
+def api_stream_prices():
+    """
+    Server-Sent Events stream of price updates (public endpoint).
+    symbols=AAPL,TSLA selects the symbols (default: the market snapshot);
+    reconnecting clients send Last-Event-ID to replay missed updates.
+    """
+    symbols = [s.strip().upper() for s in request.args.get("symbols", "").split(",") if s.strip()]
+    symbols = symbols or MARKET_SNAPSHOT_SYMBOLS
+    if len(symbols) > MAX_STREAM_SYMBOLS:
+        return jsonify({"error": f"At most {MAX_STREAM_SYMBOLS} symbols per stream"}), 400
+
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_event_id = None
+
+    try:
+        sub = price_feed.subscribe(symbols, last_event_id)
+    except FeedFull:
+        return jsonify({"error": "Too many open price streams, retry later"}), 503
+
+    response = Response(stream_with_context(sse_stream(sub)), mimetype="text/event-stream")
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
 # ============================================
 # END OF REST API ENDPOINTS
 # ============================================
@@ -0,0 +1,145 @@
+"""
+ASGI entry point: uvicorn asgi:application
+
+/api/quote, /api/market-snapshot and /api/trending are answered by
+coroutines on the event loop, so requests waiting on Alpha Vantage don't
+hold a thread each. Every other request (and CORS preflights) goes to the
+Flask app through asgiref's WSGI adapter, which runs it on a thread pool.
+The WSGI app in app.py keeps serving all routes on its own.
+
+Run one worker process (no --workers): resting orders, price alerts and
+the leaderboard are held in process memory and are not shared between
+workers.
+"""
+import asyncio
+import json
+
+from asgiref.wsgi import WsgiToAsgi
+from flask_jwt_extended import decode_token, verify_jwt_in_request
+from flask_jwt_extended.exceptions import JWTExtendedException
+from jwt.exceptions import PyJWTError
+
+from app import (app, CORS_ORIGINS, MARKET_SNAPSHOT_SYMBOLS, TRENDING_MAX_AGE, market_snapshot, quote_to_dict,
+                 start_background_tasks, _unknown_caller)
+from asyncupstream import async_upstream, lookup_async, lookup_many_async
+from helpers import PRIORITY_QUOTE, THROTTLED, UpstreamThrottled, get_trending_stocks
+
+NO_STORE = "no-cache, no-store, must-revalidate"
+MAX_BODY = 64 * 1024
+
+
+class _Request:
+    def __init__(self, scope, body):
+        self.scope = scope
+        self.body = body
+        self.headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+
+
+async def _read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if len(body) > MAX_BODY or not message.get("more_body"):
+            return body
+
+
+async def _send_json(send, request, payload, status=200, cache_control=NO_STORE):
+    body = json.dumps(payload).encode()
+    headers = [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()),
+               (b"cache-control", cache_control.encode())]
+    origin = request.headers.get("origin")
+    if origin in CORS_ORIGINS:
+        headers += [(b"access-control-allow-origin", origin.encode()),
+                    (b"access-control-allow-credentials", b"true"), (b"vary", b"Origin")]
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+def _authenticate(request):
+    """
+    (status, payload) if the request lacks a valid access token or its
+    user is unknown, else None: the same checks as the Flask routes, so it
+    reads the database; run it off the event loop.
+    """
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme != "Bearer" or not token:
+        return 401, {"msg": "Missing Authorization Header"}
+    try:
+        with app.app_context():
+            claims = decode_token(token)
+    except (PyJWTError, JWTExtendedException) as e:
+        return 401, {"msg": str(e) or "Invalid token"}
+    if claims.get("type") != "access":
+        return 401, {"msg": "Only non-refresh tokens are allowed"}
+    # A fresh app context: to_thread copies the caller's contextvars, and g must not carry over
+    with app.app_context(), app.test_request_context(headers={"Authorization": f"Bearer {token}"}):
+        verify_jwt_in_request()
+        unknown = _unknown_caller()
+        if unknown:
+            response, status = unknown
+            return status, response.get_json()
+    return None
+
+
+async def api_quote(request, send):
+    error = await asyncio.to_thread(_authenticate, request)
+    if error:
+        status, payload = error
+        return await _send_json(send, request, payload, status)
+    try:
+        data = json.loads(request.body or b"null")
+    except ValueError:
+        data = None
+    if not isinstance(data, dict) or not isinstance(data.get("symbol"), str):
+        return await _send_json(send, request, {"error": "Invalid symbol"}, 400)
+
+    symbol = data["symbol"].upper()
+    try:
+        stock_info = await lookup_async(symbol, priority=PRIORITY_QUOTE)
+    except UpstreamThrottled:
+        return await _send_json(send, request, {"error": THROTTLED}, 503)
+    if not stock_info:
+        return await _send_json(send, request, {"error": "Invalid symbol"}, 400)
+    await _send_json(send, request, quote_to_dict(symbol, stock_info))
+
+
+async def api_market_snapshot(request, send):
+    quotes = await lookup_many_async(MARKET_SNAPSHOT_SYMBOLS)
+    await _send_json(send, request, market_snapshot(quotes))
+
+
+async def api_trending(request, send):
+    # Normally a disk read; only a cold cache waits on upstream, and then on a thread
+    stocks = await asyncio.to_thread(get_trending_stocks)
+    await _send_json(send, request, {"stocks": stocks}, cache_control=f"public, max-age={TRENDING_MAX_AGE}")
+
+
+ASYNC_ROUTES = {
+    ("POST", "/api/quote"): api_quote,
+    ("GET", "/api/market-snapshot"): api_market_snapshot,
+    ("GET", "/api/trending"): api_trending,
+}
+
+flask_app = WsgiToAsgi(app)
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await asyncio.to_thread(start_background_tasks)
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await async_upstream.aclose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    handler = ASYNC_ROUTES.get((scope.get("method"), scope.get("path"))) if scope["type"] == "http" else None
+    if handler is None:
+        return await flask_app(scope, receive, send)
+    body = await _read_body(receive)
+    if len(body) > MAX_BODY:
+        return await _send_json(send, _Request(scope, b""), {"error": "Request body too large"}, 413)
+    await handler(_Request(scope, body), send)
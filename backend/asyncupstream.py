@@ -0,0 +1,212 @@
+"""
+Asyncio path to Alpha Vantage for the read-only quote endpoints.
+
+Many lookups can wait on upstream concurrently on one event loop instead
+of each holding a worker thread. The async client shares the request
+budget (scheduler), the caches (price store, shared quote table, quote
+cache) and the response parsing with the sync lookup() in helpers, which
+stays the API for everything else.
+"""
+import asyncio
+import random
+import time
+
+import httpx
+
+import helpers
+from helpers import (BASE_URL, UPSTREAM_POOL_SIZE, UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT,
+                     UPSTREAM_MAX_RETRIES, UPSTREAM_BACKOFF, THROTTLE_KEYS, PRIORITY_MAX_WAIT,
+                     PRIORITY_QUOTE, PRIORITY_BACKGROUND, QUOTE_CACHE_TTL, QUOTE_BATCH_DEADLINE,
+                     UpstreamClient, UpstreamThrottled, parse_global_quote, price_store, quote_cache,
+                     scheduler)
+from sharedquotes import SHARED_LEASE_SECONDS
+
+# How often a coroutine waiting for another worker's fetch looks again (seconds)
+ASYNC_POLL_INTERVAL = 0.05
+
+
+class AsyncUpstreamClient:
+    """
+    httpx counterpart of helpers.UpstreamClient: same timeouts, retry policy
+    (no retries on throttling) and throttle detection. The underlying AsyncClient is bound to the
+    event loop it was first used on.
+    """
+
+    RETRY_STATUSES = UpstreamClient.RETRY_STATUSES
+
+    def __init__(self, base_url=BASE_URL, pool_size=UPSTREAM_POOL_SIZE,
+                 connect_timeout=UPSTREAM_CONNECT_TIMEOUT, read_timeout=UPSTREAM_READ_TIMEOUT,
+                 max_retries=UPSTREAM_MAX_RETRIES, backoff=UPSTREAM_BACKOFF):
+        self.base_url = base_url
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._client = None
+
+    def client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=self.timeout, limits=self.limits)
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def get_json(self, params, before_retry=None):
+        """Async UpstreamClient.get_json; before_retry is a coroutine function."""
+        key = UpstreamClient.api_key()
+        if not key:
+            raise ValueError("API_KEY not found in environment")
+        params = dict(params, apikey=key)
+
+        attempt = 0
+        while True:
+            try:
+                response = await self.client().get(self.base_url, params=params)
+                if response.status_code == 429:
+                    raise UpstreamThrottled("HTTP 429 Too Many Requests")
+                if response.status_code in self.RETRY_STATUSES and attempt < self.max_retries:
+                    raise httpx.HTTPStatusError(f"HTTP {response.status_code}",
+                                                request=response.request, response=response)
+                response.raise_for_status()
+                data = response.json()
+                break
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                status = e.response.status_code if isinstance(e, httpx.HTTPStatusError) else None
+                if attempt >= self.max_retries or (status is not None and status not in self.RETRY_STATUSES):
+                    raise
+                await asyncio.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+                if before_retry is not None and not await before_retry():
+                    raise
+                attempt += 1
+
+        if isinstance(data, dict):
+            for note in THROTTLE_KEYS:
+                if note in data:
+                    raise UpstreamThrottled(data[note])
+        return data
+
+
+async_upstream = AsyncUpstreamClient()
+
+
+async def acquire_budget(priority=PRIORITY_QUOTE):
+    """
+    scheduler.acquire without blocking the loop: queue a ticket in priority
+    order, then sleep as long as the scheduler says until it is granted or
+    the priority's max wait runs out.
+    """
+    deadline = time.monotonic() + PRIORITY_MAX_WAIT[priority]
+    ticket = scheduler.enqueue(priority)
+    try:
+        while True:
+            wait = scheduler.try_acquire(ticket)
+            if wait == 0:
+                return True
+            remaining = deadline - time.monotonic()
+            if wait is None or remaining <= 0:
+                return False
+            await asyncio.sleep(min(wait, remaining))
+    finally:
+        scheduler.cancel(ticket)
+
+
+async def call_upstream_async(params, priority=PRIORITY_BACKGROUND):
+    """Async helpers._call_upstream: spend one call of the budget per attempt on Alpha Vantage."""
+    if not UpstreamClient.api_key():
+        raise ValueError("API_KEY not found in environment")
+    if not await acquire_budget(priority):
+        raise UpstreamThrottled("Outbound request budget exhausted")
+    try:
+        return await async_upstream.get_json(params, lambda: acquire_budget(priority))
+    except UpstreamThrottled:
+        scheduler.penalize()
+        raise
+
+
+async def _fetch_quote_async(symbol, priority=PRIORITY_QUOTE):
+    try:
+        data_json = await call_upstream_async({"function": "GLOBAL_QUOTE", "symbol": symbol}, priority)
+    except UpstreamThrottled:
+        print("API Rate Limit Hit!")
+        raise
+    except Exception as e:
+        print(f"Lookup error: {e}")
+        return None
+    return parse_global_quote(symbol, data_json)
+
+
+async def _fetch_shared_async(symbol, priority=PRIORITY_QUOTE):
+    """helpers._fetch_shared for coroutines: one worker process per symbol goes upstream."""
+    store = helpers.shared_quotes
+    if store is None:
+        return await _fetch_quote_async(symbol, priority)
+    requested = time.time()
+    if not store.lease(symbol):
+        deadline = time.monotonic() + SHARED_LEASE_SECONDS
+        while time.monotonic() < deadline:
+            data = store.get(symbol, QUOTE_CACHE_TTL)
+            if data and data["as_of"] > requested:
+                return data
+            await asyncio.sleep(ASYNC_POLL_INTERVAL)
+        return await _fetch_quote_async(symbol, priority)
+    data = None
+    try:
+        data = await _fetch_quote_async(symbol, priority)
+    finally:
+        if data:
+            store.put(symbol, data["price"], data.get("as_of"))
+        else:
+            store.release(symbol)
+    return data
+
+
+_inflight = {}   # (loop, symbol) -> asyncio.Task shared by concurrent callers
+
+
+async def lookup_async(symbol, max_age=None, priority=PRIORITY_QUOTE):
+    """
+    Coroutine version of helpers.lookup with the same cache order and
+    return values. Concurrent misses for a symbol on this loop share one
+    upstream call.
+    """
+    symbol = symbol.upper()
+    store_age = QUOTE_CACHE_TTL if max_age is None else max_age
+    stored = price_store.get(symbol, store_age)
+    if stored:
+        return stored
+    shared = helpers.shared_quotes.get(symbol, store_age) if helpers.shared_quotes else None
+    if shared:
+        price_store.put(symbol, shared["price"], shared["as_of"], record=True)
+        return shared
+    cached = quote_cache.get(symbol, max_age)
+    if cached:
+        return cached
+
+    key = (asyncio.get_running_loop(), symbol)
+    task = _inflight.get(key)
+    if task is None:
+        task = _inflight[key] = asyncio.ensure_future(_fetch_shared_async(symbol, priority))
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    data = await asyncio.shield(task)
+    if data:
+        quote_cache.put(symbol, data)
+        price_store.put(symbol, data["price"], data.get("as_of"), record=True)
+    return data
+
+
+async def lookup_many_async(symbols, max_age=None, deadline=QUOTE_BATCH_DEADLINE, priority=PRIORITY_BACKGROUND):
+    """
+    Coroutine version of helpers.lookup_many: {symbol: quote or None}, with
+    symbols that fail, are throttled or miss the deadline mapped to None.
+    """
+    symbols = list(dict.fromkeys(s.upper() for s in symbols))
+    tasks = {symbol: asyncio.ensure_future(lookup_async(symbol, max_age, priority)) for symbol in symbols}
+    for task in tasks.values():
+        # Late lookups keep running to fill the caches; their errors are expected
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    done, _ = await asyncio.wait(tasks.values(), timeout=deadline)
+    return {symbol: task.result() if task in done and task.exception() is None else None
+            for symbol, task in tasks.items()}
@@ -0,0 +1,102 @@
+"""
+Benchmark the portfolio/transaction indexes on a large ledger.
+
+Builds a throwaway SQLite database with the pre-index schema, prints query
+plans and latencies for the hot queries, applies migrate_db() and repeats.
+
+    python bench_indexes.py --rows 1000000 --users 1000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, insert, select, text
+
+from model import Base, User, Portfolio, Transaction, migrate_db
+
+SYMBOLS = ["AAPL", "TSLA", "MSFT", "IBM", "GOOGL", "AMZN", "NVDA", "META", "NFLX", "AMD",
+           "INTC", "ORCL", "CSCO", "ADBE", "CRM", "PYPL", "UBER", "SHOP", "SQ", "BABA"]
+
+
+def populate(engine, rows, users):
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        # Start from the schema older init_db.py runs created: primary keys only
+        for table in (Portfolio.__table__, Transaction.__table__):
+            for index in table.indexes:
+                index.drop(conn)
+
+        conn.execute(insert(User), [
+            {"id": i, "full_names": f"User {i}", "username": f"user{i}",
+             "email": f"user{i}@example.com", "password_hash": "x", "cash": 10000}
+            for i in range(1, users + 1)
+        ])
+        conn.execute(insert(Portfolio), [
+            {"user_id": u, "symbol": s, "quantity": 10, "price": 100}
+            for u in range(1, users + 1) for s in SYMBOLS
+        ])
+
+        start = datetime(2015, 1, 1)
+        chunk = 50_000
+        for offset in range(0, rows, chunk):
+            conn.execute(insert(Transaction), [
+                {"user_id": random.randint(1, users), "symbol": random.choice(SYMBOLS),
+                 "quantity": random.randint(1, 100), "price": round(random.uniform(10, 500), 2),
+                 "transaction_type": random.choice(("BUY", "SELL")),
+                 "timestamp": start + timedelta(minutes=offset + i)}
+                for i in range(min(chunk, rows - offset))
+            ])
+
+
+def queries(users):
+    user_id = users // 2
+    return {
+        "position lookup": select(Portfolio).where(Portfolio.user_id == user_id, Portfolio.symbol == "MSFT"),
+        "history page": select(Transaction).where(Transaction.user_id == user_id)
+                        .order_by(Transaction.timestamp.desc(), Transaction.id.desc()).limit(50),
+        "full history": select(Transaction).where(Transaction.user_id == user_id)
+                        .order_by(Transaction.timestamp.desc(), Transaction.id.desc()),
+    }
+
+
+def measure(engine, users, repeat=20):
+    with engine.connect() as conn:
+        for name, query in queries(users).items():
+            sql = str(query.compile(engine, compile_kwargs={"literal_binds": True}))
+            plan = conn.execute(text("EXPLAIN QUERY PLAN " + sql)).all()
+            started = time.perf_counter()
+            for _ in range(repeat):
+                conn.execute(query).all()
+            elapsed = (time.perf_counter() - started) / repeat * 1000
+            print(f"  {name:<16} {elapsed:9.3f} ms   plan: {' | '.join(row[-1] for row in plan)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=1000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        started = time.perf_counter()
+        populate(engine, args.rows, args.users)
+        print(f"Loaded {args.rows:,} transactions in {time.perf_counter() - started:.1f}s")
+
+        print("Before migration (primary keys only):")
+        measure(engine, args.users)
+
+        started = time.perf_counter()
+        migrate_db(engine)
+        print(f"migrate_db() took {time.perf_counter() - started:.1f}s")
+
+        print("After migration:")
+        measure(engine, args.users)
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Benchmark the resting-order trigger engine.
+
+Indexes N open orders on a handful of symbols, then replays a random-walk
+price series and reports per-tick evaluation latency. Fired orders are
+replaced with fresh ones so the book stays at N orders throughout.
+
+    python bench_triggers.py --orders 100000 --symbols 10 --ticks 20000
+"""
+import argparse
+import itertools
+import random
+import statistics
+import time
+
+from orders import TriggerEngine, ORDER_TYPES, fires_on_drop
+
+SIDES = ("BUY", "SELL")
+
+
+def random_order(ids, symbol, price):
+    """A resting (not yet marketable) order within 20% of the current price."""
+    side, order_type = random.choice(SIDES), random.choice(ORDER_TYPES)
+    offset = random.uniform(0.0005, 0.2)
+    factor = 1 - offset if fires_on_drop(side, order_type) else 1 + offset
+    return next(ids), symbol, side, order_type, price * factor
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--orders", type=int, default=100_000)
+    parser.add_argument("--symbols", type=int, default=10)
+    parser.add_argument("--ticks", type=int, default=20_000)
+    args = parser.parse_args()
+
+    random.seed(7)
+    symbols = [f"SYM{i}" for i in range(args.symbols)]
+    prices = {symbol: 100.0 for symbol in symbols}
+    ids = itertools.count(1)
+    engine = TriggerEngine()
+
+    started = time.perf_counter()
+    for _ in range(args.orders):
+        symbol = random.choice(symbols)
+        engine.add(*random_order(ids, symbol, prices[symbol]))
+    print(f"Indexed {len(engine)} orders in {time.perf_counter() - started:.2f}s")
+
+    latencies, fired_total = [], 0
+    for _ in range(args.ticks):
+        symbol = random.choice(symbols)
+        prices[symbol] *= random.gauss(1.0, 0.002)
+        started = time.perf_counter()
+        fired = engine.on_price(symbol, prices[symbol])
+        latencies.append(time.perf_counter() - started)
+        fired_total += len(fired)
+        for _ in fired:
+            engine.add(*random_order(ids, symbol, prices[symbol]))
+
+    latencies.sort()
+    us = lambda seconds: f"{seconds * 1e6:.1f}us"
+    print(f"{args.ticks} ticks, {fired_total} orders fired, book size {len(engine)}")
+    print(f"per tick: mean {us(statistics.fmean(latencies))}  "
+          f"p50 {us(latencies[len(latencies) // 2])}  "
+          f"p99 {us(latencies[int(len(latencies) * 0.99)])}  max {us(latencies[-1])}")
+
+
+if __name__ == "__main__":
+    main()
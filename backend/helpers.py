@@ -1,5 +1,19 @@
+import heapq
+import itertools
+import json
 import os
+import random
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, wait
+from datetime import datetime, timezone
+
 import requests
+from requests.adapters import HTTPAdapter
+
+from sharedquotes import open_shared_store, SHARED_LEASE_SECONDS
 
 # Make sure API key is set
 from dotenv import load_dotenv
@@ -9,74 +23,863 @@ api_key = os.getenv("API_KEY")
 # Set the base configuration once at the top
 BASE_URL = "https://www.alphavantage.co/query"
 
-def _make_api_request(params):
+# Upstream HTTP client configuration: pool size, separate connect/read
+# timeouts (seconds) and bounded retry with jittered exponential backoff.
+UPSTREAM_POOL_SIZE = int(os.getenv("UPSTREAM_POOL_SIZE", "16"))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "3.05"))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "10"))
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", "2"))
+UPSTREAM_BACKOFF = float(os.getenv("UPSTREAM_BACKOFF", "0.25"))
+
+# Alpha Vantage answers 200 OK with one of these keys when it throttles us
+THROTTLE_KEYS = ("Note", "Information")
+
+# Outbound request budget enforced on our side before calling Alpha Vantage
+UPSTREAM_CALLS_PER_MINUTE = float(os.getenv("UPSTREAM_CALLS_PER_MINUTE", "5"))
+UPSTREAM_CALLS_PER_DAY = int(os.getenv("UPSTREAM_CALLS_PER_DAY", "500"))
+
+# Upstream call priorities (lower runs first): order execution, interactive
+# quotes, then decorative endpoints such as trending and market snapshot.
+PRIORITY_ORDER = 0
+PRIORITY_QUOTE = 1
+PRIORITY_BACKGROUND = 2
+
+# How long each priority may queue for budget (seconds), and the share of
+# the budget it must leave untouched for higher priorities.
+PRIORITY_MAX_WAIT = {PRIORITY_ORDER: 10.0, PRIORITY_QUOTE: 3.0, PRIORITY_BACKGROUND: 0.0}
+PRIORITY_RESERVE = {PRIORITY_ORDER: 0.0, PRIORITY_QUOTE: 0.2, PRIORITY_BACKGROUND: 0.5}
+
+# Shortest wait the scheduler hands back to a queued caller (seconds)
+SCHEDULER_RECHECK_MIN = 0.01
+
+# Message returned by order execution when no price could be obtained in budget
+THROTTLED = "Market data temporarily unavailable, please retry"
+
+
+class UpstreamThrottled(Exception):
+    """The upstream call was refused because our request budget is used up."""
+
+
+class UpstreamScheduler:
+    """
+    Token-bucket budget for outbound calls with a priority queue.
+    Waiters are served strictly by priority, and lower priorities must
+    leave a reserve of the minute and day budgets for higher ones.
+    """
+
+    def __init__(self, per_minute=UPSTREAM_CALLS_PER_MINUTE, per_day=UPSTREAM_CALLS_PER_DAY):
+        self.capacity = max(1.0, per_minute)
+        self.rate = per_minute / 60.0
+        self.per_day = per_day
+        self.tokens = self.capacity
+        self.day_used = 0
+        self._day = self._today()
+        self._updated = time.monotonic()
+        self._waiters = []  # heap of (priority, seq)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self.granted = {p: 0 for p in PRIORITY_MAX_WAIT}
+        self.throttled = {p: 0 for p in PRIORITY_MAX_WAIT}
+
+    @staticmethod
+    def _today():
+        return datetime.now(timezone.utc).date()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        today = self._today()
+        if today != self._day:
+            self._day = today
+            self.day_used = 0
+
+    def acquire(self, priority=PRIORITY_QUOTE, max_wait=None):
+        """Take one call from the budget; returns False if it can't be granted in time."""
+        if max_wait is None:
+            max_wait = PRIORITY_MAX_WAIT[priority]
+        deadline = time.monotonic() + max_wait
+        ticket = self.enqueue(priority)
+        granted = False
+        try:
+            with self._cond:
+                while True:
+                    wait = self._grant(ticket)
+                    if wait == 0:
+                        granted = True
+                        return True
+                    remaining = deadline - time.monotonic()
+                    if wait is None or remaining <= 0:
+                        return False
+                    self._cond.wait(min(remaining, wait))
+        finally:
+            if not granted:
+                self.cancel(ticket)
+
+    def enqueue(self, priority=PRIORITY_QUOTE):
+        """
+        Queue for one call without blocking. Poll the returned ticket with
+        try_acquire and cancel it when giving up; callers that can't block
+        (coroutines) sleep for the time try_acquire returns in between.
+        """
+        ticket = (priority, next(self._seq))
+        with self._cond:
+            heapq.heappush(self._waiters, ticket)
+        return ticket
+
+    def try_acquire(self, ticket):
+        """
+        Non-blocking grant for a queued ticket: 0 once the call is granted
+        (the ticket leaves the queue), None when today's budget is closed to
+        its priority, else seconds until it is worth asking again.
+        """
+        with self._cond:
+            return self._grant(ticket)
+
+    def cancel(self, ticket):
+        """Leave the queue without a call; a no-op for granted tickets."""
+        with self._cond:
+            if ticket in self._waiters:
+                self._dequeue(ticket)
+                self.throttled[ticket[0]] += 1
+
+    def _grant(self, ticket):
+        priority = ticket[0]
+        reserve = PRIORITY_RESERVE[priority]
+        self._refill()
+        if self.per_day - self.day_used <= reserve * self.per_day:
+            return None
+        spare = self.tokens - reserve * self.capacity
+        ahead = sum(1 for waiter in self._waiters if waiter < ticket)
+        if not ahead and spare >= 1:
+            self.tokens -= 1
+            self.day_used += 1
+            self.granted[priority] += 1
+            self._dequeue(ticket)
+            return 0
+        if self.rate <= 0:
+            return float("inf")
+        # Enough tokens for everyone queued ahead plus this ticket; waiters
+        # ahead that are about to take theirs are rechecked shortly
+        return max((ahead + 1 - spare) / self.rate, SCHEDULER_RECHECK_MIN)
+
+    def _dequeue(self, ticket):
+        self._waiters.remove(ticket)
+        heapq.heapify(self._waiters)
+        self._cond.notify_all()
+
+    def sustainable_rate(self):
+        """Calls per second we can keep up: the bucket rate, capped by what is left of today's budget."""
+        with self._cond:
+            self._refill()
+            now = datetime.now(timezone.utc)
+            midnight = datetime.combine(now.date(), datetime.min.time(), timezone.utc)
+            seconds_left = max(60.0, 86400 - (now - midnight).total_seconds())
+            return min(self.rate, max(0, self.per_day - self.day_used) / seconds_left)
+
+    def penalize(self):
+        """Upstream said we are over the limit: drain the bucket to back off."""
+        with self._cond:
+            self._refill()
+            self.tokens = 0.0
+
+    def stats(self):
+        with self._cond:
+            self._refill()
+            return {
+                "tokens": round(self.tokens, 2),
+                "capacity": self.capacity,
+                "day_used": self.day_used,
+                "day_budget": self.per_day,
+                "queued": len(self._waiters),
+                "granted": dict(self.granted),
+                "throttled": dict(self.throttled),
+            }
+
+
+class UpstreamClient:
+    """
+    Shared keep-alive client for Alpha Vantage.
+    Connections are pooled across threads, transient failures are retried
+    with jittered backoff and throttle responses (HTTP 429 or a throttle
+    note) are detected in one place; they are never retried.
+    """
+
+    RETRY_STATUSES = {500, 502, 503, 504}
+
+    def __init__(self, base_url=BASE_URL, pool_size=UPSTREAM_POOL_SIZE,
+                 connect_timeout=UPSTREAM_CONNECT_TIMEOUT, read_timeout=UPSTREAM_READ_TIMEOUT,
+                 max_retries=UPSTREAM_MAX_RETRIES, backoff=UPSTREAM_BACKOFF):
+        self.base_url = base_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    @staticmethod
+    def api_key():
+        return os.getenv("API_KEY", api_key)
+
+    def get_json(self, params, before_retry=None):
+        """
+        Call the API with params plus the API key and return the decoded JSON.
+        Every retry spends upstream quota too: before_retry(), when given,
+        is called before each one and returning False gives up.
+        Raises UpstreamThrottled on HTTP 429 and throttle notes, and the
+        last requests exception once retries are exhausted.
+        """
+        key = self.api_key()
+        if not key:
+            raise ValueError("API_KEY not found in environment")
+        params = dict(params, apikey=key)
+
+        attempt = 0
+        while True:
+            try:
+                response = self.session.get(self.base_url, params=params, timeout=self.timeout)
+                if response.status_code == 429:
+                    raise UpstreamThrottled("HTTP 429 Too Many Requests")
+                if response.status_code in self.RETRY_STATUSES and attempt < self.max_retries:
+                    raise requests.HTTPError(f"HTTP {response.status_code}", response=response)
+                response.raise_for_status()
+                data = response.json()
+                break
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+                status = e.response.status_code if e.response is not None else None
+                if attempt >= self.max_retries or (status is not None and status not in self.RETRY_STATUSES):
+                    raise
+                time.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+                if before_retry is not None and not before_retry():
+                    raise
+                attempt += 1
+
+        if isinstance(data, dict):
+            for note in THROTTLE_KEYS:
+                if note in data:
+                    raise UpstreamThrottled(data[note])
+        return data
+
+
+upstream = UpstreamClient()
+scheduler = UpstreamScheduler()
+
+
+def _call_upstream(params, priority=PRIORITY_BACKGROUND):
+    """
+    Spend one call of the budget per attempt at the given priority and call
+    Alpha Vantage. Raises UpstreamThrottled when the budget (ours or theirs)
+    is exhausted.
+    """
+    if not upstream.api_key():
+        raise ValueError("API_KEY not found in environment")
+    if not scheduler.acquire(priority):
+        raise UpstreamThrottled("Outbound request budget exhausted")
+    try:
+        return upstream.get_json(params, lambda: scheduler.acquire(priority))
+    except UpstreamThrottled:
+        scheduler.penalize()
+        raise
+
+
+def _make_api_request(params, priority=PRIORITY_BACKGROUND):
     """
     Private helper to handle all Alpha Vantage communication.
     Returns JSON data or None if something goes wrong.
     """
-    if not api_key:
-        print("API_KEY not found in environment")
-        return None
-
-    # Merge the specific function params with the API key
-    params["apikey"] = api_key
-    
     try:
-        response = requests.get(BASE_URL, params=params, timeout=10)
-        response.raise_for_status()
-        return response.json()
+        return _call_upstream(params, priority)
+    except UpstreamThrottled:
+        print("API Rate Limit Hit!")
+        return None
     except Exception as e:
         print(f"API Request Error: {e}")
         return None
-def lookup(symbol):
-    """Look up quote for symbol using Alpha Vantage."""
-    try:
-        api_key = os.getenv("API_KEY")
-        if not api_key:
-            print("Error: API_KEY is missing!")
-            return None # This stops if key is missing
-
-        # ALL THIS CODE MUST BE FLUSH WITH THE 'IF' BLOCK, NOT INSIDE IT
-        url = "https://www.alphavantage.co/query"
-        params = {
-            "function": "GLOBAL_QUOTE", 
-            "symbol": symbol.upper(),
-            "apikey": api_key
-        }
 
-        response = requests.get(url, params=params, timeout=10)
-        response.raise_for_status()
-        
-        data_json = response.json()
-        
-        # Alpha Vantage returns 'Note' when you hit the rate limit
-        if "Note" in data_json:
-            print("API Rate Limit Hit!")
-            return None
 
-        quote = data_json.get("Global Quote")
+# Quote cache configuration (seconds). ORDER_QUOTE_MAX_AGE bounds the price
+# order execution accepts; it defaults to the display TTL and can be set lower.
+QUOTE_CACHE_TTL = float(os.getenv("QUOTE_CACHE_TTL", "15"))
+ORDER_QUOTE_MAX_AGE = float(os.getenv("ORDER_QUOTE_MAX_AGE", "15"))
+QUOTE_CACHE_SIZE = int(os.getenv("QUOTE_CACHE_SIZE", "512"))
+
+# Price store for the hot set kept warm by the background refresher:
+# number of symbol slots, and how quickly a symbol's access heat cools off.
+PRICE_STORE_SIZE = int(os.getenv("PRICE_STORE_SIZE", "4096"))
+PRICE_HEAT_HALF_LIFE = 300.0
+
+# Batch quote configuration: worker pool size, overall deadline (seconds)
+# and whether the premium bulk quote endpoint is available on our plan.
+QUOTE_WORKERS = int(os.getenv("QUOTE_WORKERS", "8"))
+QUOTE_BATCH_DEADLINE = float(os.getenv("QUOTE_BATCH_DEADLINE", "3"))
+BULK_QUOTES_ENABLED = os.getenv("BULK_QUOTES_ENABLED", "0") == "1"
+BULK_QUOTES_MAX = 100
 
-        if not quote or "05. price" not in quote:
+
+class _Flight:
+    """A single upstream fetch that concurrent callers can wait on."""
+
+    def __init__(self, priority):
+        self.priority = priority
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class QuoteCache:
+    """
+    Thread-safe LRU cache of quotes keyed by symbol.
+    Each entry expires ttl seconds after it was fetched (callers may ask
+    for fresher with max_age), and concurrent misses for the same symbol
+    are coalesced into a single upstream call.
+    """
+
+    def __init__(self, maxsize=QUOTE_CACHE_SIZE, ttl=QUOTE_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # symbol -> (data, fetched_at)
+        self._inflight = {}            # symbol -> _Flight
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.coalesced = 0
+
+    def _fresh_entry(self, key, max_age):
+        entry = self._entries.get(key)
+        if entry is None:
             return None
+        if max_age is None:
+            max_age = self.ttl
+        if time.monotonic() - entry[1] > max_age:
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def get(self, symbol, max_age=None):
+        """Return a cached quote no older than max_age, or None."""
+        with self._lock:
+            entry = self._fresh_entry(symbol.upper(), max_age)
+            if entry is None:
+                return None
+            self.hits += 1
+            return entry[0]
+
+    def put(self, symbol, data):
+        key = symbol.upper()
+        with self._lock:
+            self._entries[key] = (data, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_fetch(self, symbol, fetch, max_age=None, priority=PRIORITY_QUOTE):
+        """
+        Return a fresh cached quote, or call fetch(symbol) once on behalf
+        of every concurrent caller asking for the same symbol. priority is
+        the budget priority fetch spends; a caller whose shared fetch was
+        throttled at a lower priority tries again at its own.
+        """
+        key = symbol.upper()
+        with self._lock:
+            entry = self._fresh_entry(key, max_age)
+            if entry:
+                self.hits += 1
+                return entry[0]
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                self.misses += 1
+                flight = self._inflight[key] = _Flight(priority)
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.event.wait()
+            if isinstance(flight.error, UpstreamThrottled) and priority < flight.priority:
+                return self.get_or_fetch(key, fetch, max_age, priority)
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fetch(key)
+            if flight.result is not None:
+                self.put(key, flight.result)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.event.set()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+quote_cache = QuoteCache()
+
+
+class PriceStore:
+    """
+    Compact latest-price table for the hot set of symbols.
+    Each symbol owns one slot in parallel arrays of price, as-of time,
+    access heat and last access. Reads that return a price and writes both
+    count as access; when full, the least recently accessed slot is reused.
+    """
+
+    def __init__(self, capacity=PRICE_STORE_SIZE):
+        self.capacity = capacity
+        self._slots = {}    # symbol -> slot
+        self._symbols = []  # slot -> symbol
+        self._price = array("d")
+        self._as_of = array("d")
+        self._heat = array("d")
+        self._accessed = array("d")
+        self._lock = threading.Lock()
+
+    def _slot(self, symbol):
+        slot = self._slots.get(symbol)
+        if slot is not None:
+            return slot
+        if len(self._symbols) < self.capacity:
+            slot = len(self._symbols)
+            self._symbols.append(symbol)
+            for column in (self._price, self._as_of, self._heat, self._accessed):
+                column.append(0.0)
+        else:
+            slot = min(range(len(self._symbols)), key=self._accessed.__getitem__)
+            del self._slots[self._symbols[slot]]
+            self._symbols[slot] = symbol
+            self._price[slot] = self._as_of[slot] = self._heat[slot] = self._accessed[slot] = 0.0
+        self._slots[symbol] = slot
+        return slot
 
+    def _current_heat(self, slot, now):
+        return self._heat[slot] * 0.5 ** ((now - self._accessed[slot]) / PRICE_HEAT_HALF_LIFE)
+
+    def _touch(self, slot, now, heat):
+        self._heat[slot] = self._current_heat(slot, now) + heat
+        self._accessed[slot] = now
+
+    def get(self, symbol, max_age, record=True):
+        """
+        Return the stored quote if it is at most max_age seconds old.
+        record=True counts a hit towards the symbol's access heat; misses
+        don't, the caller records the access once it has a price (put).
+        """
+        key = symbol.upper()
+        now = time.time()
+        with self._lock:
+            slot = self._slots.get(key)
+            if slot is None:
+                return None
+            as_of = self._as_of[slot]
+            if not as_of or now - as_of > max_age:
+                return None
+            if record:
+                self._touch(slot, now, 1)
+            return {"name": key, "symbol": key, "price": self._price[slot], "as_of": as_of}
+
+    def put(self, symbol, price, as_of=None, record=False):
+        """Store a price; record=True also counts it as a client access to the symbol."""
+        now = time.time()
+        with self._lock:
+            slot = self._slot(symbol.upper())
+            self._price[slot] = price
+            self._as_of[slot] = as_of or now
+            self._touch(slot, now, 1 if record else 0)
+
+    def age(self, symbol):
+        with self._lock:
+            slot = self._slots.get(symbol.upper())
+            if slot is None or not self._as_of[slot]:
+                return float("inf")
+            return time.time() - self._as_of[slot]
+
+    def heat(self, symbol):
+        with self._lock:
+            slot = self._slots.get(symbol.upper())
+            return self._current_heat(slot, time.time()) if slot is not None else 0.0
+
+    def recent_symbols(self, min_heat=0.1):
+        """Symbols clients have asked for recently enough to still be warm."""
+        now = time.time()
+        with self._lock:
+            return {s for s, slot in self._slots.items() if self._current_heat(slot, now) >= min_heat}
+
+    def clear(self):
+        with self._lock:
+            self._slots.clear()
+            self._symbols.clear()
+            for column in (self._price, self._as_of, self._heat, self._accessed):
+                del column[:]
+
+    def stats(self):
+        with self._lock:
+            return {"symbols": len(self._symbols), "capacity": self.capacity}
+
+
+price_store = PriceStore()
+# Host-wide quote table shared by worker processes; None unless SHARED_QUOTES_PATH is set
+shared_quotes = open_shared_store()
+
+
+def _fetch_shared(symbol, priority=PRIORITY_QUOTE):
+    """
+    Fetch a quote upstream with at most one worker process per symbol doing
+    so at a time: the process holding the shared lease fetches and publishes,
+    the others wait for its result.
+    """
+    store = shared_quotes
+    if store is None:
+        return _fetch_quote(symbol, priority)
+    requested = time.time()
+    if not store.lease(symbol):
+        data = store.wait_for(symbol, requested, SHARED_LEASE_SECONDS)
+        if data:
+            return data
+        # The holder failed or died; fetch ourselves rather than fail the request
+        return _fetch_quote(symbol, priority)
+    data = None
+    try:
+        data = _fetch_quote(symbol, priority)
+    finally:
+        if data:
+            store.put(symbol, data["price"], data.get("as_of"))
+        else:
+            store.release(symbol)
+    return data
+
+
+def lookup(symbol, max_age=None, priority=PRIORITY_QUOTE):
+    """
+    Look up quote for symbol. Prices kept warm by the background refresher
+    are served from the price store, then the quote table shared with the
+    other worker processes, and only cold symbols go upstream.
+    max_age (seconds) tightens the allowed staleness, e.g. ORDER_QUOTE_MAX_AGE
+    for order execution; by default QUOTE_CACHE_TTL applies.
+    Returns None for unknown symbols and raises UpstreamThrottled when
+    no upstream call could be made within the budget for this priority.
+    """
+    store_age = QUOTE_CACHE_TTL if max_age is None else max_age
+    stored = price_store.get(symbol, store_age)
+    if stored:
+        return stored
+    shared = shared_quotes.get(symbol, store_age) if shared_quotes else None
+    if shared:
+        price_store.put(symbol, shared["price"], shared["as_of"], record=True)
+        return shared
+    data = quote_cache.get_or_fetch(symbol, lambda s: _fetch_shared(s, priority), max_age, priority)
+    if data:
+        price_store.put(symbol, data["price"], data.get("as_of"), record=True)
+    return data
+
+
+_quote_pool = ThreadPoolExecutor(max_workers=QUOTE_WORKERS, thread_name_prefix="quote")
+
+
+# lookup_many(..., mark_unavailable=True) maps symbols it couldn't price in
+# time (throttled, failed or past the deadline) to this instead of None
+QUOTE_UNAVAILABLE = object()
+
+
+def lookup_many(symbols, max_age=None, deadline=QUOTE_BATCH_DEADLINE, priority=PRIORITY_BACKGROUND,
+                mark_unavailable=False):
+    """
+    Look up quotes for several symbols at once.
+    Fresh cached quotes are returned directly; the rest are fetched with the
+    bulk endpoint when enabled, otherwise in parallel on the quote pool.
+    Returns {symbol: quote or None}; symbols that are throttled or still
+    pending when the deadline expires map to None (pending fetches keep
+    running and fill the cache), or to QUOTE_UNAVAILABLE with
+    mark_unavailable so callers can tell them from unknown symbols.
+    A bulk call that misses the deadline is not repeated symbol by symbol.
+    """
+    started = time.monotonic()
+    symbols = list(dict.fromkeys(s.upper() for s in symbols))
+    store_age = QUOTE_CACHE_TTL if max_age is None else max_age
+    results = {symbol: price_store.get(symbol, store_age) or quote_cache.get(symbol, max_age)
+               for symbol in symbols}
+    missing = [symbol for symbol in symbols if results[symbol] is None]
+    if missing and shared_quotes:
+        for symbol in missing:
+            shared = shared_quotes.get(symbol, store_age)
+            if shared:
+                price_store.put(symbol, shared["price"], shared["as_of"], record=True)
+                results[symbol] = shared
+        missing = [symbol for symbol in missing if results[symbol] is None]
+
+    if missing and BULK_QUOTES_ENABLED:
+        future = _quote_pool.submit(_fetch_bulk_quotes, missing, priority, True)
+        try:
+            bulk = future.result(timeout=deadline)
+        except TimeoutError:
+            # Still running, and it caches what it gets; fetching the symbols
+            # again one by one would spend their budget twice
+            bulk = None
+        except Exception as e:
+            print(f"Bulk quote error: {e}")
+            bulk = {}
+        if bulk is None:
+            if mark_unavailable:
+                results.update((symbol, QUOTE_UNAVAILABLE) for symbol in missing)
+            missing = []
+        else:
+            results.update(bulk)
+            missing = [symbol for symbol in missing if results[symbol] is None]
+
+    if missing:
+        futures = {_quote_pool.submit(lookup, symbol, max_age, priority): symbol for symbol in missing}
+        remaining = max(0.0, deadline - (time.monotonic() - started))
+        done, _ = wait(futures, timeout=remaining)
+        for future, symbol in futures.items():
+            if future in done and future.exception() is None:
+                results[symbol] = future.result()
+            elif mark_unavailable:
+                results[symbol] = QUOTE_UNAVAILABLE
+
+    return results
+
+
+def refresh_quotes(symbols, priority=PRIORITY_BACKGROUND, deadline=QUOTE_BATCH_DEADLINE, max_age=0):
+    """
+    Fetch fresh quotes for symbols into the quote cache and price store
+    without counting as client accesses. Used by the background refresher.
+    Quotes another worker process published within max_age seconds are
+    adopted instead of fetched again.
+    Returns {symbol: quote} for the symbols that were refreshed.
+    """
+    symbols = list(dict.fromkeys(s.upper() for s in symbols))
+    refreshed = {}
+    if shared_quotes and max_age:
+        for symbol in symbols:
+            shared = shared_quotes.get(symbol, max_age)
+            if shared:
+                quote_cache.put(symbol, shared)
+                refreshed[symbol] = shared
+    if BULK_QUOTES_ENABLED:
+        refreshed.update(_fetch_bulk_quotes([s for s in symbols if s not in refreshed], priority))
+
+    fetch = lambda s: _fetch_shared(s, priority)
+    futures = {_quote_pool.submit(quote_cache.get_or_fetch, symbol, fetch, 0, priority): symbol
+               for symbol in symbols if symbol not in refreshed}
+    done, _ = wait(futures, timeout=deadline)
+    for future in done:
+        if future.exception() is None and future.result():
+            refreshed[futures[future]] = future.result()
+
+    for symbol, data in refreshed.items():
+        price_store.put(symbol, data["price"], data.get("as_of"))
+    return refreshed
+
+
+def _fetch_bulk_quotes(symbols, priority=PRIORITY_BACKGROUND, record=False):
+    """
+    Fetch quotes for up to BULK_QUOTES_MAX symbols per upstream call and
+    store them in the quote cache, price store and shared table, so results
+    that arrive after a caller stopped waiting are kept. record=True counts
+    them as client accesses.
+    """
+    quotes = {}
+    for i in range(0, len(symbols), BULK_QUOTES_MAX):
+        chunk = symbols[i:i + BULK_QUOTES_MAX]
+        data = _make_api_request({"function": "REALTIME_BULK_QUOTES", "symbol": ",".join(chunk)}, priority)
+        if not data:
+            continue
+        for item in data.get("data", []):
+            try:
+                symbol = item["symbol"].upper()
+                price = float(item["close"])
+            except (KeyError, TypeError, ValueError):
+                continue
+            if symbol not in chunk:
+                continue
+            quote = quotes[symbol] = {"name": symbol, "symbol": symbol, "price": price, "as_of": time.time()}
+            quote_cache.put(symbol, quote)
+            price_store.put(symbol, price, quote["as_of"], record=record)
+            if shared_quotes:
+                shared_quotes.put(symbol, price, quote["as_of"])
+    return quotes
+
+
+def _fetch_quote(symbol, priority=PRIORITY_QUOTE):
+    """Fetch a quote for symbol straight from Alpha Vantage."""
+    try:
+        data_json = _call_upstream({"function": "GLOBAL_QUOTE", "symbol": symbol.upper()}, priority)
+    except UpstreamThrottled:
+        print("API Rate Limit Hit!")
+        raise
+    except Exception as e:
+        print(f"Lookup error: {e}")
+        return None
+    return parse_global_quote(symbol, data_json)
+
+
+def parse_global_quote(symbol, data_json):
+    """GLOBAL_QUOTE response -> quote dict, or None if it holds no price."""
+    if not data_json:
+        return None
+
+    quote = data_json.get("Global Quote")
+    if not quote or "05. price" not in quote:
+        return None
+
+    try:
         data = {
             "name": symbol.upper(),
             "symbol": quote["01. symbol"],
-            "price": float(quote["05. price"])
+            "price": float(quote["05. price"]),
+            "as_of": time.time()
         }
-
-        print(f"Successfully fetched: {data}")
-        return data
-    
-    except Exception as e:
+    except (KeyError, TypeError, ValueError) as e:
         print(f"Lookup error: {e}")
         return None
 
-def get_trending_stocks():
-    """Specific logic for market gainers/losers."""
+    print(f"Successfully fetched: {data}")
+    return data
+
+# Market-wide datasets (e.g. trending) change a few times a day: serve them
+# from a disk-backed cache, revalidated in the background after ttl seconds;
+# after a failed refresh, wait this long before asking upstream again.
+DATASET_CACHE_DIR = os.getenv("DATASET_CACHE_DIR", os.path.join(os.path.dirname(__file__), ".dataset_cache"))
+DATASET_RETRY_AFTER = float(os.getenv("DATASET_RETRY_AFTER", "300"))
+DATASET_LOCK_TIMEOUT = 60
+TRENDING_TTL = float(os.getenv("TRENDING_TTL", "3600"))
+
+
+class DatasetCache:
+    """
+    Stale-while-revalidate cache persisted as one JSON file per dataset, so
+    it survives restarts and is shared by worker processes. Stale data is
+    returned at once while a single refresh (one per name across processes,
+    claimed with a lock file) runs in the background; failed refreshes keep
+    the last good payload.
+    """
+
+    def __init__(self, root=DATASET_CACHE_DIR):
+        self.root = root
+        self._records = {}      # name -> (mtime_ns, record)
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def _path(self, name, suffix=".json"):
+        return os.path.join(self.root, name + suffix)
+
+    def _read(self, name):
+        path = self._path(name)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            cached = self._records.get(name)
+            if cached and cached[0] == mtime:
+                return cached[1]
+            with open(path) as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        self._records[name] = (mtime, record)
+        return record
+
+    def _write(self, name, record):
+        os.makedirs(self.root, exist_ok=True)
+        path = self._path(name)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(record, f)
+        os.replace(tmp, path)
+
+    def _claim(self, name):
+        """Take the cross-process refresh lock for name; False if someone holds it."""
+        lock = self._path(name, ".lock")
+        os.makedirs(self.root, exist_ok=True)
+        for _ in range(2):
+            try:
+                os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return True
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(lock) < DATASET_LOCK_TIMEOUT:
+                        return False
+                    os.remove(lock)  # left behind by a crashed refresh
+                except OSError:
+                    pass
+        return False
+
+    def _refresh(self, name, fetch):
+        try:
+            try:
+                data = fetch()
+            except Exception as e:
+                print(f"Dataset refresh error ({name}): {e}")
+                data = None
+            now = time.time()
+            record = dict(self._read(name) or {}, checked_at=now)
+            if data:
+                record.update(data=data, fetched_at=now)
+            self._write(name, record)
+            return record
+        finally:
+            try:
+                os.remove(self._path(name, ".lock"))
+            except OSError:
+                pass
+            with self._lock:
+                self._refreshing.discard(name)
+
+    def get(self, name, fetch, ttl):
+        """
+        Return the cached payload for name, refreshing it with fetch() (which
+        returns a falsy value on failure) when older than ttl seconds.
+        Returns None only if no good payload has ever been fetched.
+        """
+        record = self._read(name)
+        now = time.time()
+        if record is not None:
+            fetched_at, checked_at = record.get("fetched_at", 0), record.get("checked_at", 0)
+            fresh = now - fetched_at < ttl
+            failed_recently = checked_at > fetched_at and now - checked_at < DATASET_RETRY_AFTER
+            if fresh or failed_recently:
+                return record.get("data")
+
+        with self._lock:
+            claimed = name not in self._refreshing and self._claim(name)
+            if claimed:
+                self._refreshing.add(name)
+        if not claimed:
+            return record.get("data") if record else None
+        if record and record.get("data"):
+            threading.Thread(target=self._refresh, args=(name, fetch), daemon=True,
+                             name=f"dataset-refresh-{name}").start()
+            return record["data"]
+        return self._refresh(name, fetch).get("data")
+
+
+dataset_cache = DatasetCache()
+
+
+def _fetch_trending():
     data = _make_api_request({"function": "TOP_GAINERS_LOSERS"})
-    if not data:
-        return []
+    if not data or not (data.get("top_gainers") or data.get("top_losers")):
+        return None
 
     # Just combine gainers/losers and return
     combined = data.get("top_gainers", [])[:5] + data.get("top_losers", [])[:5]
@@ -84,4 +887,9 @@ def get_trending_stocks():
         "symbol": i.get("ticker"),
         "price": float(i.get("price", 0)),
         "change": i.get("change_percentage", "0%")
-    } for i in combined]
\ No newline at end of file
+    } for i in combined]
+
+
+def get_trending_stocks():
+    """Market gainers/losers, served from the shared dataset cache."""
+    return dataset_cache.get("trending", _fetch_trending, TRENDING_TTL) or []
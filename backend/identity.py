@@ -0,0 +1,116 @@
+"""
+Who is calling: the JWT identity resolved once per request (on flask.g),
+backed by a small cross-request cache of profile fields that don't change
+with trading (username, email, names, admin flag). Cash is deliberately not
+cached; read it with current_cash() where balances matter.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from flask import g
+from flask_jwt_extended import get_jwt_identity
+from sqlalchemy import event, select
+
+from model import User
+
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "4096"))
+PROFILE_CACHE_TTL = float(os.getenv("PROFILE_CACHE_TTL", "300"))
+
+Profile = namedtuple("Profile", "id username email full_names is_admin")
+
+
+class ProfileCache:
+    """Bounded LRU of Profile tuples; entries expire after PROFILE_CACHE_TTL."""
+
+    def __init__(self, maxsize=PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # user_id -> (loaded_at, profile)
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, profile):
+        with self._lock:
+            self._entries[profile.id] = (time.monotonic(), profile)
+            self._entries.move_to_end(profile.id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+profile_cache = ProfileCache()
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _invalidate_on_write(mapper, connection, target):
+    profile_cache.invalidate(target.id)
+
+
+def load_profile(session, user_id):
+    """The user's Profile from the cache or the database; None if there is no such user."""
+    profile = profile_cache.get(user_id)
+    if profile is None:
+        row = session.execute(
+            select(User.id, User.username, User.email, User.full_names, User.is_admin)
+            .where(User.id == user_id)).one_or_none()
+        if row is None:
+            return None
+        profile = Profile(row.id, row.username, row.email, row.full_names, bool(row.is_admin))
+        profile_cache.put(profile)
+    return profile
+
+
+def init_app(app):
+    """Forget the previous caller at the start of each request (g can outlive one)."""
+    @app.before_request
+    def reset_identity():
+        g.pop("user_id", None)
+        g.pop("profile", None)
+
+
+def current_user_id():
+    """The caller's user id from the JWT, parsed once per request; None if malformed."""
+    if "user_id" not in g:
+        try:
+            g.user_id = int(get_jwt_identity())
+        except (TypeError, ValueError):
+            g.user_id = None
+    return g.user_id
+
+
+def current_profile(session):
+    """The caller's Profile, loaded at most once per request; None if unknown."""
+    if "profile" not in g:
+        user_id = current_user_id()
+        g.profile = load_profile(session, user_id) if user_id is not None else None
+    return g.profile
+
+
+def current_cash(session, user_id):
+    """Authoritative cash balance, always read from the database."""
+    return session.scalar(select(User.cash).where(User.id == user_id))
@@ -1,8 +1,14 @@
-from model import Base, engine
+from model import engine, migrate_db
+from positions import rebuild_positions
 
 # This line is the "Table Builder"
 # It looks at your User, Address, Portfolio, and Transaction classes and builds them in MariaDB
+# Running it again on an existing database adds any missing columns and indexes
 print("Building tables...")
-Base.metadata.create_all(bind=engine)
+added = migrate_db()
+if "portfolio.avg_cost" in added:
+    # Backfill cost basis and realized P&L for positions created before they were tracked
+    with engine.begin() as conn:
+        rebuild_positions(conn)
+    print("Rebuilt portfolio positions from the transaction ledger")
 print("Tables 'user', 'address', 'portfolio', and 'transactions' are now live in finance_app!")
-
@@ -0,0 +1,281 @@
+"""
+Net-worth leaderboard kept up to date incrementally.
+
+Users are ranked by cash plus holdings marked at the latest known price.
+Standings live in an indexable skiplist keyed by (-net_worth, user_id), so
+inserts, removals, "rank of user" and "entry at rank r" are all O(log n).
+Committed trades adjust one user's entry; price updates mark the symbol
+and a periodic reprice() re-ranks only the users holding marked symbols.
+rebuild() recomputes everything from the database for recovery.
+
+Standings are per process and follow only the trades this process
+commits, so the app must run as a single worker process; otherwise each
+worker ranks from its own partial view until an admin rebuild.
+"""
+import os
+import random
+import threading
+import time
+from decimal import Decimal
+
+from sqlalchemy import select, func
+
+from model import User, Portfolio, Transaction
+
+LEADERBOARD_MAX_LIMIT = 100
+SKIPLIST_MAX_LEVELS = 32
+# Price moves re-rank holders at most this often, in chunks so queries
+# aren't blocked behind a widely held symbol
+LEADERBOARD_REPRICE_INTERVAL = float(os.getenv("LEADERBOARD_REPRICE_INTERVAL", "10"))
+REPRICE_CHUNK = 1000
+
+
+class _Node:
+    __slots__ = ("key", "next", "width")
+
+    def __init__(self, key, levels):
+        self.key = key
+        self.next = [None] * levels
+        self.width = [1] * levels   # level-0 steps to next[level]
+
+
+class IndexableSkipList:
+    """Sorted unique keys with O(log n) insert, remove, rank and index lookups."""
+
+    def __init__(self, max_levels=SKIPLIST_MAX_LEVELS):
+        self.max_levels = max_levels
+        self.head = _Node(None, max_levels)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def _levels(self):
+        levels = 1
+        while levels < self.max_levels and random.random() < 0.5:
+            levels += 1
+        return levels
+
+    def insert(self, key):
+        chain = [None] * self.max_levels
+        steps_at_level = [0] * self.max_levels
+        node = self.head
+        for level in reversed(range(self.max_levels)):
+            while node.next[level] is not None and node.next[level].key < key:
+                steps_at_level[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+
+        levels = self._levels()
+        new = _Node(key, levels)
+        steps = 0
+        for level in range(levels):
+            prev = chain[level]
+            new.next[level] = prev.next[level]
+            prev.next[level] = new
+            new.width[level] = prev.width[level] - steps
+            prev.width[level] = steps + 1
+            steps += steps_at_level[level]
+        for level in range(levels, self.max_levels):
+            chain[level].width[level] += 1
+        self.size += 1
+
+    def remove(self, key):
+        chain = [None] * self.max_levels
+        node = self.head
+        for level in reversed(range(self.max_levels)):
+            while node.next[level] is not None and node.next[level].key < key:
+                node = node.next[level]
+            chain[level] = node
+        target = chain[0].next[0]
+        if target is None or target.key != key:
+            raise KeyError(key)
+        for level in range(len(target.next)):
+            prev = chain[level]
+            prev.width[level] += target.width[level] - 1
+            prev.next[level] = target.next[level]
+        for level in range(len(target.next), self.max_levels):
+            chain[level].width[level] -= 1
+        self.size -= 1
+
+    def rank(self, key):
+        """Number of keys smaller than key (key's 0-based index when present)."""
+        rank = 0
+        node = self.head
+        for level in reversed(range(self.max_levels)):
+            while node.next[level] is not None and node.next[level].key < key:
+                rank += node.width[level]
+                node = node.next[level]
+        return rank
+
+    def slice(self, start, stop):
+        """Keys at 0-based positions start..stop-1."""
+        start, stop = max(0, start), min(stop, self.size)
+        if start >= stop:
+            return []
+        node = self.head
+        remaining = start + 1
+        for level in reversed(range(self.max_levels)):
+            while node.width[level] <= remaining:
+                remaining -= node.width[level]
+                node = node.next[level]
+        keys = []
+        while node is not None and len(keys) < stop - start:
+            keys.append(node.key)
+            node = node.next[0]
+        return keys
+
+
+class Leaderboard:
+    """Ranked net worth per user, maintained from trades and price updates."""
+
+    def __init__(self):
+        self._ranking = IndexableSkipList()
+        self._keys = {}       # user_id -> (-net_worth, user_id)
+        self._users = {}      # user_id -> [username, cash, {symbol: quantity}]
+        self._holders = {}    # symbol -> {user_id}
+        self._marks = {}      # symbol -> price
+        self._moved = set()   # symbols re-marked since the last reprice
+        self._repriced = -float("inf")
+        self._lock = threading.RLock()
+        self.loaded = False
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _net_worth(self, user_id):
+        _, cash, holdings = self._users[user_id]
+        return cash + sum(quantity * self._marks.get(symbol, 0.0) for symbol, quantity in holdings.items())
+
+    def _rerank(self, user_id):
+        old = self._keys.get(user_id)
+        if old is not None:
+            self._ranking.remove(old)
+        key = (-round(self._net_worth(user_id), 2), user_id)
+        self._ranking.insert(key)
+        self._keys[user_id] = key
+
+    def set_user(self, user_id, username, cash, holdings=None):
+        """Add or replace a user's standing."""
+        with self._lock:
+            previous = self._users.get(user_id)
+            for symbol in (previous[2] if previous else ()):
+                self._holders.get(symbol, set()).discard(user_id)
+            holdings = {s: float(q) for s, q in (holdings or {}).items() if q}
+            self._users[user_id] = [username, float(cash), holdings]
+            for symbol in holdings:
+                self._holders.setdefault(symbol, set()).add(user_id)
+            self._rerank(user_id)
+
+    def on_trade(self, user_id, symbol, quantity_delta, cash_delta, price):
+        """Apply a committed trade; returns False if the user isn't on the board yet."""
+        with self._lock:
+            user = self._users.get(user_id)
+            if user is None:
+                return False
+            user[1] += float(cash_delta)
+            quantity = user[2].get(symbol, 0.0) + quantity_delta
+            if quantity:
+                user[2][symbol] = quantity
+                self._holders.setdefault(symbol, set()).add(user_id)
+            else:
+                user[2].pop(symbol, None)
+                self._holders.get(symbol, set()).discard(user_id)
+            self._marks.setdefault(symbol, float(price))
+            self._rerank(user_id)
+            return True
+
+    def on_price(self, symbol, price):
+        """Record a new price for symbol; returns True when a reprice() is due."""
+        with self._lock:
+            self._marks[symbol] = float(price)
+            if symbol in self._holders:
+                self._moved.add(symbol)
+            return bool(self._moved) and time.monotonic() - self._repriced >= LEADERBOARD_REPRICE_INTERVAL
+
+    def reprice(self):
+        """Re-rank the holders of every symbol whose price moved; returns how many."""
+        with self._lock:
+            self._repriced = time.monotonic()
+            moved, self._moved = self._moved, set()
+            users = list(set().union(*(self._holders.get(symbol, ()) for symbol in moved)))
+        for start in range(0, len(users), REPRICE_CHUNK):
+            with self._lock:
+                for user_id in users[start:start + REPRICE_CHUNK]:
+                    if user_id in self._users:
+                        self._rerank(user_id)
+        return len(users)
+
+    def _entry(self, position, key):
+        username = self._users[key[1]][0]
+        return {"rank": position + 1, "username": username, "net_worth": -key[0]}
+
+    def top(self, n):
+        with self._lock:
+            return [self._entry(i, key) for i, key in enumerate(self._ranking.slice(0, n))]
+
+    def around(self, user_id, k):
+        """The user's rank with up to k neighbours on each side, or None if unranked."""
+        with self._lock:
+            key = self._keys.get(user_id)
+            if key is None:
+                return None
+            position = self._ranking.rank(key)
+            start = max(0, position - k)
+            keys = self._ranking.slice(start, position + k + 1)
+            entries = [self._entry(start + i, entry_key) for i, entry_key in enumerate(keys)]
+            return {"rank": position + 1, "total": len(self._ranking), "entries": entries}
+
+    def load_user(self, conn, user_id):
+        """(Re)load one user from the database; symbols without a mark get their latest traded price."""
+        user = conn.execute(select(User.id, User.username, User.cash).where(User.id == user_id)).one_or_none()
+        if user is None:
+            return
+        holdings = dict(conn.execute(select(Portfolio.symbol, Portfolio.quantity)
+                                     .where(Portfolio.user_id == user_id, Portfolio.quantity > 0)).all())
+        with self._lock:
+            unmarked = [symbol for symbol in holdings if symbol not in self._marks]
+        if unmarked:
+            for symbol, price in _last_trade_prices(conn, unmarked).items():
+                with self._lock:
+                    self._marks.setdefault(symbol, price)
+        self.set_user(user.id, user.username, user.cash, holdings)
+
+    def rebuild(self, conn, price_of=None):
+        """
+        Recompute every standing from users, positions and prices.
+        price_of(symbol) supplies current prices where known; other symbols
+        are marked at their latest traded price. Returns the number of ranked users.
+        """
+        prices = _last_trade_prices(conn)
+        for symbol in list(prices):
+            current = price_of(symbol) if price_of else None
+            if current:
+                prices[symbol] = float(current)
+        holdings = {}
+        for user_id, symbol, quantity in conn.execute(
+                select(Portfolio.user_id, Portfolio.symbol, Portfolio.quantity).where(Portfolio.quantity > 0)):
+            holdings.setdefault(user_id, {})[symbol] = quantity
+        users = conn.execute(select(User.id, User.username, User.cash)).all()
+
+        with self._lock:
+            self._ranking = IndexableSkipList()
+            self._keys.clear()
+            self._users.clear()
+            self._holders.clear()
+            self._moved.clear()
+            self._marks = prices
+            for user in users:
+                self.set_user(user.id, user.username, user.cash or Decimal(0), holdings.get(user.id))
+            self.loaded = True
+            return len(self._keys)
+
+
+def _last_trade_prices(conn, symbols=None):
+    """{symbol: price of its latest transaction}, for all symbols or the given ones."""
+    last_trade = select(func.max(Transaction.id)).group_by(Transaction.symbol)
+    if symbols is not None:
+        last_trade = last_trade.where(Transaction.symbol.in_(symbols))
+    rows = conn.execute(select(Transaction.symbol, Transaction.price)
+                        .where(Transaction.id.in_(last_trade.scalar_subquery())))
+    return {symbol: float(price) for symbol, price in rows}
@@ -0,0 +1,338 @@
+"""
+Transaction ledger queries: keyset pagination, streaming export and bulk import.
+Rows are read as plain tuples from a server-side cursor, never as ORM
+entities, so memory stays flat however long a user's history is.
+"""
+import base64
+import csv
+import io
+import json
+from array import array
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+
+from sqlalchemy import select, insert, update, delete, and_, or_
+
+from model import engine, User, Transaction
+from positions import rebuild_positions
+
+HISTORY_DEFAULT_LIMIT = 50
+HISTORY_MAX_LIMIT = 500
+STREAM_BATCH_SIZE = 1000
+TRANSACTION_TYPES = ("BUY", "SELL")
+
+EXPORT_FIELDS = ("id", "user_id", "symbol", "quantity", "price", "transaction_type", "timestamp")
+IMPORT_COLUMNS = ("user_id", "symbol", "quantity", "price", "transaction_type", "timestamp")
+IMPORT_BATCH_SIZE = 5000
+IMPORT_MAX_ERRORS = 20
+
+# Called as listener(user_ids) once an import has committed, with the users
+# whose ledgers and positions it changed
+import_listeners = []
+
+LEDGER_COLUMNS = (
+    Transaction.id,
+    Transaction.symbol,
+    Transaction.quantity,
+    Transaction.price,
+    Transaction.transaction_type,
+    Transaction.timestamp,
+)
+
+
+class LedgerQueryError(ValueError):
+    """Invalid filter, limit or cursor supplied by the client."""
+
+
+class LedgerImportError(ValueError):
+    """An import was rejected; errors lists the offending rows."""
+
+    def __init__(self, errors):
+        super().__init__(f"{len(errors)} invalid row(s)")
+        self.errors = errors
+
+
+def encode_cursor(timestamp, row_id):
+    raw = f"{timestamp.isoformat()}|{row_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        timestamp, row_id = raw.rsplit("|", 1)
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except (ValueError, UnicodeDecodeError):
+        raise LedgerQueryError("Invalid cursor")
+
+
+def _parse_time(value, end=False):
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise LedgerQueryError(f"Invalid date: {value}")
+    # A bare end date includes that whole day
+    if end and len(value) == 10:
+        parsed += timedelta(days=1)
+    return parsed
+
+
+def parse_history_args(args):
+    """Turn request query args into keyword arguments for history_query."""
+    filters = {}
+    if args.get("symbol"):
+        filters["symbol"] = args["symbol"].upper()
+    if args.get("type"):
+        transaction_type = args["type"].upper()
+        if transaction_type not in TRANSACTION_TYPES:
+            raise LedgerQueryError("type must be BUY or SELL")
+        filters["transaction_type"] = transaction_type
+    if args.get("start"):
+        filters["start"] = _parse_time(args["start"])
+    if args.get("end"):
+        filters["end"] = _parse_time(args["end"], end=True)
+    if args.get("cursor"):
+        filters["after"] = decode_cursor(args["cursor"])
+    if args.get("limit"):
+        try:
+            limit = int(args["limit"])
+        except ValueError:
+            raise LedgerQueryError("limit must be an integer")
+        if not 1 <= limit <= HISTORY_MAX_LIMIT:
+            raise LedgerQueryError(f"limit must be between 1 and {HISTORY_MAX_LIMIT}")
+        filters["limit"] = limit
+    return filters
+
+
+def history_query(user_id=None, symbol=None, transaction_type=None,
+                  start=None, end=None, after=None, limit=None):
+    """
+    Ledger rows newest first, ordered by (timestamp, id) to match
+    ix_transactions_user_ts_id. after=(timestamp, id) continues from a cursor.
+    """
+    stmt = select(*LEDGER_COLUMNS).order_by(Transaction.timestamp.desc(), Transaction.id.desc())
+    return _filter(stmt, user_id, symbol, transaction_type, start, end, after, limit)
+
+
+def export_query(user_id=None, symbol=None, transaction_type=None, start=None, end=None):
+    """
+    Ledger rows in replay order: one user's by (timestamp, id), or every
+    user's by id when user_id is None.
+    """
+    stmt = select(Transaction.user_id, *LEDGER_COLUMNS)
+    if user_id is None:
+        stmt = stmt.order_by(Transaction.id)
+    else:
+        stmt = stmt.order_by(Transaction.timestamp, Transaction.id)
+    return _filter(stmt, user_id, symbol, transaction_type, start, end)
+
+
+def _filter(stmt, user_id=None, symbol=None, transaction_type=None,
+            start=None, end=None, after=None, limit=None):
+    if user_id is not None:
+        stmt = stmt.where(Transaction.user_id == user_id)
+    if symbol:
+        stmt = stmt.where(Transaction.symbol == symbol)
+    if transaction_type:
+        stmt = stmt.where(Transaction.transaction_type == transaction_type)
+    if start:
+        stmt = stmt.where(Transaction.timestamp >= start)
+    if end:
+        stmt = stmt.where(Transaction.timestamp < end)
+    if after:
+        timestamp, row_id = after
+        stmt = stmt.where(or_(
+            Transaction.timestamp < timestamp,
+            and_(Transaction.timestamp == timestamp, Transaction.id < row_id),
+        ))
+    if limit:
+        stmt = stmt.limit(limit)
+    return stmt
+
+
+def row_to_dict(row):
+    return {
+        "id": row.id,
+        "symbol": row.symbol,
+        "quantity": row.quantity,
+        "price": float(row.price),
+        "transaction_type": row.transaction_type,
+        "timestamp": row.timestamp.isoformat() if row.timestamp else None
+    }
+
+
+def export_row_to_dict(row):
+    return dict(row_to_dict(row), user_id=row.user_id)
+
+
+def history_page(session, user_id, limit=HISTORY_DEFAULT_LIMIT, **filters):
+    """One page of history plus the cursor for the next page (None at the end)."""
+    rows = session.execute(history_query(user_id, limit=limit + 1, **filters)).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].timestamp, rows[-1].id)
+    return [row_to_dict(r) for r in rows], next_cursor
+
+
+def iter_rows(stmt):
+    """Yield ledger rows from a server-side cursor on a dedicated connection."""
+    with engine.connect() as conn:
+        result = conn.execution_options(yield_per=STREAM_BATCH_SIZE).execute(stmt)
+        for row in result:
+            yield row
+
+
+def stream_json(stmt, key="transactions"):
+    """Serialize rows as {"<key>": [...]} one chunk at a time."""
+    yield '{"%s": [' % key
+    first = True
+    for row in iter_rows(stmt):
+        yield ("" if first else ",") + json.dumps(row_to_dict(row))
+        first = False
+    yield "]}"
+
+
+def stream_ndjson(stmt, serialize=row_to_dict):
+    for row in iter_rows(stmt):
+        yield json.dumps(serialize(row)) + "\n"
+
+
+def stream_csv(stmt, flush_every=500):
+    """Serialize export rows as CSV with a header, flushing every few hundred rows."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    for i, row in enumerate(iter_rows(stmt), 1):
+        writer.writerow((row.id, row.user_id, row.symbol, row.quantity, row.price,
+                         row.transaction_type, row.timestamp.isoformat() if row.timestamp else ""))
+        if i % flush_every == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+    yield buffer.getvalue()
+
+
+def _read_import_rows(stream, fmt):
+    """Yield (line number, raw dict or parse error) without reading the whole file."""
+    text_stream = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+    if fmt == "ndjson":
+        for lineno, line in enumerate(text_stream, 1):
+            if not line.strip():
+                continue
+            try:
+                raw = json.loads(line)
+            except ValueError as e:
+                raw = e
+            yield lineno, raw
+    else:
+        reader = csv.DictReader(text_stream)
+        for raw in reader:
+            yield reader.line_num, raw
+
+
+def _validate_row(raw, user_id, allow_user_id):
+    if isinstance(raw, Exception):
+        raise ValueError(f"unparseable row: {raw}")
+    if not isinstance(raw, dict):
+        raise ValueError("row must be an object")
+
+    symbol = str(raw.get("symbol") or "").strip().upper()
+    if not symbol or len(symbol) > 15:
+        raise ValueError("invalid symbol")
+    try:
+        quantity = Decimal(str(raw.get("quantity")).strip())
+    except InvalidOperation:
+        quantity = None
+    if quantity is None or not quantity.is_finite() or quantity != quantity.to_integral_value():
+        raise ValueError("quantity must be a whole number")
+    quantity = int(quantity)
+    if quantity <= 0:
+        raise ValueError("quantity must be positive")
+    price = Decimal(str(raw.get("price")))
+    if not price.is_finite() or price <= 0:
+        raise ValueError("price must be positive")
+    transaction_type = str(raw.get("transaction_type") or raw.get("type") or "").upper()
+    if transaction_type not in TRANSACTION_TYPES:
+        raise ValueError("transaction_type must be BUY or SELL")
+    timestamp = datetime.fromisoformat(str(raw.get("timestamp")))
+    if allow_user_id and raw.get("user_id") not in (None, ""):
+        user_id = int(raw["user_id"])
+
+    # In IMPORT_COLUMNS order
+    return user_id, symbol, quantity, price, transaction_type, timestamp
+
+
+def import_transactions(stream, user_id, fmt="csv", allow_user_id=False):
+    """
+    Parse an uploaded ledger incrementally and insert it in executemany
+    batches, each committed on its own so trades and fills are not locked
+    out for the whole upload; the affected positions are rebuilt at the end.
+    A rejected import deletes the batches it already committed, so none of
+    it is kept (its rows can show up in history until then).
+    Imported trades are historical and do not move cash.
+    Returns (rows imported, positions rebuilt); raises LedgerImportError.
+    """
+    errors = []
+    affected = set()
+    batch = []
+    inserted = array("q")
+
+    try:
+        for lineno, raw in _read_import_rows(stream, fmt):
+            try:
+                row = _validate_row(raw, user_id, allow_user_id)
+            except (TypeError, ValueError, InvalidOperation) as e:
+                errors.append({"line": lineno, "error": str(e)})
+                if len(errors) >= IMPORT_MAX_ERRORS:
+                    break
+                continue
+            if errors:
+                continue  # keep validating, but nothing more will be written
+            batch.append(row)
+            affected.add(row[:2])
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                _insert_batch(batch, inserted)
+                batch = []
+
+        if errors:
+            raise LedgerImportError(errors)
+        if batch:
+            _insert_batch(batch, inserted)
+
+        user_ids = {u for u, _ in affected}
+        with engine.begin() as conn:
+            known = set(conn.scalars(select(User.id).where(User.id.in_(user_ids))))
+            if user_ids - known:
+                raise LedgerImportError([{"error": f"unknown user_id {u}"} for u in sorted(user_ids - known)])
+            try:
+                rebuilt = rebuild_positions(conn, pairs=affected)
+            except ValueError as e:
+                raise LedgerImportError([{"error": str(e)}])
+            conn.execute(update(User).where(User.id.in_(user_ids)).values(version=User.version + 1))
+    except BaseException:
+        _delete_imported(inserted)
+        raise
+
+    for listener in import_listeners:
+        try:
+            listener(user_ids)
+        except Exception as e:
+            print(f"Import listener error: {e}")
+    return len(inserted), rebuilt
+
+
+def _insert_batch(batch, inserted):
+    """Insert and commit one batch of import rows, remembering their ids."""
+    with engine.begin() as conn:
+        result = conn.execute(insert(Transaction).returning(Transaction.id),
+                              [dict(zip(IMPORT_COLUMNS, row)) for row in batch])
+        inserted.extend(result.scalars())
+
+
+def _delete_imported(ids):
+    """Undo the committed batches of a rejected import."""
+    for start in range(0, len(ids), IMPORT_BATCH_SIZE):
+        chunk = ids[start:start + IMPORT_BATCH_SIZE].tolist()
+        with engine.begin() as conn:
+            conn.execute(delete(Transaction).where(Transaction.id.in_(chunk)))
@@ -0,0 +1,162 @@
+"""
+Background refresher that keeps the price store warm for the hot set:
+symbols held in portfolios, the market snapshot list, symbols watched over
+SSE and symbols clients quoted recently. Request handlers read from the
+store and only go upstream for symbols that are cold.
+"""
+import math
+import os
+import threading
+import time
+
+from sqlalchemy import select
+
+from helpers import price_store, refresh_quotes, scheduler, PRIORITY_BACKGROUND
+from model import SessionLocal, Portfolio
+
+REFRESH_TICK = 1.0
+REFRESH_MIN_INTERVAL = float(os.getenv("REFRESH_MIN_INTERVAL", "5"))
+REFRESH_MAX_BACKOFF = float(os.getenv("REFRESH_MAX_BACKOFF", "600"))
+# Share of the sustainable upstream rate the refresher may use; the rest is
+# left for cold lookups and orders.
+REFRESH_BUDGET_SHARE = float(os.getenv("REFRESH_BUDGET_SHARE", "0.5"))
+REFRESH_BATCH = 20
+HELD_SYMBOLS_TTL = 60
+
+_held = {"symbols": frozenset(), "loaded": -math.inf}
+
+
+def held_symbols():
+    """Symbols with an open position in any portfolio, re-read at most once a minute."""
+    now = time.monotonic()
+    if now - _held["loaded"] >= HELD_SYMBOLS_TTL:
+        with SessionLocal() as session:
+            rows = session.scalars(select(Portfolio.symbol).where(Portfolio.quantity > 0).distinct())
+            _held["symbols"] = frozenset(rows)
+        _held["loaded"] = now
+    return _held["symbols"]
+
+
+class MarketDataRefresher:
+    """
+    Refreshes hot symbols on adaptive intervals. Each source names a set of
+    symbols and the staleness it tolerates; frequently quoted symbols are
+    refreshed faster, and everything slows down when the combined demand
+    would exceed our share of the upstream budget.
+    """
+
+    def __init__(self, feed=None, budget_share=REFRESH_BUDGET_SHARE, tick=REFRESH_TICK):
+        self.feed = feed
+        self.budget_share = budget_share
+        self.tick = tick
+        self._sources = []   # (callable returning symbols, interval)
+        self._next = {}      # symbol -> monotonic time of next refresh
+        self._failures = {}  # symbol -> consecutive failed refreshes
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.refreshed = 0
+        self.failed = 0
+
+    def add_source(self, symbols, interval):
+        """Keep the symbols returned by symbols() at most interval seconds old."""
+        self._sources.append((symbols, interval))
+
+    def intervals(self):
+        """Target refresh interval per hot symbol, adjusted for access heat and budget."""
+        targets = {}
+        for source, interval in self._sources:
+            try:
+                symbols = source()
+            except Exception as e:
+                print(f"Refresher source error: {e}")
+                continue
+            for symbol in symbols:
+                symbol = symbol.upper()
+                targets[symbol] = min(targets.get(symbol, interval), interval)
+        for symbol, interval in targets.items():
+            targets[symbol] = max(REFRESH_MIN_INTERVAL, interval / (1 + price_store.heat(symbol)))
+
+        # One upstream call per symbol is the worst case (no bulk endpoint).
+        demand = sum(1 / interval for interval in targets.values())
+        allowed = self.budget_share * scheduler.sustainable_rate()
+        if demand > allowed:
+            if allowed <= 0:
+                return {}
+            stretch = demand / allowed
+            targets = {symbol: interval * stretch for symbol, interval in targets.items()}
+        return targets
+
+    def refresh_once(self):
+        """Refresh the symbols that are due; returns the symbols refreshed."""
+        now = time.monotonic()
+        targets = self.intervals()
+        for symbol in list(self._next):
+            if symbol not in targets:
+                del self._next[symbol]
+                self._failures.pop(symbol, None)
+
+        due = []
+        for symbol, interval in targets.items():
+            if self._next.get(symbol, 0) > now:
+                continue
+            age = price_store.age(symbol)
+            if age < interval:
+                # Already fresh from a client lookup; publish it without spending a call
+                self._next[symbol] = now + interval - age
+                stored = price_store.get(symbol, interval, record=False)
+                if stored and self.feed is not None:
+                    self.feed.publish(symbol, stored["price"], stored["as_of"])
+            else:
+                due.append(symbol)
+        due.sort(key=lambda s: self._next.get(s, 0))
+        due = due[:REFRESH_BATCH]
+        if not due:
+            return []
+
+        try:
+            quotes = refresh_quotes(due, PRIORITY_BACKGROUND, max_age=REFRESH_MIN_INTERVAL)
+        except Exception as e:
+            print(f"Refresher error: {e}")
+            quotes = {}
+
+        for symbol in due:
+            quote = quotes.get(symbol)
+            if quote:
+                self.refreshed += 1
+                self._failures.pop(symbol, None)
+                self._next[symbol] = now + targets[symbol]
+                if self.feed is not None:
+                    self.feed.publish(symbol, float(quote["price"]), quote.get("as_of"))
+            else:
+                self.failed += 1
+                failures = self._failures[symbol] = self._failures.get(symbol, 0) + 1
+                self._next[symbol] = now + min(REFRESH_MAX_BACKOFF, targets[symbol] * 2 ** failures)
+        return sorted(s for s in due if quotes.get(s))
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="market-data-refresher", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        return {
+            "hot_symbols": len(self._next),
+            "refreshed": self.refreshed,
+            "failed": self.failed,
+            "running": self._thread is not None and self._thread.is_alive(),
+        }
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh_once()
+            except Exception as e:
+                print(f"Refresher error: {e}")
+            if self._stop.wait(self.tick):
+                return
@@ -1,9 +1,12 @@
-from sqlalchemy import String, ForeignKey, Float, DateTime, func, Numeric, CheckConstraint
-from sqlalchemy.orm import Mapped, mapped_column, DeclarativeBase, relationship, sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy import String, ForeignKey, Float, DateTime, func, Numeric, CheckConstraint, Index, inspect, select, delete, update, text, false
+from sqlalchemy.orm import Mapped, mapped_column, DeclarativeBase, relationship, sessionmaker, scoped_session
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.dialects.sqlite import DATETIME as SQLITE_DATETIME
 from werkzeug.security import generate_password_hash, check_password_hash
+from passwords import PASSWORD_HASH_METHOD
 from datetime import datetime
-from typing import List
+from typing import List, Optional
 import os
 
 class Base(DeclarativeBase):
@@ -19,6 +22,10 @@ class User(Base):
     password_hash: Mapped[str] = mapped_column(String(1000))
     cash: Mapped[float] = mapped_column(Numeric(15, 2), insert_default=10000.00)
     create_date: Mapped[datetime] = mapped_column(server_default=func.now())
+    # Back-office users may export and import every user's ledger
+    is_admin: Mapped[bool] = mapped_column(default=False, server_default=false())
+    # Bumped by every write to the user's cash, positions, ledger or profile; drives ETags
+    version: Mapped[int] = mapped_column(default=0, server_default=text("0"))
 
     # Relationships
     portfolio: Mapped[List["Portfolio"]] = relationship(back_populates="user")
@@ -34,11 +41,15 @@ class User(Base):
     @password.setter
     def password(self, password):
         # This MUST set the actual column name 'password_hash'
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = generate_password_hash(password, PASSWORD_HASH_METHOD)
 
     def verify_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+@event.listens_for(User, "before_update")
+def _bump_version(mapper, connection, target):
+    target.version = (target.version or 0) + 1
+
 class Portfolio(Base):
     __tablename__ = 'portfolio'
     id: Mapped[int] = mapped_column(primary_key=True)
@@ -46,6 +57,10 @@ class Portfolio(Base):
     symbol: Mapped[str] = mapped_column(String(15))
     quantity: Mapped[int] = mapped_column()
     price: Mapped[float] = mapped_column(Numeric(10, 2)) # Purchase price
+    # Running aggregates maintained by positions.py on every trade
+    avg_cost: Mapped[float] = mapped_column(Numeric(14, 4), default=0, server_default=text("0"))
+    total_cost: Mapped[float] = mapped_column(Numeric(15, 2), default=0, server_default=text("0"))
+    realized_pnl: Mapped[float] = mapped_column(Numeric(15, 2), default=0, server_default=text("0"))
 
     user: Mapped["User"] = relationship(back_populates="portfolio")
 
@@ -57,20 +72,172 @@ class Transaction(Base):
     quantity: Mapped[int] = mapped_column()
     price: Mapped[float] = mapped_column(Numeric(10, 2))
     transaction_type: Mapped[str] = mapped_column(String(10)) # 'BUY' or 'SELL'
-    timestamp: Mapped[datetime] = mapped_column(server_default=func.now())
+    # Stored to the second on SQLite so bound values compare like CURRENT_TIMESTAMP
+    timestamp: Mapped[datetime] = mapped_column(
+        DateTime().with_variant(SQLITE_DATETIME(truncate_microseconds=True), "sqlite"),
+        server_default=func.now(),
+    )
+
+class PendingOrder(Base):
+    """A resting LIMIT or STOP order, filled by the trigger engine in orders.py."""
+    __tablename__ = 'pending_orders'
+    id: Mapped[int] = mapped_column(primary_key=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey('user.id'))
+    symbol: Mapped[str] = mapped_column(String(15))
+    side: Mapped[str] = mapped_column(String(4))          # 'BUY' or 'SELL'
+    order_type: Mapped[str] = mapped_column(String(5))    # 'LIMIT' or 'STOP'
+    quantity: Mapped[int] = mapped_column()
+    trigger_price: Mapped[float] = mapped_column(Numeric(10, 2))
+    status: Mapped[str] = mapped_column(String(10), default="OPEN", server_default=text("'OPEN'"))
+    fill_price: Mapped[Optional[float]] = mapped_column(Numeric(10, 2))
+    error: Mapped[Optional[str]] = mapped_column(String(255))
+    created_at: Mapped[datetime] = mapped_column(server_default=func.now())
+    closed_at: Mapped[Optional[datetime]] = mapped_column()
+
+class PriceAlert(Base):
+    """Notify the user once when symbol's price crosses threshold (see alerts.py)."""
+    __tablename__ = 'price_alerts'
+    id: Mapped[int] = mapped_column(primary_key=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey('user.id'))
+    symbol: Mapped[str] = mapped_column(String(15))
+    threshold: Mapped[float] = mapped_column(Numeric(10, 2))
+    direction: Mapped[str] = mapped_column(String(5))     # 'ABOVE' or 'BELOW'
+    status: Mapped[str] = mapped_column(String(10), default="ACTIVE", server_default=text("'ACTIVE'"))
+    triggered_price: Mapped[Optional[float]] = mapped_column(Numeric(10, 2))
+    triggered_at: Mapped[Optional[datetime]] = mapped_column()
+    delivered_at: Mapped[Optional[datetime]] = mapped_column()
+    created_at: Mapped[datetime] = mapped_column(server_default=func.now())
+
+# One position row per (user, symbol); also serves the buy/sell lookups
+Index("uq_portfolio_user_symbol", Portfolio.user_id, Portfolio.symbol, unique=True)
+# Per-user history, newest first, with id as the tie-breaker
+Index("ix_transactions_user_ts_id", Transaction.user_id, Transaction.timestamp.desc(), Transaction.id.desc())
+# Open orders are loaded by status at startup and listed per user
+Index("ix_pending_orders_status", PendingOrder.status)
+Index("ix_pending_orders_user_status", PendingOrder.user_id, PendingOrder.status)
+Index("ix_price_alerts_status", PriceAlert.status)
+Index("ix_price_alerts_user_status", PriceAlert.user_id, PriceAlert.status)
 
 
 
 DATABASE_URL = os.environ.get('DATABASE_URL', 'sqlite:///finance.db')
 
-engine = create_engine(DATABASE_URL)
+
+def _engine_options(url):
+    """Connection pool settings from the environment, tuned per backend."""
+    options = {
+        "pool_pre_ping": os.environ.get('DB_POOL_PRE_PING', '1') == '1',
+        "pool_recycle": int(os.environ.get('DB_POOL_RECYCLE', '1800')),
+    }
+    if url.get_backend_name() == 'sqlite':
+        # Sessions are handed between request threads, and readers must
+        # wait on a busy writer instead of failing straight away
+        options["connect_args"] = {
+            "check_same_thread": False,
+            "timeout": float(os.environ.get('SQLITE_BUSY_TIMEOUT', '30')),
+        }
+        if url.database in (None, '', ':memory:'):
+            return options
+    options.update(
+        pool_size=int(os.environ.get('DB_POOL_SIZE', '10')),
+        max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', '20')),
+        pool_timeout=float(os.environ.get('DB_POOL_TIMEOUT', '30')),
+    )
+    return options
+
+
+engine = create_engine(DATABASE_URL, **_engine_options(make_url(DATABASE_URL)))
+
+
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers proceed while a writer commits
+    if engine.dialect.name != 'sqlite':
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# One session per request thread, released by the teardown hook from init_app
+db_session = scoped_session(SessionLocal)
+
 def init_db():
     # This creates all your classes (User, Portfolio, etc.) as tables
     Base.metadata.create_all(bind=engine)
     print("Database tables created successfully in 'finance_app'!")
 
+def _merge_duplicate_positions(conn):
+    """Collapse duplicate (user_id, symbol) portfolio rows into the oldest one."""
+    duplicates = conn.execute(
+        select(Portfolio.user_id, Portfolio.symbol)
+        .group_by(Portfolio.user_id, Portfolio.symbol)
+        .having(func.count() > 1)
+    ).all()
+    for user_id, symbol in duplicates:
+        rows = conn.execute(
+            select(Portfolio.id, Portfolio.quantity, Portfolio.price)
+            .where(Portfolio.user_id == user_id, Portfolio.symbol == symbol)
+            .order_by(Portfolio.id)
+        ).all()
+        keep = rows[0]
+        conn.execute(
+            update(Portfolio).where(Portfolio.id == keep.id)
+            .values(quantity=sum(r.quantity for r in rows), price=rows[-1].price)
+        )
+        conn.execute(delete(Portfolio).where(Portfolio.id.in_([r.id for r in rows[1:]])))
+    return len(duplicates)
+
+def _add_missing_columns(conn):
+    """ALTER TABLE ... ADD COLUMN for model columns an older database lacks."""
+    inspector = inspect(conn)
+    preparer = conn.dialect.identifier_preparer
+    ddl_compiler = conn.dialect.ddl_compiler(conn.dialect, None)
+    added = []
+    for table in Base.metadata.sorted_tables:
+        existing = {c["name"] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN " \
+                  f"{preparer.format_column(column)} {column.type.compile(dialect=conn.dialect)}"
+            default = ddl_compiler.get_column_default_string(column)
+            if default is not None:
+                ddl += f" DEFAULT {default}"
+            conn.execute(text(ddl))
+            added.append(f"{table.name}.{column.name}")
+    return added
+
+def migrate_db(bind=engine):
+    """
+    Bring a database created by an older init_db.py up to the current schema.
+    Creates missing tables, columns and indexes; safe to run repeatedly.
+    Returns the "table.column" names that were added.
+    """
+    Base.metadata.create_all(bind=bind)
+    with bind.begin() as conn:
+        added = _add_missing_columns(conn)
+        for column in added:
+            print(f"Added column {column}")
+        existing = {ix["name"] for ix in inspect(conn).get_indexes("portfolio")}
+        if "uq_portfolio_user_symbol" not in existing:
+            merged = _merge_duplicate_positions(conn)
+            if merged:
+                print(f"Merged {merged} duplicate portfolio positions")
+        for table in (Portfolio.__table__, Transaction.__table__):
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+    return added
+
 # Use this to get a session whenever you need to add data
 def dbconnect():
     return SessionLocal()
+
+def init_app(app):
+    """Release the request's session when the app context tears down."""
+    @app.teardown_appcontext
+    def remove_db_session(exception=None):
+        db_session.remove()
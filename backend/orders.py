@@ -0,0 +1,178 @@
+"""
+Resting LIMIT and STOP orders.
+
+TriggerEngine keeps two heaps of trigger prices per symbol: orders that fire
+when the price falls to their trigger (buy limits, sell stops) and orders
+that fire when it rises to it (sell limits, buy stops). A price tick pops
+only the orders whose thresholds it crossed, so its cost depends on how
+many orders fire, not how many are open. Fired orders are filled through
+the same trade functions as market orders.
+
+The engine is per process and loaded once, so the app must run as a single
+worker process: orders placed in another worker would never reach it.
+Fills are still safe if two processes hold the same order, because a fill
+claims it with UPDATE ... WHERE status = 'OPEN' in the trade's transaction
+and gives up unless that moved exactly one row.
+"""
+import heapq
+import threading
+from datetime import datetime, timezone
+
+from sqlalchemy import select, update
+
+from model import SessionLocal, PendingOrder
+from trading import TradeRejected, run_trade, execute_buy, execute_sell
+
+ORDER_TYPES = ("LIMIT", "STOP")
+# Compact the heaps once cancelled entries outnumber live ones by this much
+COMPACT_MIN_DEAD = 1024
+
+
+def fires_on_drop(side, order_type):
+    """True if the order triggers when the price falls to its trigger price."""
+    return (side, order_type) in (("BUY", "LIMIT"), ("SELL", "STOP"))
+
+
+class TriggerEngine:
+    """Per-symbol trigger heaps for open orders; cancelled entries are dropped lazily."""
+
+    def __init__(self):
+        self._drop = {}  # symbol -> heap of (-trigger, order_id): fire when price <= trigger
+        self._rise = {}  # symbol -> heap of (trigger, order_id):  fire when price >= trigger
+        self._live = {}  # order_id -> symbol
+        self._dead = 0
+        self._lock = threading.Lock()
+        self.loaded = False
+
+    def __len__(self):
+        return len(self._live)
+
+    def add(self, order_id, symbol, side, order_type, trigger_price):
+        symbol = symbol.upper()
+        trigger_price = float(trigger_price)
+        with self._lock:
+            if order_id in self._live:
+                return
+            if fires_on_drop(side, order_type):
+                heapq.heappush(self._drop.setdefault(symbol, []), (-trigger_price, order_id))
+            else:
+                heapq.heappush(self._rise.setdefault(symbol, []), (trigger_price, order_id))
+            self._live[order_id] = symbol
+
+    def remove(self, order_id):
+        with self._lock:
+            if self._live.pop(order_id, None) is not None:
+                self._dead += 1
+                if self._dead > max(COMPACT_MIN_DEAD, len(self._live)):
+                    self._compact()
+
+    def on_price(self, symbol, price):
+        """Pop and return the ids of orders on symbol triggered by price."""
+        symbol = symbol.upper()
+        fired = []
+        with self._lock:
+            drop = self._drop.get(symbol)
+            while drop and -drop[0][0] >= price:
+                self._take(heapq.heappop(drop)[1], fired)
+            rise = self._rise.get(symbol)
+            while rise and rise[0][0] <= price:
+                self._take(heapq.heappop(rise)[1], fired)
+        return fired
+
+    def symbols(self):
+        with self._lock:
+            return set(self._live.values())
+
+    def load(self, conn):
+        """Index every OPEN order in the database."""
+        rows = conn.execute(select(PendingOrder.id, PendingOrder.symbol, PendingOrder.side,
+                                   PendingOrder.order_type, PendingOrder.trigger_price)
+                            .where(PendingOrder.status == "OPEN"))
+        for row in rows:
+            self.add(*row)
+        self.loaded = True
+
+    def clear(self):
+        with self._lock:
+            self._drop.clear()
+            self._rise.clear()
+            self._live.clear()
+            self._dead = 0
+
+    def _take(self, order_id, fired):
+        if self._live.pop(order_id, None) is not None:
+            fired.append(order_id)
+        else:
+            self._dead -= 1
+
+    def _compact(self):
+        for heaps in (self._drop, self._rise):
+            for symbol, heap in list(heaps.items()):
+                heap[:] = [entry for entry in heap if entry[1] in self._live]
+                heapq.heapify(heap)
+                if not heap:
+                    del heaps[symbol]
+        self._dead = 0
+
+
+def _close(session, order_id, status, **values):
+    """Move an OPEN order to status; returns False if it was no longer open."""
+    result = session.execute(
+        update(PendingOrder).where(PendingOrder.id == order_id, PendingOrder.status == "OPEN")
+        .values(status=status, closed_at=datetime.now(timezone.utc), **values)
+        .execution_options(synchronize_session=False))
+    return result.rowcount == 1
+
+
+def _fill(session, order, price):
+    # Claiming the order in the trade's transaction keeps a cancel from racing the fill
+    if not _close(session, order.id, "FILLED", fill_price=price):
+        raise TradeRejected("Order is no longer open")
+    trade = execute_buy if order.side == "BUY" else execute_sell
+    trade(session, order.user_id, order.symbol, order.quantity, price)
+
+
+def fill_orders(order_ids, price, session_factory=SessionLocal, engine=None):
+    """
+    Fill triggered orders at price. Orders the account can no longer cover
+    are marked REJECTED with the reason. Orders that hit a database error
+    (e.g. still locked after run_trade's retries) stay OPEN and are put back
+    into engine, if given, to fire on a later price. Returns {order_id: outcome}.
+    """
+    outcomes = {}
+    with session_factory() as session:
+        for order_id in order_ids:
+            entry = None
+            try:
+                order = session.get(PendingOrder, order_id)
+                if order is None or order.status != "OPEN":
+                    continue
+                # Read before trading: a rollback expires the loaded order
+                entry = (order.id, order.symbol, order.side, order.order_type, order.trigger_price)
+                outcome = run_trade(session, _fill, order, price)
+                if outcome != "success" and _close(session, order_id, "REJECTED", error=outcome[:255]):
+                    session.commit()
+            except Exception as e:
+                session.rollback()
+                print(f"Order fill error ({order_id}): {e}")
+                outcome = f"error: {e}"
+                if engine is not None and entry is not None:
+                    engine.add(*entry)
+            outcomes[order_id] = outcome
+    return outcomes
+
+
+def order_to_dict(order):
+    return {
+        "id": order.id,
+        "symbol": order.symbol,
+        "side": order.side,
+        "type": order.order_type,
+        "quantity": order.quantity,
+        "trigger_price": float(order.trigger_price),
+        "status": order.status,
+        "fill_price": float(order.fill_price) if order.fill_price is not None else None,
+        "error": order.error,
+        "created_at": order.created_at.isoformat() if order.created_at else None,
+        "closed_at": order.closed_at.isoformat() if order.closed_at else None,
+    }
@@ -0,0 +1,110 @@
+"""
+Password hashing off the request threads.
+
+Hashing and verifying are deliberately slow, CPU-bound work that holds the
+GIL, so they run on a small pool of spawned worker processes. At most
+PASSWORD_QUEUE_MAX calls may be queued or running; beyond that callers get
+PasswordBusy right away (the API answers 503) instead of piling up behind a
+login burst. Verifying a hash made with other parameters than
+PASSWORD_HASH_METHOD also returns a fresh hash so it can be upgraded.
+"""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+# Any werkzeug method string, e.g. "scrypt:32768:8:1" or "pbkdf2:sha256:600000"
+PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "scrypt")
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", str(os.cpu_count() or 1)))
+PASSWORD_QUEUE_MAX = int(os.getenv("PASSWORD_QUEUE_MAX", str(PASSWORD_WORKERS * 4)))
+PASSWORD_TIMEOUT = float(os.getenv("PASSWORD_TIMEOUT", "10"))
+PASSWORD_BUSY = "Server busy, please retry"
+
+
+class PasswordBusy(Exception):
+    """Too many hash operations in flight (or the pool is unavailable)."""
+
+
+_prefixes = {}
+
+
+def _prefix(method):
+    """The "method$" part werkzeug writes for method, e.g. "scrypt:32768:8:1"."""
+    if method not in _prefixes:
+        _prefixes[method] = generate_password_hash("", method).split("$", 1)[0]
+    return _prefixes[method]
+
+
+def _hash(password, method):
+    return generate_password_hash(password, method)
+
+
+def _verify(pwhash, password, method):
+    """(matches, upgraded hash or None); runs in a worker process."""
+    if not pwhash or not check_password_hash(pwhash, password):
+        return False, None
+    if pwhash.split("$", 1)[0] != _prefix(method):
+        return True, generate_password_hash(password, method)
+    return True, None
+
+
+class PasswordHasher:
+    """Bounded front end to a spawned process pool for hash/verify calls."""
+
+    def __init__(self, workers=PASSWORD_WORKERS, queue_max=PASSWORD_QUEUE_MAX,
+                 method=PASSWORD_HASH_METHOD, timeout=PASSWORD_TIMEOUT):
+        self.workers = workers
+        self.method = method
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(queue_max)
+        self._pool = None
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                # spawn: forking a threaded server process isn't safe
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+            return self._pool
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            raise PasswordBusy("Too many concurrent password operations")
+        try:
+            future = self._executor().submit(fn, *args)
+        except (BrokenProcessPool, RuntimeError) as e:
+            self._slots.release()
+            self._reset()
+            raise PasswordBusy(str(e)) from e
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError as e:
+            raise PasswordBusy("Password operation timed out") from e
+        except BrokenProcessPool as e:
+            self._reset()
+            raise PasswordBusy(str(e)) from e
+
+    def _reset(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def hash(self, password):
+        return self._run(_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        """(matches, new hash to store when the parameters changed, else None)."""
+        return self._run(_verify, pwhash, password, self.method)
+
+    def shutdown(self):
+        self._reset()
+
+
+hasher = PasswordHasher()
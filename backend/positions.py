@@ -0,0 +1,188 @@
+"""
+Position accounting: quantity, average cost, total cost and realized P&L per
+(user, symbol), kept up to date incrementally as each buy/sell commits and
+rebuildable from the transaction ledger.
+
+    python positions.py verify [--user-id N]    report positions that disagree with the ledger
+    python positions.py rebuild [--user-id N]   rewrite positions from the ledger
+"""
+import argparse
+from decimal import Decimal
+
+from sqlalchemy import select, insert, delete, case, func
+
+from model import engine, Portfolio, Transaction
+
+ZERO = Decimal("0")
+AVG_COST_PLACES = Decimal("0.0001")
+REPLAY_BATCH_SIZE = 1000
+TOLERANCE = Decimal("0.01")
+
+
+def _dec(value):
+    return value if isinstance(value, Decimal) else Decimal(str(value or 0))
+
+
+def buy_position(quantity, total_cost, buy_quantity, price):
+    """Average-cost accounting for a buy. Returns (quantity, total_cost, avg_cost)."""
+    quantity += buy_quantity
+    total_cost = _dec(total_cost) + _dec(price) * buy_quantity
+    return quantity, total_cost, (total_cost / quantity).quantize(AVG_COST_PLACES)
+
+
+def sell_position(quantity, total_cost, realized_pnl, sell_quantity, price):
+    """
+    Average-cost accounting for a sell.
+    Returns (quantity, total_cost, avg_cost, realized_pnl).
+    """
+    if sell_quantity > quantity:
+        raise ValueError("sell exceeds position")
+    total_cost = _dec(total_cost)
+    cost_removed = total_cost * sell_quantity / quantity
+    realized_pnl = _dec(realized_pnl) + _dec(price) * sell_quantity - cost_removed
+    quantity -= sell_quantity
+    if quantity == 0:
+        return 0, ZERO, ZERO, realized_pnl
+    total_cost -= cost_removed
+    return quantity, total_cost, (total_cost / quantity).quantize(AVG_COST_PLACES), realized_pnl
+
+
+def buy_values(quantity, price):
+    """
+    SET values applying buy_position to the row's current columns inside a
+    single UPDATE (or upsert), so concurrent buys can't interleave. The last
+    purchase price becomes the row's price.
+    """
+    new_total = Portfolio.total_cost + _dec(price) * quantity
+    return {
+        Portfolio.quantity: Portfolio.quantity + quantity,
+        Portfolio.total_cost: new_total,
+        Portfolio.avg_cost: func.round(new_total / (Portfolio.quantity + quantity), 4),
+        Portfolio.price: price,
+    }
+
+
+def sell_values(quantity, price):
+    """
+    Ordered SET values applying sell_position to the row's current columns.
+    quantity is assigned last so every expression sees the pre-sale row, even
+    on databases that evaluate SET clauses left to right. The UPDATE must be
+    guarded by quantity >= sold.
+    """
+    closes = Portfolio.quantity == quantity
+    # Multiplying by a Decimal keeps the division fractional on SQLite
+    cost_removed = Portfolio.total_cost * _dec(quantity) / Portfolio.quantity
+    return [
+        (Portfolio.realized_pnl, Portfolio.realized_pnl + _dec(price) * quantity - cost_removed),
+        (Portfolio.total_cost, case((closes, 0), else_=Portfolio.total_cost - cost_removed)),
+        (Portfolio.avg_cost, case((closes, 0), else_=Portfolio.avg_cost)),
+        (Portfolio.quantity, Portfolio.quantity - quantity),
+    ]
+
+
+def _scope(stmt, model, user_id=None, symbols=None):
+    if user_id is not None:
+        stmt = stmt.where(model.user_id == user_id)
+    if symbols is not None:
+        stmt = stmt.where(model.symbol.in_(symbols))
+    return stmt
+
+
+def replay_ledger(conn, user_id=None, symbols=None):
+    """
+    Replay transactions in (timestamp, id) order and return
+    {(user_id, symbol): [quantity, total_cost, avg_cost, realized_pnl, last_buy_price]}.
+    Raises ValueError if the ledger sells more shares than were held.
+    """
+    stmt = _scope(
+        select(Transaction.user_id, Transaction.symbol, Transaction.quantity,
+               Transaction.price, Transaction.transaction_type),
+        Transaction, user_id, symbols,
+    ).order_by(Transaction.user_id, Transaction.timestamp, Transaction.id)
+
+    positions = {}
+    for uid, symbol, quantity, price, transaction_type in conn.execute(
+            stmt.execution_options(yield_per=REPLAY_BATCH_SIZE)):
+        state = positions.setdefault((uid, symbol), [0, ZERO, ZERO, ZERO, None])
+        if transaction_type == "BUY":
+            state[0], state[1], state[2] = buy_position(state[0], state[1], quantity, price)
+            state[4] = price
+        else:
+            if quantity > state[0]:
+                raise ValueError(f"SELL of {symbol} exceeds holdings for user {uid}")
+            state[0], state[1], state[2], state[3] = sell_position(state[0], state[1], state[3], quantity, price)
+    return positions
+
+
+def rebuild_positions(conn, user_id=None, pairs=None):
+    """
+    Rewrite portfolio rows in scope (one user, some (user, symbol) pairs, or
+    everything) from a ledger replay. Returns the number of open positions.
+    """
+    if pairs is not None:
+        by_user = {}
+        for uid, symbol in pairs:
+            by_user.setdefault(uid, set()).add(symbol)
+        return sum(_rebuild(conn, uid, sorted(symbols)) for uid, symbols in by_user.items())
+    return _rebuild(conn, user_id)
+
+
+def _rebuild(conn, user_id=None, symbols=None):
+    positions = replay_ledger(conn, user_id, symbols)
+    conn.execute(_scope(delete(Portfolio), Portfolio, user_id, symbols))
+    values = [
+        {"user_id": uid, "symbol": symbol, "quantity": quantity, "total_cost": total_cost,
+         "avg_cost": avg_cost, "realized_pnl": realized, "price": last_price or ZERO}
+        for (uid, symbol), (quantity, total_cost, avg_cost, realized, last_price) in positions.items()
+    ]
+    if values:
+        conn.execute(insert(Portfolio), values)
+    return sum(1 for v in values if v["quantity"] > 0)
+
+
+def verify_positions(conn, user_id=None):
+    """List positions whose stored aggregates disagree with the ledger."""
+    expected = replay_ledger(conn, user_id)
+    stored = {
+        (row.user_id, row.symbol): row
+        for row in conn.execute(_scope(select(Portfolio), Portfolio, user_id))
+    }
+    mismatches = []
+    for key in sorted(set(expected) | set(stored), key=str):
+        quantity, total_cost, avg_cost, realized, _ = expected.get(key, (0, ZERO, ZERO, ZERO, None))
+        row = stored.get(key)
+        actual = (row.quantity, _dec(row.total_cost), _dec(row.avg_cost), _dec(row.realized_pnl)) if row \
+            else (0, ZERO, ZERO, ZERO)
+        if actual[0] != quantity or any(abs(a - e) > TOLERANCE for a, e in
+                                        zip(actual[1:], (total_cost, avg_cost, realized))):
+            mismatches.append({
+                "user_id": key[0], "symbol": key[1],
+                "expected": {"quantity": quantity, "total_cost": str(total_cost),
+                             "avg_cost": str(avg_cost), "realized_pnl": str(realized)},
+                "stored": {"quantity": actual[0], "total_cost": str(actual[1]),
+                           "avg_cost": str(actual[2]), "realized_pnl": str(actual[3])},
+            })
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Verify or rebuild portfolio aggregates from the ledger.")
+    parser.add_argument("command", choices=["verify", "rebuild"])
+    parser.add_argument("--user-id", type=int)
+    args = parser.parse_args()
+
+    if args.command == "verify":
+        with engine.connect() as conn:
+            mismatches = verify_positions(conn, args.user_id)
+        for m in mismatches:
+            print(f"user {m['user_id']} {m['symbol']}: stored {m['stored']} expected {m['expected']}")
+        print(f"{len(mismatches)} position(s) out of line with the ledger")
+        raise SystemExit(1 if mismatches else 0)
+
+    with engine.begin() as conn:
+        rebuilt = rebuild_positions(conn, args.user_id)
+    print(f"Rebuilt {rebuilt} open position(s) from the ledger")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+In-process price feed fanned out to Server-Sent Events subscribers.
+The feed does not fetch prices itself: the market data refresher keeps the
+union of watched symbols (watched_symbols) current and publishes them, so
+upstream load depends on the symbols watched, not on how many clients
+watch them.
+"""
+import itertools
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+# How often the refresher republishes watched symbols (seconds)
+PRICE_FEED_INTERVAL = float(os.getenv("PRICE_FEED_INTERVAL", "15"))
+SSE_HEARTBEAT = float(os.getenv("SSE_HEARTBEAT", "15"))
+SSE_MAX_SUBSCRIBERS = int(os.getenv("SSE_MAX_SUBSCRIBERS", "200"))
+SSE_RETRY_MS = 3000
+REPLAY_BUFFER_SIZE = 1024
+
+
+class PriceEvent:
+    __slots__ = ("id", "symbol", "price", "as_of")
+
+    def __init__(self, event_id, symbol, price, as_of):
+        self.id = event_id
+        self.symbol = symbol
+        self.price = price
+        self.as_of = as_of
+
+    def to_sse(self):
+        data = json.dumps({"symbol": self.symbol, "price": self.price, "as_of": self.as_of})
+        return f"id: {self.id}\nevent: price\ndata: {data}\n\n"
+
+
+class FeedFull(Exception):
+    """The feed already serves SSE_MAX_SUBSCRIBERS connections."""
+
+
+class Subscription:
+    """
+    One client's view of the feed. Pending updates are conflated per symbol,
+    so a slow client holds at most the latest price of each symbol it
+    watches rather than an ever-growing backlog.
+    """
+
+    def __init__(self, feed, symbols):
+        self.feed = feed
+        self.symbols = frozenset(symbols)
+        self.closed = False
+        self.conflated = 0
+        self._pending = OrderedDict()
+        self._cond = threading.Condition()
+
+    def push(self, event):
+        with self._cond:
+            if self._pending.pop(event.symbol, None) is not None:
+                self.conflated += 1
+            self._pending[event.symbol] = event
+            self._cond.notify()
+
+    def next_events(self, timeout):
+        """Wait up to timeout for updates; returns [] on timeout or close."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._pending or self.closed, timeout)
+            events = list(self._pending.values())
+            self._pending.clear()
+            return events
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+        self.feed.unsubscribe(self)
+
+
+class PriceFeed:
+    """Keeps the latest price per symbol and publishes changes to subscribers."""
+
+    def __init__(self, max_subscribers=SSE_MAX_SUBSCRIBERS):
+        self.max_subscribers = max_subscribers
+        self._subscribers = set()
+        self._listeners = []
+        self._latest = {}                             # symbol -> PriceEvent
+        self._recent = deque(maxlen=REPLAY_BUFFER_SIZE)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def add_listener(self, callback):
+        """Call callback(symbol, price) for every published price change."""
+        self._listeners.append(callback)
+
+    def watched_symbols(self):
+        with self._lock:
+            return set().union(*(s.symbols for s in self._subscribers))
+
+    def subscribe(self, symbols, last_event_id=None):
+        """
+        Register a subscriber for symbols. Updates it missed since
+        last_event_id are replayed when still buffered; otherwise it starts
+        from the latest known price of each symbol.
+        """
+        symbols = {s.upper() for s in symbols}
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                raise FeedFull()
+            sub = Subscription(self, symbols)
+            self._subscribers.add(sub)
+            if (last_event_id is not None and self._recent
+                    and self._recent[0].id <= last_event_id + 1 <= self._recent[-1].id + 1):
+                backlog = [e for e in self._recent if e.id > last_event_id]
+            else:
+                backlog = sorted(self._latest.values(), key=lambda e: e.id)
+            for event in backlog:
+                if event.symbol in symbols:
+                    sub.push(event)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+
+    def publish(self, symbol, price, as_of=None):
+        """Record a price and fan it out if it changed; returns the event or None."""
+        symbol = symbol.upper()
+        with self._lock:
+            latest = self._latest.get(symbol)
+            if latest is not None and latest.price == price:
+                return None
+            event = PriceEvent(next(self._ids), symbol, price, as_of or time.time())
+            self._latest[symbol] = event
+            self._recent.append(event)
+            subscribers = [s for s in self._subscribers if symbol in s.symbols]
+        for sub in subscribers:
+            sub.push(event)
+        for callback in self._listeners:
+            try:
+                callback(symbol, price)
+            except Exception as e:
+                print(f"Price listener error: {e}")
+        return event
+
+    def latest(self, symbol):
+        event = self._latest.get(symbol.upper())
+        return event.price if event else None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "subscribers": len(self._subscribers),
+                "symbols": len(self._latest),
+                "last_event_id": self._recent[-1].id if self._recent else 0,
+            }
+
+
+def sse_stream(sub, heartbeat=SSE_HEARTBEAT):
+    """Yield SSE frames for a subscription, with keepalive comments while idle."""
+    try:
+        yield f"retry: {SSE_RETRY_MS}\n\n"
+        while not sub.closed:
+            events = sub.next_events(heartbeat)
+            if not events:
+                yield ": keepalive\n\n"
+            for event in events:
+                yield event.to_sse()
+    finally:
+        sub.close()
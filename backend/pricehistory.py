@@ -0,0 +1,155 @@
+"""
+Local daily OHLCV store for charts and analytics.
+
+Each symbol is one .npy file holding a (6, n) float64 array: one contiguous
+row per column (day, open, high, low, close, volume), days counted from
+1970-01-01 and kept ascending. Files are opened memory-mapped, so range
+queries return zero-copy slices, and updates only fetch and append the days
+after the last stored bar.
+"""
+import os
+import threading
+import time
+from datetime import date
+
+import numpy as np
+
+from helpers import _make_api_request, PRIORITY_BACKGROUND
+
+PRICE_HISTORY_DIR = os.getenv("PRICE_HISTORY_DIR", os.path.join(os.path.dirname(__file__), "price_history"))
+# Don't ask upstream for new bars more often than this per symbol
+PRICE_HISTORY_REFRESH = float(os.getenv("PRICE_HISTORY_REFRESH", str(6 * 3600)))
+# TIME_SERIES_DAILY "compact" returns the latest 100 bars; older gaps need "full"
+COMPACT_BARS = 100
+COLUMNS = ("day", "open", "high", "low", "close", "volume")
+DAY, OPEN, HIGH, LOW, CLOSE, VOLUME = range(len(COLUMNS))
+_EMPTY = np.empty((len(COLUMNS), 0))
+
+
+def to_day(value):
+    """date or ISO string -> days since the epoch."""
+    if isinstance(value, str):
+        value = date.fromisoformat(value)
+    return value.toordinal() - date(1970, 1, 1).toordinal()
+
+
+def from_day(day):
+    return date.fromordinal(int(day) + date(1970, 1, 1).toordinal())
+
+
+def parse_daily_series(data):
+    """TIME_SERIES_DAILY JSON -> (6, n) array sorted by day."""
+    series = (data or {}).get("Time Series (Daily)") or {}
+    rows = [
+        (to_day(day), float(bar["1. open"]), float(bar["2. high"]), float(bar["3. low"]),
+         float(bar["4. close"]), float(bar["5. volume"]))
+        for day, bar in series.items()
+    ]
+    if not rows:
+        return _EMPTY
+    return np.array(sorted(rows)).T
+
+
+class PriceHistoryStore:
+    """Per-symbol columnar bar files under root, memory-mapped on read."""
+
+    def __init__(self, root=PRICE_HISTORY_DIR, fetch=None):
+        self.root = root
+        self.fetch = fetch or (lambda params: _make_api_request(params, PRIORITY_BACKGROUND))
+        self._maps = {}   # symbol -> (mtime, memmap)
+        self._attempts = {}  # symbol -> time of the last fetch that left no file (unknown symbols)
+        self._lock = threading.Lock()
+
+    def path(self, symbol):
+        return os.path.join(self.root, f"{symbol.upper()}.npy")
+
+    def bars(self, symbol):
+        """The symbol's full (6, n) array, memory-mapped; empty if nothing is stored."""
+        path = self.path(symbol)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return _EMPTY
+        with self._lock:
+            cached = self._maps.get(symbol.upper())
+            if cached is None or cached[0] != mtime:
+                cached = (mtime, np.load(path, mmap_mode="r"))
+                self._maps[symbol.upper()] = cached
+            return cached[1]
+
+    def stamp(self, symbol):
+        """Modification time of the symbol's file (ns), or 0 if nothing is stored; changes with every write."""
+        try:
+            return os.stat(self.path(symbol)).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+    def range(self, symbol, start=None, end=None):
+        """Bars with start <= day <= end (dates or ISO strings) as a zero-copy (6, k) view."""
+        bars = self.bars(symbol)
+        days = bars[DAY]
+        lo = np.searchsorted(days, to_day(start), "left") if start else 0
+        hi = np.searchsorted(days, to_day(end), "right") if end else days.shape[0]
+        return bars[:, lo:hi]
+
+    def append(self, symbol, new_bars):
+        """Append the bars of new_bars newer than the last stored day; returns how many."""
+        current = self.bars(symbol)
+        if current.shape[1]:
+            new_bars = new_bars[:, new_bars[DAY] > current[DAY, -1]]
+        if not new_bars.shape[1]:
+            return 0
+        merged = np.concatenate([np.asarray(current), new_bars], axis=1)
+        os.makedirs(self.root, exist_ok=True)
+        path = self.path(symbol)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, merged)
+        os.replace(tmp, path)
+        return new_bars.shape[1]
+
+    def update(self, symbol, force=False):
+        """
+        Fetch bars after the last stored day through the upstream budget.
+        Skips symbols refreshed (or found to have no bars) within
+        PRICE_HISTORY_REFRESH unless force.
+        Returns the number of bars appended.
+        """
+        path = self.path(symbol)
+        key = symbol.upper()
+        if os.path.exists(path):
+            last_checked = os.path.getmtime(path)
+        else:
+            last_checked = self._attempts.get(key, -float("inf"))
+        if not force and time.time() - last_checked < PRICE_HISTORY_REFRESH:
+            return 0
+        current = self.bars(symbol)
+        today = to_day(date.today())
+        # Roughly 5 trading days per 7 calendar days
+        recent = current.shape[1] and (today - current[DAY, -1]) * 5 / 7 < COMPACT_BARS
+        data = self.fetch({"function": "TIME_SERIES_DAILY", "symbol": symbol.upper(),
+                           "outputsize": "compact" if recent else "full"})
+        appended = self.append(symbol, parse_daily_series(data))
+        if os.path.exists(path):
+            self._attempts.pop(key, None)
+            if not appended:
+                os.utime(path)  # nothing new yet; don't ask again until the refresh interval passes
+        else:
+            self._attempts[key] = time.time()  # no bars (e.g. unknown symbol); same back-off without a file
+        return appended
+
+    def symbols(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name[:-4] for name in os.listdir(self.root) if name.endswith(".npy"))
+
+
+def bars_to_dicts(bars):
+    """(6, k) bars -> list of {"date", "open", ...} for JSON responses."""
+    return [
+        {"date": from_day(day).isoformat(), "open": o, "high": h, "low": l, "close": c, "volume": int(v)}
+        for day, o, h, l, c, v in bars.T.tolist()
+    ]
+
+
+price_history = PriceHistoryStore()
@@ -0,0 +1,204 @@
+"""
+Quote table shared by every worker process on a host.
+
+A memory-mapped file holds a fixed number of 64-byte slots keyed by symbol
+(open addressing on a CRC32 of the symbol, so every process agrees on the
+layout). Readers never lock: each slot carries a sequence number that
+writers make odd while they update it, and a reader retries if the number
+changed under it. Writers serialize on a short fcntl lock over the file.
+A per-slot lease lets one process refresh a symbol while the others wait
+for its result instead of calling upstream themselves.
+"""
+import mmap
+import os
+import struct
+import time
+import zlib
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows; the shared store is disabled there
+    fcntl = None
+
+SHARED_QUOTES_PATH = os.getenv("SHARED_QUOTES_PATH", "")
+SHARED_QUOTES_SLOTS = int(os.getenv("SHARED_QUOTES_SLOTS", "4096"))
+SHARED_LEASE_SECONDS = float(os.getenv("SHARED_LEASE_SECONDS", "5"))
+MAX_PROBE = 16
+WAIT_STEP = 0.01
+READ_RETRIES = 1000
+EMPTY = b"\0" * 16
+
+MAGIC = b"QSLT"
+VERSION = 1
+HEADER = struct.Struct("<4sII52x")                  # magic, version, slots
+SLOT = struct.Struct("<I16sdddI16x")                # seq, symbol, price, as_of, lease_until, lease_owner
+SLOT_SIZE = 64
+SEQ = struct.Struct("<I")
+assert HEADER.size == SLOT.size == SLOT_SIZE
+
+
+class SharedQuoteStore:
+    """
+    Fixed-slot quote table in a shared memory-mapped file.
+    slots only applies when the file is created; an existing table keeps
+    the slot count in its header, since other processes may have it mapped.
+    """
+
+    def __init__(self, path, slots=SHARED_QUOTES_SLOTS, owner=None):
+        self.path = path
+        self.owner = owner or os.getpid()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            with self._locked():
+                header = os.pread(self._fd, HEADER.size, 0)
+                if not header:
+                    os.ftruncate(self._fd, SLOT_SIZE * (slots + 1))
+                    os.pwrite(self._fd, HEADER.pack(MAGIC, VERSION, slots), 0)
+                else:
+                    slots = self._check_header(header)
+            self.slots = slots
+            self._map = mmap.mmap(self._fd, SLOT_SIZE * (slots + 1))
+        except BaseException:
+            os.close(self._fd)
+            raise
+
+    def _check_header(self, header):
+        """Slot count of an existing table; ValueError if it isn't one this code can share."""
+        if len(header) < HEADER.size:
+            raise ValueError(f"{self.path} is not a shared quote table (truncated header)")
+        magic, version, slots = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError(f"{self.path} is not a shared quote table")
+        if version != VERSION:
+            raise ValueError(f"{self.path} has table version {version}, expected {VERSION}; "
+                             f"stop the workers using it and remove the file")
+        if not slots or os.fstat(self._fd).st_size < SLOT_SIZE * (slots + 1):
+            raise ValueError(f"{self.path} is shorter than its {slots} slots")
+        return slots
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+    @contextmanager
+    def _locked(self):
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _offsets(self, key):
+        start = zlib.crc32(key) % self.slots
+        for probe in range(min(MAX_PROBE, self.slots)):
+            yield SLOT_SIZE * (1 + (start + probe) % self.slots)
+
+    def _read(self, offset):
+        """Consistent snapshot of the slot at offset (seqlock read)."""
+        for _ in range(READ_RETRIES):
+            seq, symbol, price, as_of, lease_until, owner = SLOT.unpack_from(self._map, offset)
+            if seq & 1 == 0 and SEQ.unpack_from(self._map, offset)[0] == seq:
+                return symbol, price, as_of, lease_until, owner
+        # A writer died mid-update; treat the slot as stale until it's rewritten
+        return symbol, 0.0, 0.0, 0.0, 0
+
+    def _find(self, key):
+        for offset in self._offsets(key):
+            slot = self._read(offset)
+            if slot[0] == key:
+                return offset, slot
+            if slot[0] == EMPTY:
+                return None, None
+        return None, None
+
+    def _slot_for_write(self, key):
+        """Existing slot for key, else an empty one, else the stalest probed slot."""
+        victim, oldest = None, float("inf")
+        for offset in self._offsets(key):
+            symbol, _, as_of, lease_until, _ = self._read(offset)
+            if symbol == key or symbol == EMPTY:
+                return offset
+            if max(as_of, lease_until) < oldest:
+                victim, oldest = offset, max(as_of, lease_until)
+        return victim
+
+    def _write(self, offset, key, price, as_of, lease_until, owner):
+        # Odd while writing; starting from seq | 1 also heals a slot left odd by a crash
+        writing = (SEQ.unpack_from(self._map, offset)[0] | 1) & 0xFFFFFFFF
+        SEQ.pack_into(self._map, offset, writing)
+        SLOT.pack_into(self._map, offset, writing, key, price, as_of, lease_until, owner)
+        SEQ.pack_into(self._map, offset, (writing + 1) & 0xFFFFFFFF)
+
+    @staticmethod
+    def _key(symbol):
+        return symbol.upper().encode()[:16].ljust(16, b"\0")
+
+    def get(self, symbol, max_age):
+        """The stored quote if at most max_age seconds old, else None. Lock-free."""
+        offset, slot = self._find(self._key(symbol))
+        if slot is None or not slot[2] or time.time() - slot[2] > max_age:
+            return None
+        name = symbol.upper()
+        return {"name": name, "symbol": name, "price": slot[1], "as_of": slot[2]}
+
+    def put(self, symbol, price, as_of=None):
+        """Store a quote and release any lease on the symbol."""
+        key = self._key(symbol)
+        with self._locked():
+            offset = self._slot_for_write(key)
+            self._write(offset, key, price, as_of or time.time(), 0.0, 0)
+
+    def lease(self, symbol, seconds=SHARED_LEASE_SECONDS):
+        """Claim the right to refresh symbol; False while another process holds it."""
+        key = self._key(symbol)
+        now = time.time()
+        with self._locked():
+            offset = self._slot_for_write(key)
+            stored, price, as_of, lease_until, owner = self._read(offset)
+            if stored != key:
+                price, as_of = 0.0, 0.0
+            elif lease_until > now and owner != self.owner:
+                return False
+            self._write(offset, key, price, as_of, now + seconds, self.owner)
+            return True
+
+    def release(self, symbol):
+        """Give up a lease without storing a quote (the refresh failed)."""
+        key = self._key(symbol)
+        with self._locked():
+            offset, slot = self._find(key)
+            if slot is not None and slot[4] == self.owner:
+                self._write(offset, key, slot[1], slot[2], 0.0, 0)
+
+    def wait_for(self, symbol, newer_than, timeout=SHARED_LEASE_SECONDS):
+        """
+        Wait for another process's refresh: returns the quote once one newer
+        than newer_than is stored, or None when the lease ends without one.
+        """
+        key = self._key(symbol)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            offset, slot = self._find(key)
+            if slot is not None and slot[2] > newer_than:
+                name = symbol.upper()
+                return {"name": name, "symbol": name, "price": slot[1], "as_of": slot[2]}
+            if slot is None or slot[3] < time.time():
+                return None
+            time.sleep(WAIT_STEP)
+        return None
+
+
+def open_shared_store(path=SHARED_QUOTES_PATH):
+    """
+    The host-wide store when SHARED_QUOTES_PATH is set (and fcntl exists),
+    else None. A file that can't be used as the table also disables it;
+    workers then fetch quotes independently.
+    """
+    if not path or fcntl is None:
+        return None
+    try:
+        return SharedQuoteStore(path)
+    except (OSError, ValueError) as e:
+        print(f"Shared quote store disabled: {e}")
+        return None
@@ -6,14 +6,14 @@ from werkzeug.security import generate_password_hash, check_password_hash
 # ======================================================
 # FIXTURES (Setup and Teardown)
 # ======================================================
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 import pytest
 
 @pytest.fixture(autouse=True)
 def mock_lookup():
     """This stops the tests from calling the real internet"""
     with patch("app.lookup") as mocked:
-        def side_effect(symbol):
+        def side_effect(symbol, **kwargs):
             if symbol.upper() == "AAPL":
                 return {"symbol": "AAPL", "price": 150.0, "name": "Apple Inc"}
             if symbol.upper() == "BRK.A":
@@ -21,6 +21,21 @@ def mock_lookup():
             return None
         mocked.side_effect = side_effect
         yield mocked
+
+
+@pytest.fixture(autouse=True)
+def reset_quote_state():
+    """Start every test with empty quote, price, analytics and profile caches."""
+    import helpers
+    from analytics import analytics_cache
+    from identity import profile_cache
+    helpers.quote_cache.clear()
+    helpers.price_store.clear()
+    analytics_cache.clear()
+    profile_cache.clear()
+    yield
+    helpers.quote_cache.clear()
+    helpers.price_store.clear()
         
         
 @pytest.fixture
@@ -98,6 +113,28 @@ def test_login_success(client):
     assert response.status_code == 200
     assert "access_token" in response.json
 
+def test_login_upgrades_hash_and_fails_fast_when_busy(client, auth_headers):
+    """Old-parameter hashes are replaced on login; a saturated hasher answers 503."""
+    from passwords import PasswordHasher
+
+    with app.app_context():
+        db = dbconnect()
+        db.get(User, 1).password_hash = generate_password_hash("Password123!", "pbkdf2:sha256:1000")
+        db.commit()
+        db.close()
+    credentials = {"username_or_email": "tester", "password": "Password123!"}
+    assert client.post('/api/login', json=credentials).status_code == 200
+    with app.app_context():
+        db = dbconnect()
+        stored = db.get(User, 1).password_hash
+        db.close()
+    assert stored.startswith("scrypt:") and check_password_hash(stored, "Password123!")
+    assert client.post('/api/login', json=dict(credentials, password="wrong")).status_code == 401
+
+    with patch("app.hasher", PasswordHasher(workers=1, queue_max=0)):
+        response = client.post('/api/login', json=credentials)
+    assert response.status_code == 503
+
 def test_get_user_profile(client, auth_headers):
     """Test fetching protected user data using JWT."""
     response = client.get('/api/user', headers=auth_headers)
@@ -140,4 +177,1162 @@ def test_insufficient_funds(client, auth_headers):
     payload = {"symbol": "BRK.A", "quantity": 15000}  # Assuming this exceeds available cash
     response = client.post('/api/buy', json=payload, headers=auth_headers)
     assert response.status_code == 400
-    assert response.json['error'] == "Insufficient funds"
\ No newline at end of file
+    assert response.json['error'] == "Insufficient funds"
+
+
+def test_quote_cache_coalesces_concurrent_misses():
+    """N concurrent misses for one symbol should make a single upstream call."""
+    import threading
+    import time
+    import helpers
+
+    calls = []
+
+    def slow_fetch(symbol):
+        calls.append(symbol)
+        time.sleep(0.05)
+        return {"symbol": symbol, "price": 150.0, "name": symbol}
+
+    cache = helpers.QuoteCache(maxsize=8, ttl=60)
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(cache.get_or_fetch("aapl", slow_fetch)))
+        for _ in range(10)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert calls == ["AAPL"]
+    assert len(results) == 10 and all(r["price"] == 150.0 for r in results)
+    stats = cache.stats()
+    assert stats["misses"] == 1
+    assert stats["coalesced"] + stats["hits"] == 9
+
+def test_quote_cache_waiter_retries_throttle_at_its_own_priority():
+    """An order lookup that joined a throttled background fetch spends its own budget instead of failing."""
+    import threading
+    import time
+    import helpers
+
+    cache = helpers.QuoteCache(maxsize=8, ttl=60)
+    release = threading.Event()
+
+    def background_fetch(symbol):
+        release.wait(1)
+        raise helpers.UpstreamThrottled("background budget exhausted")
+
+    leader_errors = []
+    def background():
+        try:
+            cache.get_or_fetch("aapl", background_fetch, priority=helpers.PRIORITY_BACKGROUND)
+        except helpers.UpstreamThrottled as e:
+            leader_errors.append(e)
+    leader = threading.Thread(target=background)
+    leader.start()
+    while cache.stats()["misses"] == 0:
+        time.sleep(0.001)
+
+    results = []
+    order_fetch = lambda symbol: {"symbol": symbol, "price": 150.0, "name": symbol}
+    waiter = threading.Thread(target=lambda: results.append(
+        cache.get_or_fetch("AAPL", order_fetch, priority=helpers.PRIORITY_ORDER)))
+    waiter.start()
+    while cache.stats()["coalesced"] == 0:
+        time.sleep(0.001)
+    release.set()
+    leader.join()
+    waiter.join()
+    assert len(leader_errors) == 1
+    assert results[0]["price"] == 150.0
+
+def test_quote_cache_ttl_and_lru_eviction():
+    """Stale entries are refetched and the cache stays within its size bound."""
+    import helpers
+
+    fetch = lambda symbol: {"symbol": symbol, "price": 1.0, "name": symbol}
+    cache = helpers.QuoteCache(maxsize=2, ttl=60)
+    for symbol in ("AAPL", "MSFT", "AAPL", "IBM"):
+        cache.get_or_fetch(symbol, fetch)
+
+    stats = cache.stats()
+    assert stats["hits"] == 1
+    assert stats["evictions"] == 1
+    assert cache.get("MSFT") is None   # least recently used was evicted
+    assert cache.get("AAPL") is not None
+    # An order-execution lookup with max_age=0 must not accept the cached price
+    assert cache.get("AAPL", max_age=0) is None
+
+def test_lookup_many_bulk_timeout_is_not_fetched_twice():
+    """A late bulk call isn't repeated per symbol, and its result still lands in the cache."""
+    import threading
+    import time
+    import helpers
+
+    release = threading.Event()
+    def slow_bulk(params, priority):
+        release.wait(1)
+        return {"data": [{"symbol": "IBM", "close": "190.5"}]}
+
+    with patch.object(helpers, "BULK_QUOTES_ENABLED", True), \
+         patch("helpers._make_api_request", side_effect=slow_bulk), \
+         patch("helpers.lookup") as single:
+        quotes = helpers.lookup_many(["ibm"], deadline=0.05, mark_unavailable=True)
+        release.set()
+        assert quotes == {"IBM": helpers.QUOTE_UNAVAILABLE}
+        assert single.call_count == 0
+        for _ in range(100):
+            if helpers.quote_cache.get("IBM"):
+                break
+            time.sleep(0.01)
+    assert helpers.quote_cache.get("IBM")["price"] == 190.5
+
+def test_lookup_many_parallel_with_deadline():
+    """Batch lookups run in parallel and never wait past the deadline."""
+    import time
+    import helpers
+
+    def fetch(symbol, priority=None):
+        time.sleep(2.0 if symbol == "SLOW" else 0.1)
+        return {"symbol": symbol, "price": 10.0, "name": symbol}
+
+    helpers.quote_cache.clear()
+    with patch("helpers._fetch_quote", side_effect=fetch):
+        started = time.monotonic()
+        quotes = helpers.lookup_many(["aa", "bb", "cc", "dd", "SLOW"], deadline=0.5)
+        elapsed = time.monotonic() - started
+
+    assert elapsed < 1.0
+    assert quotes["SLOW"] is None
+    assert all(quotes[s]["price"] == 10.0 for s in ("AA", "BB", "CC", "DD"))
+    helpers.quote_cache.clear()
+
+def test_market_snapshot_falls_back_to_mock_prices(client):
+    """Symbols without an upstream price use the built-in fallback prices."""
+    import helpers
+
+    helpers.quote_cache.clear()
+    def fetch(symbol, priority=None):
+        return {"symbol": symbol, "price": 99.0, "name": symbol} if symbol == "AAPL" else None
+
+    with patch("helpers._fetch_quote", side_effect=fetch):
+        response = client.get('/api/market-snapshot')
+
+    prices = {s["symbol"]: s["price"] for s in response.json}
+    assert prices["AAPL"] == 99.0
+    assert prices["MSFT"] == 415.50
+    helpers.quote_cache.clear()
+
+def test_upstream_client_retries_then_detects_throttle(monkeypatch):
+    """Transient errors are retried; throttle notes raise UpstreamThrottled."""
+    import requests
+    import helpers
+
+    monkeypatch.setenv("API_KEY", "demo")
+    client = helpers.UpstreamClient(max_retries=2, backoff=0)
+    throttled = requests.Response()
+    throttled.status_code = 200
+    throttled._content = b'{"Note": "Thank you for using Alpha Vantage!"}'
+
+    with patch.object(client.session, "get",
+                      side_effect=[requests.ConnectionError("reset"), throttled]) as get:
+        with pytest.raises(helpers.UpstreamThrottled):
+            client.get_json({"function": "GLOBAL_QUOTE", "symbol": "AAPL"})
+    assert get.call_count == 2
+    assert get.call_args.kwargs["params"]["apikey"] == "demo"
+    assert get.call_args.kwargs["timeout"] == client.timeout
+
+    too_many = requests.Response()
+    too_many.status_code = 429
+    with patch.object(client.session, "get", return_value=too_many) as get:
+        with pytest.raises(helpers.UpstreamThrottled):
+            client.get_json({"function": "GLOBAL_QUOTE", "symbol": "AAPL"})
+    assert get.call_count == 1                  # throttling is never retried
+
+    # Each retry is charged to the budget, and stops when the budget says no
+    budget = MagicMock(side_effect=[True, False])
+    with patch.object(client.session, "get", side_effect=requests.ConnectionError("reset")) as get:
+        with pytest.raises(requests.ConnectionError):
+            client.get_json({"function": "GLOBAL_QUOTE", "symbol": "AAPL"}, budget)
+    assert get.call_count == 2 and budget.call_count == 2
+
+def test_scheduler_keeps_budget_for_orders():
+    """Background calls leave a reserve that only order execution may spend."""
+    import helpers
+
+    scheduler = helpers.UpstreamScheduler(per_minute=2, per_day=100)
+    assert scheduler.acquire(helpers.PRIORITY_BACKGROUND)
+    assert not scheduler.acquire(helpers.PRIORITY_BACKGROUND)
+    assert scheduler.acquire(helpers.PRIORITY_ORDER, max_wait=0)
+    assert not scheduler.acquire(helpers.PRIORITY_ORDER, max_wait=0)
+    assert scheduler.stats()["throttled"][helpers.PRIORITY_BACKGROUND] == 1
+
+    daily = helpers.UpstreamScheduler(per_minute=60, per_day=1)
+    assert daily.acquire(helpers.PRIORITY_ORDER)
+    assert not daily.acquire(helpers.PRIORITY_ORDER, max_wait=0)
+
+def test_scheduler_tickets_wait_without_polling():
+    """Queued tickets get a wait time in priority order; the async path sleeps it once instead of polling."""
+    import asyncio
+    from unittest.mock import AsyncMock
+    import asyncupstream
+    import helpers
+
+    scheduler = helpers.UpstreamScheduler(per_minute=60, per_day=1000)
+    scheduler.tokens = 0.0
+    quote = scheduler.enqueue(helpers.PRIORITY_QUOTE)
+    order = scheduler.enqueue(helpers.PRIORITY_ORDER)
+    assert 0 < scheduler.try_acquire(order) < scheduler.try_acquire(quote)
+    scheduler.tokens = 60.0
+    assert scheduler.try_acquire(quote) > 0                 # the order ticket goes first
+    assert scheduler.try_acquire(order) == 0
+    assert scheduler.try_acquire(quote) == 0
+    scheduler.cancel(quote)
+    assert scheduler.stats()["queued"] == 0 and scheduler.stats()["throttled"][helpers.PRIORITY_QUOTE] == 0
+
+    scheduler.tokens = 0.0
+    refill = lambda seconds: setattr(scheduler, "tokens", 60.0)
+    with patch.object(asyncupstream, "scheduler", scheduler), \
+         patch("asyncupstream.asyncio.sleep", AsyncMock(side_effect=refill)) as sleep:
+        assert asyncio.run(asyncupstream.acquire_budget(helpers.PRIORITY_ORDER))
+    assert sleep.await_count == 1 and 0.9 < sleep.await_args[0][0] <= 1.0
+    assert scheduler.stats()["queued"] == 0
+
+def test_quote_throttled_returns_503(client, auth_headers, mock_lookup):
+    """A throttled lookup is reported as such, not as an invalid symbol."""
+    import helpers
+
+    mock_lookup.side_effect = helpers.UpstreamThrottled("budget exhausted")
+    response = client.post('/api/quote', json={"symbol": "AAPL"}, headers=auth_headers)
+    assert response.status_code == 503
+    assert response.json['error'] == helpers.THROTTLED
+
+    response = client.post('/api/buy', json={"symbol": "AAPL", "quantity": 1}, headers=auth_headers)
+    assert response.status_code == 503
+
+def test_sessions_are_request_scoped(client):
+    """Each thread gets its own session, and teardown releases it."""
+    import threading
+    from model import db_session, engine
+
+    sessions = []
+    def grab():
+        sessions.append(db_session())
+        db_session.remove()
+    threads = [threading.Thread(target=grab) for _ in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sessions[0] is not sessions[1]
+
+    if engine.dialect.name == 'sqlite':
+        with engine.connect() as conn:
+            assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+
+    main_session = db_session()
+    with app.app_context():
+        pass
+    assert db_session() is not main_session
+
+def test_migrate_db_adds_indexes_and_merges_positions(tmp_path):
+    """An old database without indexes is upgraded in place."""
+    from sqlalchemy import create_engine, inspect, text
+    from model import migrate_db
+
+    old = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with old.begin() as conn:
+        conn.execute(text("CREATE TABLE portfolio (id INTEGER PRIMARY KEY, user_id INTEGER, "
+                          "symbol VARCHAR(15), quantity INTEGER, price NUMERIC(10, 2))"))
+        conn.execute(text("INSERT INTO portfolio (user_id, symbol, quantity, price) "
+                          "VALUES (1, 'AAPL', 2, 100), (1, 'AAPL', 3, 120), (1, 'IBM', 1, 50)"))
+        conn.execute(text("CREATE TABLE user (id INTEGER PRIMARY KEY, full_names VARCHAR(255), "
+                          "username VARCHAR(255), email VARCHAR(255), password_hash VARCHAR(1000), "
+                          "cash NUMERIC(15, 2), create_date DATETIME)"))
+        conn.execute(text("INSERT INTO user (username, email) VALUES ('old', 'old@example.com')"))
+
+    migrate_db(old)
+    migrate_db(old)  # idempotent
+
+    inspector = inspect(old)
+    assert "uq_portfolio_user_symbol" in {ix["name"] for ix in inspector.get_indexes("portfolio")}
+    assert "ix_transactions_user_ts_id" in {ix["name"] for ix in inspector.get_indexes("transactions")}
+    with old.connect() as conn:
+        rows = conn.execute(text("SELECT symbol, quantity, price FROM portfolio ORDER BY symbol")).all()
+    assert [(r[0], r[1], float(r[2])) for r in rows] == [("AAPL", 5, 120.0), ("IBM", 1, 50.0)]
+    with old.connect() as conn:
+        assert conn.execute(text("SELECT is_admin, version FROM user")).one() == (0, 0)
+    old.dispose()
+
+    # Added columns get their defaults in the target dialect's syntax
+    from sqlalchemy.dialects import postgresql
+    from model import User
+    compiler = postgresql.dialect().ddl_compiler(postgresql.dialect(), None)
+    assert compiler.get_column_default_string(User.__table__.c.is_admin) == "false"
+
+def _seed_transactions(count, user_id=1):
+    from datetime import datetime, timedelta
+    from model import Transaction
+
+    db = dbconnect()
+    base = datetime(2024, 1, 1, 9, 30)
+    for i in range(count):
+        db.add(Transaction(user_id=user_id, symbol="AAPL" if i % 2 else "IBM", quantity=1,
+                           price=100 + i, transaction_type="BUY" if i % 3 else "SELL",
+                           # pairs of rows share a timestamp to exercise the id tie-breaker
+                           timestamp=base + timedelta(minutes=i // 2)))
+    db.commit()
+    db.close()
+
+def test_history_keyset_pagination(client, auth_headers):
+    """Pages follow next_cursor without gaps or duplicates."""
+    _seed_transactions(25)
+    seen = []
+    cursor = None
+    while True:
+        query = "/api/history?limit=10" + (f"&cursor={cursor}" if cursor else "")
+        response = client.get(query, headers=auth_headers)
+        assert response.status_code == 200
+        seen.extend(t["id"] for t in response.json["transactions"])
+        cursor = response.json["next_cursor"]
+        if not cursor:
+            break
+    assert seen == sorted(range(1, 26), key=lambda i: ((i - 1) // 2, i), reverse=True)
+
+    response = client.get("/api/history?limit=5&symbol=aapl&type=buy", headers=auth_headers)
+    assert all(t["symbol"] == "AAPL" and t["transaction_type"] == "BUY"
+               for t in response.json["transactions"])
+    assert client.get("/api/history?cursor=garbage", headers=auth_headers).status_code == 400
+
+def test_history_streaming_modes(client, auth_headers):
+    """The default response streams the full list; ndjson streams one row per line."""
+    import json
+    _seed_transactions(7)
+
+    response = client.get("/api/history", headers=auth_headers)
+    assert response.is_streamed
+    assert len(response.json["transactions"]) == 7
+
+    response = client.get("/api/history?format=ndjson&end=2024-01-01", headers=auth_headers)
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert len(lines) == 7
+    assert lines[0]["timestamp"] >= lines[-1]["timestamp"]
+
+def test_import_then_export_ledger(client, auth_headers):
+    """Imported trades rebuild positions and round-trip through the export."""
+    import csv
+    import io
+    import json
+
+    upload = (
+        "symbol,quantity,price,transaction_type,timestamp\n"
+        "aapl,10,100.50,BUY,2020-01-02T10:00:00\n"
+        "AAPL,4,120,SELL,2020-03-02T10:00:00\n"
+        "IBM,3,90,BUY,2020-02-02 10:00:00\n"
+        "MSFT,2,50,buy,2020-02-03\n"
+        "MSFT,2,55,SELL,2020-02-04\n"
+    )
+    response = client.post('/api/import/transactions', data=upload,
+                           content_type="text/csv", headers=auth_headers)
+    assert response.status_code == 200
+    assert response.json == {"imported": 5, "positions_rebuilt": 2}
+
+    holdings = {h["symbol"]: h["quantity"] for h in
+                client.get('/api/portfolio', headers=auth_headers).json["holdings"]}
+    assert holdings == {"AAPL": 6, "IBM": 3}
+
+    response = client.get('/api/export/transactions', headers=auth_headers)
+    rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+    assert [r["symbol"] for r in rows] == ["AAPL", "IBM", "MSFT", "MSFT", "AAPL"]
+    assert response.headers["Content-Disposition"].endswith("transactions.csv")
+
+    response = client.get('/api/export/transactions?format=ndjson&symbol=IBM', headers=auth_headers)
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert len(lines) == 1 and lines[0]["quantity"] == 3
+
+    assert client.get('/api/export/transactions?scope=all', headers=auth_headers).status_code == 403
+
+def test_import_rejects_invalid_rows_atomically(client, auth_headers):
+    """A bad row or an oversell rejects the whole file."""
+    import io
+
+    upload = ('{"symbol": "AAPL", "quantity": 1, "price": 10, "type": "BUY", "timestamp": "2020-01-01"}\n'
+              '{"symbol": "AAPL", "quantity": -1, "price": 10, "type": "BUY", "timestamp": "2020-01-01"}\n')
+    response = client.post('/api/import/transactions', headers=auth_headers,
+                           data={"file": (io.BytesIO(upload.encode()), "trades.ndjson")},
+                           content_type="multipart/form-data")
+    assert response.status_code == 400
+    assert response.json["details"][0]["line"] == 2
+
+    oversell = "symbol,quantity,price,transaction_type,timestamp\nAAPL,1,10,SELL,2020-01-01\n"
+    response = client.post('/api/import/transactions', data=oversell,
+                           content_type="text/csv", headers=auth_headers)
+    assert response.status_code == 400
+    assert client.get('/api/history', headers=auth_headers).json["transactions"] == []
+
+    # Batches already committed are removed again when a later row is rejected
+    late_error = ("symbol,quantity,price,transaction_type,timestamp\n"
+                  "AAPL,1,10,BUY,2020-01-01\nAAPL,1,10,BUY,2020-01-02\nAAPL,x,10,BUY,2020-01-03\n")
+    with patch("ledger.IMPORT_BATCH_SIZE", 1):
+        response = client.post('/api/import/transactions', data=late_error,
+                               content_type="text/csv", headers=auth_headers)
+    assert response.status_code == 400 and response.json["details"][0]["line"] == 4
+    assert client.get('/api/history', headers=auth_headers).json["transactions"] == []
+
+    fractional = '{"symbol": "AAPL", "quantity": 1.5, "price": 10, "type": "BUY", "timestamp": "2020-01-01"}\n'
+    response = client.post('/api/import/transactions', data=fractional,
+                           content_type="application/x-ndjson", headers=auth_headers)
+    assert response.status_code == 400
+    assert response.json["details"][0]["error"] == "quantity must be a whole number"
+    whole = "symbol,quantity,price,transaction_type,timestamp\nAAPL,2.0,10,BUY,2020-01-01\n"
+    response = client.post('/api/import/transactions', data=whole, content_type="text/csv", headers=auth_headers)
+    assert response.status_code == 200 and response.json["imported"] == 1
+
+def test_portfolio_market_valuation(client, auth_headers):
+    """valuation=market prices all holdings in one batch with P&L and staleness."""
+    import time
+    import helpers
+
+    client.post('/api/buy', json={"symbol": "AAPL", "quantity": 2}, headers=auth_headers)
+    helpers.quote_cache.clear()
+    with patch("app.lookup_many",
+               return_value={"AAPL": {"symbol": "AAPL", "price": 160.0, "as_of": time.time()}}) as batch:
+        response = client.get('/api/portfolio?valuation=market', headers=auth_headers)
+    assert batch.call_count == 1
+
+    holding = response.json["holdings"][0]
+    assert holding["current_price"] == 160.0
+    assert holding["avg_price"] == 150.0
+    assert holding["unrealized_pnl"] == 20.0
+    assert holding["stale"] is False
+    assert response.json["total_value"] == 10000 - 300 + 320
+
+    with patch("app.lookup_many", return_value={"AAPL": None}):
+        holding = client.get('/api/portfolio?valuation=market', headers=auth_headers).json["holdings"][0]
+    assert holding["price_source"] == "book" and holding["stale"] is True
+
+def test_position_aggregates_track_average_cost_and_realized_pnl(client, auth_headers, mock_lookup):
+    """Buys average the cost, sells realize P&L, and the ledger replay agrees."""
+    from model import engine, Portfolio
+    from positions import verify_positions, rebuild_positions
+
+    prices = iter([100.0, 130.0, 160.0, 90.0])
+    mock_lookup.side_effect = lambda symbol, **kwargs: {"symbol": "AAPL", "price": next(prices), "name": "Apple"}
+    client.post('/api/buy', json={"symbol": "AAPL", "quantity": 1}, headers=auth_headers)
+    client.post('/api/buy', json={"symbol": "AAPL", "quantity": 3}, headers=auth_headers)
+
+    holding = client.get('/api/portfolio', headers=auth_headers).json["holdings"][0]
+    assert holding["avg_price"] == 122.5
+    assert holding["cost_basis"] == 490.0
+
+    client.post('/api/sell', json={"symbol": "AAPL", "quantity": 2}, headers=auth_headers)
+    client.post('/api/sell', json={"symbol": "AAPL", "quantity": 2}, headers=auth_headers)
+
+    portfolio = client.get('/api/portfolio', headers=auth_headers).json
+    assert portfolio["holdings"] == []
+    assert portfolio["realized_pnl"] == (160 - 122.5) * 2 + (90 - 122.5) * 2
+
+    with engine.begin() as conn:
+        assert verify_positions(conn) == []
+        conn.execute(Portfolio.__table__.update().values(realized_pnl=0))
+        assert len(verify_positions(conn)) == 1
+        rebuild_positions(conn, user_id=1)
+        assert verify_positions(conn) == []
+
+def test_price_feed_conflates_and_replays():
+    """Slow subscribers keep only the latest price; reconnects replay missed events."""
+    from pricefeed import PriceFeed
+
+    feed = PriceFeed()
+    sub = feed.subscribe(["AAPL"])
+    feed.publish("AAPL", 1.0)
+    feed.publish("MSFT", 9.0)    # not subscribed
+    feed.publish("AAPL", 2.0)
+    feed.publish("AAPL", 2.0)    # unchanged prices are not republished
+    events = sub.next_events(timeout=0)
+    assert [(e.symbol, e.price) for e in events] == [("AAPL", 2.0)]
+    assert sub.conflated == 1
+    last_seen = events[-1].id
+    sub.close()
+
+    feed.publish("AAPL", 3.0)
+    feed.publish("AAPL", 4.0)
+    resumed = feed.subscribe(["AAPL"], last_event_id=last_seen)
+    assert [e.price for e in resumed.next_events(timeout=0)] == [4.0]
+    fresh = feed.subscribe(["AAPL", "MSFT"])
+    assert sorted(e.symbol for e in fresh.next_events(timeout=0)) == ["AAPL", "MSFT"]
+    assert feed.stats()["subscribers"] == 2
+
+def test_price_stream_endpoint(client):
+    """The SSE endpoint sends the retry hint and the latest price for its symbols."""
+    import app as app_module
+
+    app_module.price_feed.publish("IBM", 190.5)
+    response = client.get('/api/stream/prices?symbols=ibm', buffered=False)
+    assert response.mimetype == "text/event-stream"
+    chunks = response.response
+    assert next(chunks).startswith(b"retry:")
+    frame = next(chunks).decode()
+    response.close()
+    assert "event: price" in frame and '"symbol": "IBM"' in frame
+    assert app_module.price_feed.stats()["subscribers"] == 0
+
+def test_lookup_served_from_price_store():
+    """Warm symbols are answered from the price store without an upstream call."""
+    import helpers
+
+    helpers.price_store.put("IBM", 190.0)
+    with patch("helpers._fetch_quote") as fetch:
+        quote = helpers.lookup("ibm", max_age=5)
+    assert fetch.call_count == 0
+    assert quote["price"] == 190.0
+    assert helpers.price_store.heat("IBM") > 0.9
+    assert "IBM" in helpers.price_store.recent_symbols()
+
+    with patch("helpers._fetch_quote", return_value=None):
+        assert helpers.lookup("NOPE") is None
+    assert helpers.price_store.heat("NOPE") == 0.0          # failed lookups don't claim a slot
+    assert helpers.price_store.stats()["symbols"] == 1
+
+    small = helpers.PriceStore(capacity=2)
+    with patch("helpers.time") as clock:
+        clock.time.side_effect = [1.0, 2.0, 3.0, 4.0]
+        small.put("A", 1.0)
+        small.put("B", 2.0)
+        small.put("A", 1.5)      # refresher writes count as access
+        small.put("C", 3.0)      # reuses the least recently accessed slot (B)
+    assert small.get("A", float("inf"), record=False)["price"] == 1.5
+    assert small.get("B", float("inf"), record=False) is None
+
+def test_refresher_refreshes_due_symbols_within_budget():
+    """The refresher fetches stale hot symbols, skips fresh ones and backs off failures."""
+    import helpers
+    from marketdata import MarketDataRefresher
+    from pricefeed import PriceFeed
+
+    feed = PriceFeed()
+    refresher = MarketDataRefresher(feed)
+    refresher.add_source(lambda: ["AAPL", "MSFT", "NOPE"], 30)
+    helpers.price_store.put("MSFT", 400.0)     # fresh already
+
+    def refresh(symbols, priority=None, **kwargs):
+        return {s: {"symbol": s, "price": 151.0, "as_of": None} for s in symbols if s == "AAPL"}
+
+    with patch.object(helpers.scheduler, "sustainable_rate", return_value=1.0), \
+         patch("marketdata.refresh_quotes", side_effect=refresh) as fetch:
+        assert refresher.refresh_once() == ["AAPL"]
+        assert sorted(fetch.call_args[0][0]) == ["AAPL", "NOPE"]
+        assert feed.latest("AAPL") == 151.0
+        assert feed.latest("MSFT") == 400.0          # fresh prices are published without a fetch
+        assert refresher.refresh_once() == []       # nothing due yet
+        assert refresher.failed == 1
+
+    with patch.object(helpers.scheduler, "sustainable_rate", return_value=0.01):
+        intervals = refresher.intervals()
+    # 3 symbols every 30s = 0.1 calls/s, stretched to fit half of 0.01 calls/s
+    assert intervals["AAPL"] == pytest.approx(600.0)
+
+
+def test_concurrent_orders_never_overspend_or_oversell(client, auth_headers):
+    """Parallel buys and sells keep cash, shares and the ledger consistent."""
+    from concurrent.futures import ThreadPoolExecutor
+    import app as app_module
+    from model import db_session, engine, Portfolio, Transaction
+    from positions import verify_positions
+
+    def hammer(trade, attempts):
+        try:
+            return [trade(1, "AAPL", 1) for _ in range(attempts)]
+        finally:
+            db_session.remove()
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = sum(pool.map(hammer, [app_module.buy_for_user] * 8, [12] * 8), [])
+    bought = results.count("success")
+    assert bought == 66                               # 10000 // 150
+    assert set(results) == {"success", "Insufficient funds"}
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = sum(pool.map(hammer, [app_module.sell_for_user] * 8, [10] * 8), [])
+    assert results.count("success") == bought
+
+    db = dbconnect()
+    user = db.get(User, 1)
+    position = db.query(Portfolio).filter_by(user_id=1, symbol="AAPL").one()
+    assert float(user.cash) == 10000.0
+    assert position.quantity == 0
+    assert db.query(Transaction).count() == 2 * bought
+    db.close()
+    with engine.connect() as conn:
+        assert verify_positions(conn) == []
+
+def test_batch_orders_single_commit_all_or_nothing(client, auth_headers):
+    """A batch prices once, commits once, and rolls back entirely on any bad order."""
+    from sqlalchemy import event
+    from model import SessionLocal, Transaction
+
+    quotes = {"AAPL": {"symbol": "AAPL", "price": 150.0}, "MSFT": {"symbol": "MSFT", "price": 400.0}}
+    commits = []
+    listener = lambda session: commits.append(session)
+    event.listen(SessionLocal, "after_commit", listener)
+    try:
+        with patch("app.lookup_many", return_value=quotes) as batch:
+            response = client.post('/api/orders/batch', headers=auth_headers, json={"orders": [
+                {"symbol": "aapl", "side": "buy", "quantity": 20},
+                {"symbol": "AAPL", "side": "sell", "quantity": 5},
+                {"symbol": "MSFT", "side": "buy", "quantity": 10},
+            ]})
+    finally:
+        event.remove(SessionLocal, "after_commit", listener)
+    assert response.status_code == 200
+    assert batch.call_count == 1 and len(commits) == 1
+    assert [r["status"] for r in response.json["results"]] == ["filled"] * 3
+    assert response.json["new_balance"] == 10000 - 3000 + 750 - 4000
+
+    with patch("app.lookup_many", return_value=quotes):
+        response = client.post('/api/orders/batch', headers=auth_headers, json={"orders": [
+            {"symbol": "AAPL", "side": "SELL", "quantity": 15},
+            {"symbol": "MSFT", "side": "BUY", "quantity": 100},
+            {"symbol": "AAPL", "side": "HOLD", "quantity": 1},
+        ]})
+    assert response.status_code == 400
+    assert [r["status"] for r in response.json["results"]] == ["not_executed", "rejected", "rejected"]
+    assert response.json["results"][1]["error"] == "Insufficient funds"
+    db = dbconnect()
+    assert db.query(Transaction).count() == 3
+    assert float(db.get(User, 1).cash) == 3750.0
+    db.close()
+
+def test_trigger_engine_fires_only_crossed_orders():
+    """Ticks pop exactly the orders whose thresholds they cross."""
+    from orders import TriggerEngine
+
+    engine = TriggerEngine()
+    engine.add(1, "AAPL", "BUY", "LIMIT", 140)    # fires at <= 140
+    engine.add(2, "AAPL", "BUY", "LIMIT", 130)
+    engine.add(3, "AAPL", "SELL", "LIMIT", 170)   # fires at >= 170
+    engine.add(4, "AAPL", "BUY", "STOP", 160)     # fires at >= 160
+    engine.add(5, "AAPL", "SELL", "STOP", 120)    # fires at <= 120
+    engine.remove(2)
+
+    assert engine.on_price("AAPL", 150) == []
+    assert engine.on_price("MSFT", 1) == []
+    assert engine.on_price("aapl", 135) == [1]
+    assert engine.on_price("AAPL", 125) == []     # 2 was cancelled
+    assert sorted(engine.on_price("AAPL", 175)) == [3, 4]
+    assert engine.on_price("AAPL", 100) == [5]
+    assert len(engine) == 0
+
+def test_limit_order_lifecycle(client, auth_headers):
+    """Orders rest until a price crosses them, then fill through the trade path."""
+    import app as app_module
+
+    app_module.order_engine.clear()
+    with patch.object(app_module, "order_fills") as pool:
+        pool.submit.side_effect = lambda fn, *args, **kwargs: fn(*args, **kwargs)
+        response = client.post('/api/orders', headers=auth_headers, json={
+            "symbol": "AAPL", "side": "BUY", "type": "LIMIT", "quantity": 10, "trigger_price": 140})
+        assert response.status_code == 201 and response.json["status"] == "OPEN"
+        order_id = response.json["id"]
+        cancel_id = client.post('/api/orders', headers=auth_headers, json={
+            "symbol": "AAPL", "side": "SELL", "type": "STOP", "quantity": 1, "trigger_price": 100}).json["id"]
+        assert client.delete(f'/api/orders/{cancel_id}', headers=auth_headers).status_code == 200
+        assert client.delete(f'/api/orders/{cancel_id}', headers=auth_headers).status_code == 404
+
+        app_module.price_feed.publish("AAPL", 139.5)
+        app_module.price_feed.publish("AAPL", 99.0)
+
+    orders = {o["id"]: o for o in client.get('/api/orders', headers=auth_headers).json["orders"]}
+    assert orders[order_id]["status"] == "FILLED" and orders[order_id]["fill_price"] == 139.5
+    assert orders[cancel_id]["status"] == "CANCELLED"
+    assert client.get('/api/user', headers=auth_headers).json["cash"] == 10000 - 1395.0
+
+    bad = client.post('/api/orders', headers=auth_headers, json={
+        "symbol": "AAPL", "side": "BUY", "type": "MARKET", "quantity": 1, "trigger_price": 1})
+    assert bad.status_code == 400
+
+def test_order_loaded_by_two_workers_fills_once(client, auth_headers):
+    """The conditional claim lets only one process fill an order it saw OPEN."""
+    import orders
+    from model import PendingOrder
+
+    order_id = client.post('/api/orders', headers=auth_headers, json={
+        "symbol": "AAPL", "side": "BUY", "type": "LIMIT", "quantity": 10, "trigger_price": 140}).json["id"]
+    with dbconnect() as other_worker:
+        stale = other_worker.get(PendingOrder, order_id)
+        assert stale.status == "OPEN"
+        assert orders.fill_orders([order_id], 139.0) == {order_id: "success"}
+        assert orders.run_trade(other_worker, orders._fill, stale, 138.0) == "Order is no longer open"
+    assert client.get('/api/user', headers=auth_headers).json["cash"] == 10000 - 1390.0
+
+def test_fill_errors_requeue_the_order_and_continue(client, auth_headers):
+    """A fill that fails on a database error leaves the order OPEN and re-armed; later orders still fill."""
+    import orders
+    from sqlalchemy.exc import OperationalError
+
+    ids = [client.post('/api/orders', headers=auth_headers, json={
+        "symbol": "AAPL", "side": "BUY", "type": "LIMIT", "quantity": 1, "trigger_price": 140}).json["id"]
+        for _ in range(2)]
+    engine = orders.TriggerEngine()
+    real_run_trade = orders.run_trade
+    def flaky(session, trade, order, price):
+        if order.id == ids[0]:
+            raise OperationalError("UPDATE", {}, Exception("database is locked"))
+        return real_run_trade(session, trade, order, price)
+    with patch("orders.run_trade", side_effect=flaky):
+        outcomes = orders.fill_orders(ids, 139.0, engine=engine)
+    assert outcomes[ids[1]] == "success" and outcomes[ids[0]].startswith("error")
+    assert engine.on_price("AAPL", 139.0) == [ids[0]]
+    statuses = {o["id"]: o["status"] for o in client.get('/api/orders', headers=auth_headers).json["orders"]}
+    assert statuses == {ids[0]: "OPEN", ids[1]: "FILLED"}
+
+def test_alert_index_pops_crossed_range():
+    """Each tick pops only the thresholds it crossed; deletions leave no stale fires."""
+    import random
+    import time
+    from alerts import AlertIndex
+
+    index = AlertIndex()
+    index.add(1, "TSLA", "ABOVE", 200)
+    index.add(2, "TSLA", "ABOVE", 210)
+    index.add(3, "TSLA", "BELOW", 150)
+    index.add(4, "TSLA", "BELOW", 160)
+    assert index.remove(2, "TSLA", "ABOVE", 210)
+    assert index.on_price("TSLA", 180) == []
+    assert index.on_price("TSLA", 205) == [1]
+    assert index.on_price("TSLA", 220) == []
+    assert sorted(index.on_price("tsla", 140)) == [3, 4]
+    assert len(index) == 0
+
+    big = AlertIndex()
+    big.load((i, "AAPL", random.choice(("ABOVE", "BELOW")), random.uniform(50, 250))
+             for i in range(1, 200_001))
+    assert big.stats()["bytes"] == 200_000 * 16
+    started = time.perf_counter()
+    fired = big.on_price("AAPL", 150.5)
+    assert time.perf_counter() - started < 0.5
+    assert 80_000 < len(fired) < 120_000       # everything already on the far side fires once
+    assert big.on_price("AAPL", 150.5) == []
+
+def test_alert_endpoints_and_notifications(client, auth_headers):
+    """Alerts pick a direction from the current price and are delivered once after firing."""
+    import app as app_module
+
+    app_module.alert_index.clear()
+    up = client.post('/api/alerts', headers=auth_headers, json={"symbol": "aapl", "threshold": 160})
+    down = client.post('/api/alerts', headers=auth_headers, json={"symbol": "AAPL", "threshold": 140})
+    assert up.status_code == 201 and up.json["direction"] == "ABOVE"
+    assert down.json["direction"] == "BELOW"
+    assert client.delete(f'/api/alerts/{down.json["id"]}', headers=auth_headers).status_code == 200
+    assert client.post('/api/alerts', headers=auth_headers,
+                       json={"symbol": "AAPL", "threshold": -1}).status_code == 400
+
+    with patch.object(app_module, "alert_delivery") as pool:
+        pool.submit.side_effect = lambda fn, *args: fn(*args)
+        app_module.price_feed.publish("AAPL", 139.0)   # the deleted alert doesn't fire
+        app_module.price_feed.publish("AAPL", 161.0)
+
+    notes = client.get('/api/alerts/notifications', headers=auth_headers).json["notifications"]
+    assert [(n["id"], n["triggered_price"]) for n in notes] == [(up.json["id"], 161.0)]
+    assert client.get('/api/alerts/notifications', headers=auth_headers).json["notifications"] == []
+    statuses = [a["status"] for a in client.get('/api/alerts', headers=auth_headers).json["alerts"]]
+    assert statuses == ["TRIGGERED"]
+
+def _daily_series(closes):
+    """Fake TIME_SERIES_DAILY payload for {iso_date: close}."""
+    return {"Time Series (Daily)": {
+        day: {"1. open": str(c), "2. high": str(c + 1), "3. low": str(c - 1), "4. close": str(c), "5. volume": "1000"}
+        for day, c in closes.items()
+    }}
+
+def test_price_history_appends_incrementally_and_slices_zero_copy(tmp_path):
+    """Updates only append new days; range queries are views into the mapped file."""
+    import numpy as np
+    from pricehistory import PriceHistoryStore, CLOSE, DAY, to_day
+
+    fetch = MagicMock(return_value=_daily_series({"2024-01-02": 10.0, "2024-01-03": 11.0, "2024-01-04": 12.0}))
+    store = PriceHistoryStore(str(tmp_path), fetch=fetch)
+    assert store.update("aapl") == 3
+    assert fetch.call_args[0][0]["outputsize"] == "full"
+
+    fetch.return_value = _daily_series({"2024-01-04": 12.0, "2024-01-05": 13.0})
+    assert store.update("AAPL") == 0                        # refreshed recently
+    assert store.update("AAPL", force=True) == 1
+    assert fetch.call_count == 2
+
+    window = store.range("AAPL", "2024-01-03", "2024-01-04")
+    assert window[CLOSE].tolist() == [11.0, 12.0]
+    assert window[DAY, 0] == to_day("2024-01-03")
+    assert np.shares_memory(window, store.bars("AAPL"))
+    assert store.range("MSFT").shape == (6, 0)
+
+    # Symbols without bars are backed off too, although no file is written
+    fetch.return_value = {"Error Message": "Invalid API call"}
+    assert store.update("NOPE") == 0
+    assert store.update("nope") == 0
+    assert fetch.call_count == 3
+
+def test_price_history_endpoint(client, auth_headers, tmp_path):
+    """The endpoint serves stored bars for a date range."""
+    from pricehistory import PriceHistoryStore
+
+    store = PriceHistoryStore(str(tmp_path), fetch=lambda params: _daily_series(
+        {"2024-01-02": 10.0, "2024-01-03": 11.0}))
+    with patch("app.price_history", store):
+        response = client.get('/api/history/prices?symbol=aapl&start=2024-01-03', headers=auth_headers)
+        assert client.get('/api/history/prices?symbol=AAPL&start=01/03/2024',
+                          headers=auth_headers).status_code == 400
+    assert response.status_code == 200
+    assert response.json["bars"] == [
+        {"date": "2024-01-03", "open": 11.0, "high": 12.0, "low": 10.0, "close": 11.0, "volume": 1000}]
+
+def test_compute_analytics_metrics():
+    """TWR ignores trade cash flows; drawdown, beta and correlations come out of the grid."""
+    import numpy as np
+    from analytics import compute_analytics
+
+    days = np.array([0, 1, 2, 3])
+    series = {"AAA": (days, np.array([100.0, 110.0, 99.0, 108.9])),
+              "BBB": (days, np.array([50.0, 55.0, 49.5, 54.45]))}
+    # Buy 10 AAA on day 0, then 20 BBB on day 2 (a cash inflow, not a return)
+    result = compute_analytics(["AAA", "BBB"], np.array([0, 2]), np.array([0, 1]), np.array([10.0, 20.0]),
+                               np.array([100.0, 49.5]), series, benchmark=series["AAA"])
+    assert result["time_weighted_return"] == pytest.approx(0.089)
+    assert result["max_drawdown"] == pytest.approx(99 / 110 - 1)
+    assert result["beta"] == pytest.approx(1.0)
+    assert result["correlation"]["matrix"] == [[1.0, 1.0], [1.0, 1.0]]
+    assert [p["value"] for p in result["equity_curve"]] == [1000.0, 1100.0, 1980.0, 2178.0]
+
+def test_analytics_endpoint_cached_until_ledger_changes(client, auth_headers, tmp_path):
+    """Results are cached per user and recomputed after a new transaction."""
+    from datetime import date, timedelta
+    import numpy as np
+    import analytics
+    from pricehistory import PriceHistoryStore, to_day
+
+    store = PriceHistoryStore(str(tmp_path), fetch=lambda params: None)
+    today = to_day(date.today())
+    store.append("AAPL", np.array([[today - 1, today], [150, 150], [151, 151], [149, 149],
+                                   [150, 160], [1000, 1000]], dtype=float))
+    assert client.get('/api/analytics', headers=auth_headers).status_code == 404
+    client.post('/api/buy', json={"symbol": "AAPL", "quantity": 2}, headers=auth_headers)
+
+    with patch("analytics.price_history", store), patch("app.history_updates"), \
+         patch("analytics.compute_analytics", wraps=analytics.compute_analytics) as compute:
+        first = client.get('/api/analytics', headers=auth_headers).json
+        client.get('/api/analytics', headers=auth_headers)
+        assert compute.call_count == 1
+        client.post('/api/buy', json={"symbol": "AAPL", "quantity": 1}, headers=auth_headers)
+        client.get('/api/analytics', headers=auth_headers)
+        assert compute.call_count == 2
+        # Newly fetched history (here the benchmark's) also invalidates the entry
+        store.append(analytics.ANALYTICS_BENCHMARK, np.array([[today], [1], [1], [1], [1], [1]], dtype=float))
+        client.get('/api/analytics', headers=auth_headers)
+        assert compute.call_count == 3
+    assert first["equity_curve"][-1]["value"] == 320.0
+    assert first["missing_price_history"] == []
+
+def test_deleted_user_gets_404_from_trading_endpoints(client, auth_headers):
+    """A valid token for a user that no longer exists is refused instead of acting on nobody."""
+    with app.app_context():
+        db = dbconnect()
+        db.delete(db.get(User, 1))
+        db.commit()
+        db.close()
+    for method, path in (("get", "/api/analytics"), ("get", "/api/orders"), ("get", "/api/alerts"),
+                         ("post", "/api/orders/batch"), ("get", "/api/leaderboard/me")):
+        assert getattr(client, method)(path, headers=auth_headers).status_code == 404, path
+
+def test_indexable_skiplist_matches_sorted_list():
+    """Rank and slice queries agree with a plain sorted list under random churn."""
+    import random
+    from leaderboard import IndexableSkipList
+
+    skiplist, reference = IndexableSkipList(), []
+    for _ in range(2000):
+        key = (random.randint(-500, 500), random.randint(1, 50))
+        if key in reference:
+            skiplist.remove(key)
+            reference.remove(key)
+        else:
+            skiplist.insert(key)
+            reference.append(key)
+            reference.sort()
+    assert len(skiplist) == len(reference)
+    assert skiplist.slice(0, len(reference)) == reference
+    assert skiplist.slice(10, 20) == reference[10:20]
+    probe = reference[len(reference) // 2]
+    assert skiplist.rank(probe) == reference.index(probe)
+    with pytest.raises(KeyError):
+        skiplist.remove((9999, 0))
+
+def test_leaderboard_follows_trades_and_prices(client, auth_headers):
+    """Standings update on committed trades and on price moves of held symbols."""
+    import app as app_module
+    from werkzeug.security import generate_password_hash
+
+    db = dbconnect()
+    db.add(User(username="rival", email="rival@example.com", full_names="Rival",
+                password_hash=generate_password_hash("x"), cash=10100.0))
+    db.commit()
+    db.close()
+
+    app_module.leaderboard.loaded = False
+    leaders = client.get('/api/leaderboard').json
+    assert [e["username"] for e in leaders["leaders"]] == ["rival", "tester"]
+
+    client.post('/api/buy', json={"symbol": "AAPL", "quantity": 10}, headers=auth_headers)
+    with patch.object(app_module, "leaderboard_updates") as pool:
+        pool.submit.side_effect = lambda fn: fn()
+        app_module.price_feed.publish("AAPL", 170.0)   # tester: 8500 cash + 1700 stock
+    leaders = client.get('/api/leaderboard?limit=1').json
+    assert leaders["leaders"] == [{"rank": 1, "username": "tester", "net_worth": 10200.0}]
+    assert leaders["total"] == 2
+
+    me = client.get('/api/leaderboard/me?k=1', headers=auth_headers).json
+    assert me["rank"] == 1 and [e["username"] for e in me["entries"]] == ["tester", "rival"]
+    assert client.post('/api/leaderboard/rebuild', headers=auth_headers).status_code == 403
+    app_module.leaderboard.loaded = False
+
+def test_leaderboard_follows_ledger_imports(client, auth_headers):
+    """Imported holdings reach a loaded leaderboard, marked at their last traded price."""
+    import app as app_module
+
+    app_module.leaderboard.loaded = False
+    assert client.get('/api/leaderboard').json["leaders"][0]["net_worth"] == 10000.0
+    upload = "symbol,quantity,price,transaction_type,timestamp\nIBM,3,90,BUY,2020-02-02\n"
+    assert client.post('/api/import/transactions', data=upload, content_type="text/csv",
+                       headers=auth_headers).status_code == 200
+    assert client.get('/api/leaderboard').json["leaders"][0]["net_worth"] == 10270.0
+    app_module.leaderboard.loaded = False
+
+def test_dataset_cache_serves_stale_while_revalidating(tmp_path):
+    """One refresh runs in the background while stale data is served; failures keep the last good payload."""
+    import threading
+    import time
+    import helpers
+
+    cache = helpers.DatasetCache(str(tmp_path))
+    fetch = MagicMock(return_value=[{"symbol": "AAPL"}])
+    assert cache.get("trending", fetch, ttl=60) == [{"symbol": "AAPL"}]
+    assert cache.get("trending", fetch, ttl=60) == [{"symbol": "AAPL"}]
+    assert fetch.call_count == 1
+
+    # A new process (fresh instance) reads the persisted payload without fetching
+    other = helpers.DatasetCache(str(tmp_path))
+    assert other.get("trending", fetch, ttl=60) == [{"symbol": "AAPL"}]
+    assert fetch.call_count == 1
+
+    release = threading.Event()
+    def slow_failure():
+        release.wait(5)
+        return None
+    started = time.monotonic()
+    results = [other.get("trending", slow_failure, ttl=0) for _ in range(3)]
+    assert time.monotonic() - started < 1
+    assert results == [[{"symbol": "AAPL"}]] * 3
+    release.set()
+    for _ in range(100):
+        if not list(tmp_path.glob("*.lock")):
+            break
+        time.sleep(0.01)
+    # The failed refresh kept the payload and backs off further upstream calls
+    assert other.get("trending", fetch, ttl=0) == [{"symbol": "AAPL"}]
+    assert fetch.call_count == 1
+
+def test_trending_uses_dataset_cache(client, tmp_path):
+    """The public endpoint doesn't call upstream again while the payload is fresh."""
+    import helpers
+
+    payload = {"top_gainers": [{"ticker": "XYZ", "price": "1.5", "change_percentage": "9%"}], "top_losers": []}
+    with patch("helpers.dataset_cache", helpers.DatasetCache(str(tmp_path))), \
+         patch("helpers._make_api_request", return_value=payload) as upstream:
+        for _ in range(3):
+            response = client.get('/api/trending')
+    assert upstream.call_count == 1
+    assert response.json["stocks"] == [{"symbol": "XYZ", "price": 1.5, "change": "9%"}]
+
+def test_shared_quote_store_across_processes(tmp_path):
+    """Quotes and leases are visible to every process mapping the same file."""
+    import multiprocessing
+    import time
+    from sharedquotes import SharedQuoteStore, open_shared_store
+
+    path = str(tmp_path / "quotes.bin")
+    mine = SharedQuoteStore(path, slots=64, owner=1)
+    other = SharedQuoteStore(path, slots=64, owner=2)
+    mine.put("aapl", 150.0)
+    assert other.get("AAPL", 5)["price"] == 150.0
+    assert other.get("AAPL", -1) is None
+    assert other.get("MSFT", 5) is None
+
+    # Only one process refreshes a symbol; the other waits for its result
+    assert mine.lease("MSFT")
+    assert not other.lease("MSFT")
+    requested = time.time()
+    mine.put("MSFT", 400.0)
+    assert other.wait_for("MSFT", requested - 1, timeout=1)["price"] == 400.0
+    assert other.lease("IBM")
+    other.release("IBM")
+    assert mine.lease("IBM")
+    assert other.wait_for("IBM", time.time(), timeout=0.05) is None
+
+    ctx = multiprocessing.get_context("fork")
+    results = ctx.Queue()
+    def contend():
+        store = SharedQuoteStore(path, slots=64)
+        results.put(store.lease("TSLA"))
+    workers = [ctx.Process(target=contend) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(10)
+    assert sorted(results.get(timeout=1) for _ in workers) == [False, False, False, True]
+
+    # A worker configured with another slot count adopts the table instead of wiping it
+    resized = SharedQuoteStore(path, slots=128)
+    assert resized.slots == 64 and resized.get("AAPL", 5)["price"] == 150.0
+    resized.close()
+    stale = tmp_path / "stale.bin"
+    stale.write_bytes(b"QSLT" + (0).to_bytes(4, "little") * 2 + b"\0" * 52)
+    with pytest.raises(ValueError):
+        SharedQuoteStore(str(stale))
+    assert open_shared_store(str(stale)) is None
+    mine.close()
+    other.close()
+
+def test_lookup_uses_shared_quotes(tmp_path):
+    """A quote another worker published is served without an upstream call, and fetches are published."""
+    import helpers
+    from sharedquotes import SharedQuoteStore
+
+    store = SharedQuoteStore(str(tmp_path / "quotes.bin"), slots=64)
+    store.put("IBM", 190.0)
+    quote = {"name": "NVDA", "symbol": "NVDA", "price": 120.0, "as_of": None}
+    with patch("helpers.shared_quotes", store), \
+         patch("helpers._fetch_quote", return_value=quote) as fetch:
+        assert helpers.lookup("IBM")["price"] == 190.0
+        assert fetch.call_count == 0
+        assert helpers.price_store.get("IBM", 5)["price"] == 190.0
+        helpers.lookup("NVDA")
+    assert fetch.call_count == 1
+    assert store.get("NVDA", 5)["price"] == 120.0
+    store.close()
+
+def test_profile_cached_across_requests_but_cash_is_not(client, auth_headers):
+    """Profile fields come from the cache after the first request; cash always reflects trades."""
+    from identity import profile_cache
+
+    assert client.get('/api/user', headers=auth_headers).json["username"] == "tester"
+    assert profile_cache.stats()["misses"] == 1
+    client.post('/api/buy', json={"symbol": "AAPL", "quantity": 2}, headers=auth_headers)
+    response = client.get('/api/user', headers=auth_headers)
+    assert response.json["cash"] == 9700.0
+    assert profile_cache.stats() == {"size": 1, "hits": 1, "misses": 1}
+
+    # ORM writes to the user drop the cached profile
+    with app.app_context():
+        db = dbconnect()
+        db.get(User, 1).full_names = "Renamed"
+        db.commit()
+        db.close()
+    assert client.get('/api/user', headers=auth_headers).json["full_names"] == "Renamed"
+
+def test_conditional_get_with_user_version_etags(client, auth_headers):
+    """Unchanged portfolio, history and user payloads revalidate with 304 until a trade commits."""
+    first = {path: client.get(path, headers=auth_headers)
+             for path in ('/api/portfolio', '/api/history?limit=10', '/api/user')}
+    for path, response in first.items():
+        assert response.status_code == 200
+        assert response.headers["Cache-Control"] == "private, no-cache"
+        cached = dict(auth_headers, **{"If-None-Match": response.headers["ETag"]})
+        again = client.get(path, headers=cached)
+        assert again.status_code == 304 and again.data == b""
+
+    # A different history query is a different representation
+    other = client.get('/api/history?limit=5', headers=dict(auth_headers, **{
+        "If-None-Match": first['/api/history?limit=10'].headers["ETag"]}))
+    assert other.status_code == 200
+
+    client.post('/api/buy', json={"symbol": "AAPL", "quantity": 1}, headers=auth_headers)
+    for path, response in first.items():
+        cached = dict(auth_headers, **{"If-None-Match": response.headers["ETag"]})
+        assert client.get(path, headers=cached).status_code == 200
+
+    assert client.get('/api/portfolio?valuation=market', headers=auth_headers).headers["Cache-Control"] \
+        == "no-cache, no-store, must-revalidate"
+    assert client.get('/api/trending').headers["Cache-Control"].startswith("public")
+
+def test_lookup_async_coalesces_concurrent_misses():
+    """Many coroutines asking for a cold symbol share one upstream call and fill the sync caches."""
+    import asyncio
+    from unittest.mock import AsyncMock
+    import asyncupstream
+    import helpers
+
+    payload = {"Global Quote": {"01. symbol": "IBM", "05. price": "190.5"}}
+    async def slow_call(params, priority):
+        await asyncio.sleep(0.05)
+        return payload
+    async def run():
+        return await asyncio.gather(*(asyncupstream.lookup_async("ibm") for _ in range(200)))
+
+    with patch("asyncupstream.call_upstream_async", AsyncMock(side_effect=slow_call)) as upstream:
+        quotes = asyncio.run(run())
+        assert upstream.call_count == 1
+    assert {q["price"] for q in quotes} == {190.5}
+    assert helpers.price_store.get("IBM", 5)["price"] == 190.5
+
+    with patch("asyncupstream.call_upstream_async", AsyncMock(side_effect=helpers.UpstreamThrottled("x"))):
+        snapshot = asyncio.run(asyncupstream.lookup_many_async(["IBM", "MSFT"]))
+    assert snapshot["IBM"]["price"] == 190.5 and snapshot["MSFT"] is None
+
+def test_asgi_routes_quotes_async_and_the_rest_to_flask(client, auth_headers):
+    """The ASGI app answers quote routes itself and hands other routes to Flask."""
+    import asyncio
+    from unittest.mock import AsyncMock
+    import httpx
+    from asgi import application
+
+    quote = {"name": "AAPL", "symbol": "AAPL", "price": 151.0, "as_of": None}
+    with app.app_context():
+        ghost = {"Authorization": f"Bearer {create_access_token(identity='99')}"}   # no such user
+    async def run():
+        transport = httpx.ASGITransport(app=application)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            unauthenticated = await http.post("/api/quote", json={"symbol": "AAPL"})
+            with patch("asgi.lookup_async", AsyncMock(return_value=quote)):
+                quoted = await http.post("/api/quote", json={"symbol": "aapl"},
+                                         headers=dict(auth_headers, Origin="http://localhost:3000"))
+            user = await http.get("/api/user", headers=auth_headers)
+            deleted = await http.post("/api/quote", json={"symbol": "AAPL"}, headers=ghost)
+        return unauthenticated, quoted, user, deleted
+
+    unauthenticated, quoted, user, deleted = asyncio.run(run())
+    assert unauthenticated.status_code == 401
+    assert deleted.status_code == 404
+    assert client.post('/api/quote', json={"symbol": "AAPL"}, headers=ghost).status_code == 404
+    assert quoted.status_code == 200 and quoted.json() == {"name": "AAPL", "symbol": "AAPL", "price": 151.0}
+    assert quoted.headers["access-control-allow-origin"] == "http://localhost:3000"
+    assert user.status_code == 200 and user.json()["username"] == "tester"
+
+def test_batch_orders_throttled_quotes_answer_503(client, auth_headers):
+    """Orders that couldn't be priced in time are THROTTLED, not invalid symbols."""
+    import helpers
+
+    with patch("helpers.lookup", side_effect=helpers.UpstreamThrottled("budget")):
+        quotes = helpers.lookup_many(["IBM"], mark_unavailable=True)
+    assert quotes["IBM"] is helpers.QUOTE_UNAVAILABLE
+
+    with patch("app.lookup_many", return_value={"AAPL": helpers.QUOTE_UNAVAILABLE}) as batch:
+        response = client.post('/api/orders/batch', headers=auth_headers, json={"orders": [
+            {"symbol": "AAPL", "side": "BUY", "quantity": 1}]})
+    assert response.status_code == 503
+    assert response.json["results"][0]["error"] == helpers.THROTTLED
+    assert batch.call_args.kwargs["deadline"] >= helpers.PRIORITY_MAX_WAIT[helpers.PRIORITY_ORDER]
+
+    with patch("app.lookup_many", return_value={"AAPL": helpers.QUOTE_UNAVAILABLE, "NOPE": None}):
+        response = client.post('/api/orders/batch', headers=auth_headers, json={"orders": [
+            {"symbol": "AAPL", "side": "BUY", "quantity": 1}, {"symbol": "NOPE", "side": "BUY", "quantity": 1}]})
+    assert response.status_code == 400
@@ -0,0 +1,226 @@
+"""
+Order execution with atomic conditional UPDATEs, safe under parallel requests.
+
+Cash is debited with `UPDATE ... WHERE cash >= cost` and shares are removed
+with `UPDATE ... WHERE quantity >= sold`, so the database (not a read in
+Python) decides whether a trade fits. Positions are upserted through the
+unique (user_id, symbol) index. Lock timeouts and lost insert races roll the
+whole trade back and retry it a bounded number of times.
+"""
+import os
+import random
+import time
+from decimal import Decimal
+
+from sqlalchemy import select, update, insert
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from helpers import QUOTE_UNAVAILABLE, THROTTLED
+from model import User, Portfolio, Transaction
+from positions import buy_values, sell_values
+
+TRADE_MAX_RETRIES = int(os.getenv("TRADE_MAX_RETRIES", "5"))
+TRADE_RETRY_BACKOFF = 0.02
+ORDER_BATCH_MAX = int(os.getenv("ORDER_BATCH_MAX", "100"))
+ORDER_SIDES = ("BUY", "SELL")
+
+# Dialects with INSERT ... ON CONFLICT DO UPDATE
+_UPSERT_INSERTS = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}
+
+
+# Called as listener(user_id, symbol, quantity_delta, cash_delta, price) for
+# every trade once its transaction has committed
+trade_listeners = []
+
+
+class TradeRejected(Exception):
+    """The trade can't be executed; the message is shown to the user."""
+
+
+def _record(session, *trade):
+    session.info.setdefault("trades", []).append(trade)
+
+
+def _publish_trades(trades):
+    for trade in trades:
+        for listener in trade_listeners:
+            try:
+                listener(*trade)
+            except Exception as e:
+                print(f"Trade listener error: {e}")
+
+
+def _debit_cash(session, user_id, amount):
+    result = session.execute(
+        update(User).where(User.id == user_id, User.cash >= amount)
+        .values(cash=User.cash - amount, version=User.version + 1)
+        .execution_options(synchronize_session=False))
+    if result.rowcount == 0:
+        if session.scalar(select(User.id).where(User.id == user_id)) is None:
+            raise TradeRejected("User not found")
+        raise TradeRejected("Insufficient funds")
+
+
+def _credit_cash(session, user_id, amount):
+    result = session.execute(
+        update(User).where(User.id == user_id)
+        .values(cash=User.cash + amount, version=User.version + 1)
+        .execution_options(synchronize_session=False))
+    if result.rowcount == 0:
+        raise TradeRejected("User not found")
+
+
+def _add_to_position(session, user_id, symbol, quantity, price):
+    new_row = {"user_id": user_id, "symbol": symbol, "quantity": quantity, "price": price,
+               "total_cost": price * quantity, "avg_cost": price, "realized_pnl": 0}
+    upsert = _UPSERT_INSERTS.get(session.get_bind().dialect.name)
+    if upsert is not None:
+        stmt = upsert(Portfolio).values(new_row).on_conflict_do_update(
+            index_elements=[Portfolio.user_id, Portfolio.symbol],
+            set_={column.key: value for column, value in buy_values(quantity, price).items()})
+        session.execute(stmt)
+        return
+    result = session.execute(
+        update(Portfolio).where(Portfolio.user_id == user_id, Portfolio.symbol == symbol)
+        .values(buy_values(quantity, price))
+        .execution_options(synchronize_session=False))
+    if result.rowcount == 0:
+        # A concurrent first buy may win this insert; the IntegrityError retries the trade
+        session.execute(insert(Portfolio).values(new_row))
+
+
+def _remove_from_position(session, user_id, symbol, quantity, price):
+    result = session.execute(
+        update(Portfolio)
+        .where(Portfolio.user_id == user_id, Portfolio.symbol == symbol, Portfolio.quantity >= quantity)
+        .ordered_values(*sell_values(quantity, price))
+        .execution_options(synchronize_session=False))
+    if result.rowcount == 0:
+        held = session.scalar(select(Portfolio.quantity)
+                              .where(Portfolio.user_id == user_id, Portfolio.symbol == symbol))
+        if not held:
+            raise TradeRejected("You don't own this stock")
+        raise TradeRejected("Not enough shares")
+
+
+def execute_buy(session, user_id, symbol, quantity, price):
+    """Debit cash, grow the position and record the BUY in the current transaction."""
+    price = Decimal(str(price))
+    _debit_cash(session, user_id, price * quantity)
+    _add_to_position(session, user_id, symbol, quantity, price)
+    session.add(Transaction(user_id=user_id, symbol=symbol, quantity=quantity,
+                            price=price, transaction_type="BUY"))
+    _record(session, user_id, symbol, quantity, -price * quantity, price)
+
+
+def execute_sell(session, user_id, symbol, quantity, price):
+    """Shrink the position, credit cash and record the SELL in the current transaction."""
+    price = Decimal(str(price))
+    _remove_from_position(session, user_id, symbol, quantity, price)
+    _credit_cash(session, user_id, price * quantity)
+    session.add(Transaction(user_id=user_id, symbol=symbol, quantity=quantity,
+                            price=price, transaction_type="SELL"))
+    _record(session, user_id, symbol, -quantity, price * quantity, price)
+
+
+def run_trade(session, trade, *args):
+    """
+    Run trade(session, *args) and commit, retrying on lock timeouts and
+    insert races. Committed trades are passed to trade_listeners.
+    Returns "success" or the rejection message.
+    """
+    for attempt in range(TRADE_MAX_RETRIES):
+        session.info["trades"] = []
+        try:
+            trade(session, *args)
+            session.commit()
+            _publish_trades(session.info.pop("trades"))
+            return "success"
+        except TradeRejected as e:
+            session.rollback()
+            session.info.pop("trades", None)
+            return str(e)
+        except (OperationalError, IntegrityError) as e:
+            session.rollback()
+            session.info.pop("trades", None)
+            if attempt == TRADE_MAX_RETRIES - 1:
+                raise
+            print(f"Trade conflict, retrying: {e.orig}")
+            time.sleep(TRADE_RETRY_BACKOFF * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+
+def parse_order(raw):
+    """Normalize one batch order {"symbol", "side", "quantity"}; raises TradeRejected."""
+    if not isinstance(raw, dict):
+        raise TradeRejected("Order must be an object")
+    symbol = str(raw.get("symbol") or "").strip().upper()
+    if not symbol:
+        raise TradeRejected("Missing symbol")
+    side = str(raw.get("side") or raw.get("type") or "").upper()
+    if side not in ORDER_SIDES:
+        raise TradeRejected("side must be BUY or SELL")
+    try:
+        quantity = int(raw.get("quantity"))
+    except (TypeError, ValueError):
+        raise TradeRejected("Invalid quantity")
+    if quantity <= 0:
+        raise TradeRejected("Quantity must be positive")
+    return {"symbol": symbol, "side": side, "quantity": quantity}
+
+
+def plan_orders(orders, quotes, cash, holdings):
+    """
+    Price each order and check it against the cash and holdings left after
+    the orders before it, so a sell can fund a later buy.
+    orders are parse_order() dicts or TradeRejected; quotes may map symbols
+    to QUOTE_UNAVAILABLE, which rejects their orders with THROTTLED.
+    Returns per-order result dicts, with an "error" key on orders that
+    can't execute.
+    """
+    cash = Decimal(str(cash))
+    holdings = dict(holdings)
+    results = []
+    for index, order in enumerate(orders):
+        if isinstance(order, TradeRejected):
+            results.append({"index": index, "error": str(order)})
+            continue
+        result = dict(order, index=index)
+        results.append(result)
+        quote = quotes.get(order["symbol"])
+        if quote is QUOTE_UNAVAILABLE:
+            result["error"] = THROTTLED
+            continue
+        if not quote:
+            result["error"] = "Invalid symbol"
+            continue
+        price = Decimal(str(quote["price"]))
+        result["price"] = float(price)
+        amount = price * order["quantity"]
+        held = holdings.get(order["symbol"], 0)
+        if order["side"] == "BUY":
+            if amount > cash:
+                result["error"] = "Insufficient funds"
+                continue
+            cash -= amount
+            holdings[order["symbol"]] = held + order["quantity"]
+        else:
+            if held <= 0:
+                result["error"] = "You don't own this stock"
+                continue
+            if held < order["quantity"]:
+                result["error"] = "Not enough shares"
+                continue
+            cash += amount
+            holdings[order["symbol"]] = held - order["quantity"]
+    return results
+
+
+def execute_orders(session, user_id, planned):
+    """Apply planned orders in sequence within the current transaction."""
+    for result in planned:
+        trade = execute_buy if result["side"] == "BUY" else execute_sell
+        try:
+            trade(session, user_id, result["symbol"], result["quantity"], result["price"])
+        except TradeRejected as e:
+            raise TradeRejected(f"Order {result['index']}: {e}")
@@ -12,7 +12,7 @@ const Dashboard = ({ userToken, cash }) => {
         setError('');
         
         try {
-            const response = await fetch(`${API_BASE_URL}/api/portfolio`, {
+            const response = await fetch(`${API_BASE_URL}/api/portfolio?valuation=market`, {
                 headers: {
                     'Authorization': `Bearer ${userToken}`,
                     'Content-Type': 'application/json'
@@ -15,12 +15,24 @@ const LandingPage = ({ token }) => {
       .then(data => setMarketData(data))
       .catch(err => console.error("Error fetching market data:", err));
 
-    // 2. Simulated live latency heartbeat
+    // 2. Live prices pushed over Server-Sent Events instead of polling
+    const source = new EventSource(`${API_BASE_URL}/api/stream/prices`);
+    source.addEventListener('price', (event) => {
+      const update = JSON.parse(event.data);
+      setMarketData(prev => prev.map(stock =>
+        stock.symbol === update.symbol ? { ...stock, price: update.price } : stock
+      ));
+    });
+
+    // 3. Simulated live latency heartbeat
     const interval = setInterval(() => {
       setLatency(Math.floor(Math.random() * (18 - 8 + 1) + 8));
     }, 3000);
 
-    return () => clearInterval(interval);
+    return () => {
+      clearInterval(interval);
+      source.close();
+    };
   }, []);
 
   // Calculate dynamic volume safely
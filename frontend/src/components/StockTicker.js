@@ -6,16 +6,20 @@ const StockTicker = () => {
     const [stocks, setStocks] = useState([]);
 
     useEffect(() => {
-        const fetchMarketData = () => {
-            fetch(`${API_BASE_URL}/api/market-snapshot`)
-                .then(res => res.json())
-                .then(data => setStocks(data))
-                .catch(err => console.error("Ticker error:", err));
-        };
+        fetch(`${API_BASE_URL}/api/market-snapshot`)
+            .then(res => res.json())
+            .then(data => setStocks(data))
+            .catch(err => console.error("Ticker error:", err));
 
-        fetchMarketData();
-        const interval = setInterval(fetchMarketData, 60000); // Refresh every minute
-        return () => clearInterval(interval);
+        // Live updates are pushed by the server; EventSource reconnects on its own
+        const source = new EventSource(`${API_BASE_URL}/api/stream/prices`);
+        source.addEventListener('price', (event) => {
+            const update = JSON.parse(event.data);
+            setStocks(prev => prev.map(stock =>
+                stock.symbol === update.symbol ? { ...stock, price: update.price } : stock
+            ));
+        });
+        return () => source.close();
     }, []);
 
     return (